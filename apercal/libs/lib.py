@@ -1,7 +1,15 @@
+import atexit
 import logging
 import os
+import re
+import select
+import signal
 import subprocess
 import sys
+import threading
+import time
+import uuid
+from collections import namedtuple
 from ConfigParser import SafeConfigParser, ConfigParser
 
 import astropy.io.fits as pyfits
@@ -11,6 +19,11 @@ import matplotlib.pyplot as plt
 import numpy as np
 import drivecasa
 
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
 from apercal.subs import setinit as subs_setinit
 from apercal.modules import default_cfg
 from apercal.exceptions import ApercalException
@@ -142,18 +155,75 @@ def exceptioner(O, E):
             raise FatalMiriadError(E)
 
 
-def run_casa(cmd, raise_on_severe=False, log_output=False, timeout=1800):
-    """Run a list of casa commands"""
-    casa = drivecasa.Casapy()
+# Number of commands after which a reused CASA session is restarted
+CASA_SESSION_MAX_COMMANDS = 200
+
+# The CASA session of this process, which is reused by run_casa
+_casa_session = {'pid': None, 'casa': None, 'ncommands': 0}
+
+
+def close_casa_session():
+    """
+    Stop the CASA session of this process, the next call of run_casa starts a new one
+    """
+    casa = _casa_session['casa']
+    if casa is not None and _casa_session['pid'] == os.getpid():
+        try:
+            casa.child.close(force=True)
+        except Exception as e:
+            logger.debug("Could not close CASA session: " + str(e))
+    _casa_session.update(pid=None, casa=None, ncommands=0)
+
+
+atexit.register(close_casa_session)
+
+
+def get_casa_session():
+    """
+    Returns the CASA session of this process. A new session is started if there is none yet, if it died,
+    if it belongs to the parent of a forked process or if it already ran CASA_SESSION_MAX_COMMANDS commands.
+    """
+    casa = _casa_session['casa']
+    if _casa_session['pid'] != os.getpid():
+        # Sessions of the parent process can not be used in forked processes
+        _casa_session.update(pid=None, casa=None, ncommands=0)
+    elif casa is not None and (not casa.child.isalive() or
+                               _casa_session['ncommands'] >= CASA_SESSION_MAX_COMMANDS):
+        logger.debug("Restarting CASA session")
+        close_casa_session()
+    if _casa_session['casa'] is None:
+        _casa_session.update(pid=os.getpid(), casa=drivecasa.Casapy(), ncommands=0)
+    return _casa_session['casa']
+
+
+def run_casa(cmd, raise_on_severe=False, log_output=False, timeout=1800, reuse_session=True):
+    """
+    Run a list of casa commands
+    By default the commands run in a CASA session, which is kept alive for the following calls to save the
+    startup time of CASA. The session is restarted after a failed command and after CASA_SESSION_MAX_COMMANDS
+    commands. Set reuse_session to False to run the commands in a CASA instance of their own.
+    """
+    if reuse_session:
+        casa = get_casa_session()
+    else:
+        casa = drivecasa.Casapy()
     try:
         casa_output, casa_error = casa.run_script(cmd, raise_on_severe=True, timeout=timeout)
         if log_output:
             logger.info('\n'.join(casa_output))
         logger.debug('\n'.join(casa_error))
+        if reuse_session:
+            _casa_session['ncommands'] += len(cmd)
     except RuntimeError:
         logger.error("Casa command failed")
+        if reuse_session:
+            close_casa_session()
         if raise_on_severe:
             raise
+    except Exception:
+        if reuse_session:
+            close_casa_session()
+        raise
 
 
 def str2bool(s):
@@ -231,7 +301,7 @@ def strip_prefixes(lines, prefixes):
     return ret
 
 
-def basher(cmd, showasinfo=False, prefixes_to_strip=[]):
+def basher(cmd, showasinfo=False, prefixes_to_strip=[], timeout=None):
     """
     basher: shell run - helper function to run commands on the shell.
 
@@ -239,6 +309,7 @@ def basher(cmd, showasinfo=False, prefixes_to_strip=[]):
         cmd (str): command to be run
         showasinfo (bool): Log the output to info (default: log to debug)
         remove_ouput (List[str]): do not log lines that start with any of these strings
+        timeout (float): Seconds after which the command is killed (default: no timeout)
     """
     logger = logging.getLogger('basher')
     logger.debug(cmd)
@@ -258,9 +329,8 @@ def basher(cmd, showasinfo=False, prefixes_to_strip=[]):
     else:
         cmd = cmd.replace("(", "\\(")
         cmd = cmd.replace(")", "\\)")
-    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE, shell=True)
-    out, err = proc.communicate()
+    result = run_command(cmd, timeout=timeout)
+    out, err = result.out, result.err
 
     if len(out) > 0:
         if showasinfo:
@@ -273,13 +343,243 @@ def basher(cmd, showasinfo=False, prefixes_to_strip=[]):
         logger.debug(err)
     # NOTE: Returns the STD output.
     exceptioner(out, err)
-    if proc.returncode != 0:
+    if result.returncode != 0:
         raise RuntimeError("Error in command " + cmd.split(" ")[0] + ": \n" + err)
     logger.debug("Returning output.")
     # Standard output error are returned in a more convenient way
     return out.split('\n')[0:-1]
 
 
+ShellResult = namedtuple('ShellResult', ['cmd', 'returncode', 'out', 'err', 'duration'])
+
+
+def _to_str(data):
+    """Converts the raw output of a shell to a string"""
+    if isinstance(data, str):
+        return data
+    return data.decode('utf-8', 'replace')
+
+
+def _kill_process_group(proc):
+    """Kills a process started in its own session together with all the processes it spawned"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    proc.wait()
+
+
+class PersistentShell:
+    """
+    A long-lived shell, which runs commands sent to it one after another. This saves starting and initialising
+    a new shell for every command. Every command runs in a subshell in the current working directory of the
+    python process, so commands can not change the state of the persistent shell.
+    """
+
+    def __init__(self, init=None):
+        """
+        init (str): Command to run once when the shell is started, e.g. to source the MIRIAD environment
+        """
+        self.proc = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE, preexec_fn=os.setsid, close_fds=True)
+        if init:
+            result = self.run(init)
+            if result.returncode != 0:
+                self.close()
+                raise RuntimeError("Initialisation of persistent shell failed: \n" + result.err)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def close(self):
+        if self.alive():
+            _kill_process_group(self.proc)
+
+    def run(self, cmd, timeout=None):
+        """
+        Run a command in the shell and wait for it to finish
+        cmd (str): command to be run
+        timeout (float): Seconds after which the shell and the command are killed (default: no timeout)
+        returns (ShellResult): The command, its return code, standard output, standard error and duration
+        """
+        start = time.time()
+        marker = 'APERCAL_SHELL_' + uuid.uuid4().hex
+        # The command is passed quoted to eval, so that an unbalanced quote or a trailing backslash only gives a
+        # syntax error in the command and can not swallow the end markers
+        script = '( cd {0} && eval {1}\n) < /dev/null\nprintf "\\n{2} %d\\n" $?\nprintf "\\n{2}\\n" >&2\n'.format(
+            quote(os.getcwd()), quote(cmd), marker)
+        self.proc.stdin.write(script.encode('utf-8') if not isinstance(script, bytes) else script)
+        self.proc.stdin.flush()
+        out_end = re.compile(b'\n' + marker.encode('ascii') + b' (-?[0-9]+)\n$')
+        err_end = b'\n' + marker.encode('ascii') + b'\n'
+        out, err = b'', b''
+        out_done, err_done = None, False
+        while out_done is None or not err_done:
+            wait = None if timeout is None else timeout - (time.time() - start)
+            if wait is not None and wait <= 0:
+                self.close()
+                raise RuntimeError("Timeout after " + str(timeout) + "s in command " + cmd.split(" ")[0])
+            streams = []
+            if out_done is None:
+                streams.append(self.proc.stdout)
+            if not err_done:
+                streams.append(self.proc.stderr)
+            ready = select.select(streams, [], [], wait)[0]
+            for stream in ready:
+                chunk = os.read(stream.fileno(), 65536)
+                if not chunk:
+                    self.close()
+                    raise RuntimeError("Persistent shell died in command " + cmd.split(" ")[0])
+                if stream is self.proc.stdout:
+                    out += chunk
+                    out_done = out_end.search(out, max(0, len(out) - len(chunk) - len(marker) - 32))
+                else:
+                    err += chunk
+                    err_done = err.endswith(err_end)
+        returncode = int(out_done.group(1))
+        out = out[:out_done.start()]
+        err = err[:-len(err_end)]
+        return ShellResult(cmd, returncode, _to_str(out), _to_str(err), time.time() - start)
+
+
+class ShellPool:
+    """
+    Pool of persistent shells to run commands in. Shells are started on demand up to the size of the pool and
+    replaced if they die or time out. Shells are never shared with forked processes, which start their own.
+    """
+
+    def __init__(self, size=1, init=None):
+        """
+        size (int): Maximum number of shells
+        init (str): Command to run once in each new shell, e.g. to source the MIRIAD environment
+        """
+        self.size = size
+        self.init = init
+        self.pid = os.getpid()
+        self.idle = []
+        self.nshells = 0
+        self.lock = threading.Lock()
+        self.available = threading.Condition(self.lock)
+
+    def _acquire(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked process, the shells belong to the parent
+                self.pid = os.getpid()
+                self.idle = []
+                self.nshells = 0
+            while True:
+                while self.idle:
+                    shell = self.idle.pop()
+                    if shell.alive():
+                        return shell
+                    self.nshells -= 1
+                if self.nshells < self.size:
+                    self.nshells += 1
+                    break
+                self.available.wait()
+        try:
+            return PersistentShell(self.init)
+        except Exception:
+            with self.lock:
+                self.nshells -= 1
+                self.available.notify()
+            raise
+
+    def _release(self, shell):
+        with self.lock:
+            if shell.alive():
+                self.idle.append(shell)
+            else:
+                self.nshells -= 1
+            self.available.notify()
+
+    def run(self, cmd, timeout=None):
+        """
+        Run a command in one of the shells of the pool
+        cmd (str): command to be run
+        timeout (float): Seconds after which the command is killed (default: no timeout)
+        returns (ShellResult): The command, its return code, standard output, standard error and duration
+        """
+        shell = self._acquire()
+        try:
+            return shell.run(cmd, timeout=timeout)
+        finally:
+            self._release(shell)
+
+    def close(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                for shell in self.idle:
+                    shell.close()
+            self.idle = []
+            self.nshells = 0
+
+
+_shell_pool = None
+
+
+def enable_shell_pool(size=1, init=None):
+    """
+    Run all commands of basher (and with that all MIRIAD tasks) in a pool of persistent shells. This is off by
+    default, start_apercal_pipeline enables it with its shell_pool argument.
+    size (int): Maximum number of shells, only matters if commands are run from several threads
+    init (str): Command to run once in each new shell, e.g. to source the MIRIAD environment
+    """
+    global _shell_pool
+    disable_shell_pool()
+    _shell_pool = ShellPool(size, init)
+
+
+def disable_shell_pool():
+    """
+    Stop the persistent shells and run every command in a new shell again
+    """
+    global _shell_pool
+    if _shell_pool is not None:
+        _shell_pool.close()
+        _shell_pool = None
+
+
+def get_shell_pool():
+    """
+    Returns the active shell pool, None if commands run in a new shell each. The pool can also be enabled
+    with the environment variables APERCAL_SHELL_POOL (number of shells) and APERCAL_SHELL_INIT.
+    """
+    if _shell_pool is None and os.environ.get('APERCAL_SHELL_POOL'):
+        enable_shell_pool(int(os.environ['APERCAL_SHELL_POOL']), os.environ.get('APERCAL_SHELL_INIT'))
+    return _shell_pool
+
+
+def run_command(cmd, timeout=None):
+    """
+    Run a shell command, in a persistent shell if the shell pool is enabled, otherwise in a new shell
+    cmd (str): command to be run
+    timeout (float): Seconds after which the command is killed (default: no timeout)
+    returns (ShellResult): The command, its return code, standard output, standard error and duration
+    """
+    pool = get_shell_pool()
+    if pool is not None:
+        return pool.run(cmd, timeout=timeout)
+    start = time.time()
+    # Only a command with a timeout gets its own session, so that it can be killed with everything it spawned.
+    # Otherwise it stays in our process group and receives a Ctrl-C together with the pipeline.
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True,
+                            preexec_fn=os.setsid if timeout is not None else None)
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, _kill_process_group, [proc])
+        timer.start()
+    try:
+        out, err = proc.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    if timeout is not None and time.time() - start >= timeout and proc.returncode < 0:
+        raise RuntimeError("Timeout after " + str(timeout) + "s in command " + cmd.split(" ")[0])
+    return ShellResult(cmd, proc.returncode, _to_str(out), _to_str(err), time.time() - start)
+
+
 def get_source_names(vis=None):
     """
     get_source_names (vis=None)
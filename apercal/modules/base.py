@@ -14,6 +14,8 @@ class BaseModule:
         pass
 
     paramfilename = 'param.npy'
+    # If set, parameters are kept in this SQLite database in basedir, with paramfilename as namespace
+    paramdatabase = None
     fluxcal = None
     polcal = None
     target = None
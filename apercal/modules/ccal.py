@@ -1939,23 +1939,20 @@ class ccal(BaseModule):
             else:
                 plot_path = "."
 
-        # take MS file and get calibrated data
-        # amp_ant_array = np.empty(
-        #     (len(ant_names), len(freqs), n_stokes), dtype=np.float64)
+        # take MS file and get calibrated data of all antennas in one pass
+        try:
+            amp_ant_array = ccal_utils.get_autocorr_amplitudes(msfile)[2]
+        except Exception as e:
+            logger.warning("Beam {}: Could not get autocorrelation information".format(self.beam))
+            logger.exception(e)
+            amp_ant_array = None
         for ant, ant_name in enumerate(ant_names):
             # getting the autocorrelation amplitude
-            try:
-                taql_command = ("SELECT abs(gmeans(CORRECTED_DATA[FLAG])) AS amp "
-                                "FROM {0} "
-                                "WHERE ANTENNA1==ANTENNA2 && (ANTENNA1={1} || ANTENNA2={1})").format(msfile, ant)
-                t = pt.taql(taql_command)
-                test = t.getcol('amp')
-                amp_ant = t.getcol('amp')[0, :, :]
-            except Exception as e:
+            if amp_ant_array is None:
                 logger.warning("Beam {}: Could not get autocorrelation information for antenna {}".format(
                     self.beam, ant_name))
-                logger.exception(e)
                 continue
+            amp_ant = amp_ant_array[ant]
 
             # get XX and YY
             # amp_XX = amp_ant[:, 0]
@@ -32,6 +32,8 @@ class continuum(BaseModule):
     selfcaldir = None
 
     continuum_gaussianity = None
+    continuum_maskengine = 'pybdsf'
+    continuum_noiseengine = 'image'
     continuum_mfimage = None
     continuum_mfimage_imsize = None
     continuum_mfimage_cellsize = None
@@ -41,6 +43,7 @@ class continuum(BaseModule):
     continuum_mfimage_mindr = None
     continuum_mfimage_nsigma = None
     continuum_mfimage_robust = None
+    continuum_mfimage_convergence = None
     continuum_chunkimage = None
     continuum_chunkimage_startchannels = None
     continuum_chunkimage_endchannels = None
@@ -209,13 +212,14 @@ class continuum(BaseModule):
                 if dataset != None:
                     # Start the multi-frequency continuum imaging
                     # Calculate the theoretical noise and check Stokes V for gaussianity parameter
-                    gaussianity, TN = masking.get_theoretical_noise(self, dataset, self.continuum_gaussianity)
+                    gaussianity, TN = masking.get_theoretical_noise(self, dataset, self.continuum_gaussianity, engine=self.continuum_noiseengine)
                     if gaussianity:
                         pass
                     else:
                         logger.warning('Beam ' + self.beam + ': Stokes V image shows non-gaussian distribution. Your theoretical noise value might be off!')
                     logger.info('Beam ' + self.beam + ': Theoretical noise is ' + '%.6f' % TN + ' Jy')
                     TNreached = False  # Stop continuum imaging if theoretical noise is reached
+                    converged = False  # Stop continuum imaging if cleaning does not improve the image anymore
                     stop = False
                     for minc in range(self.continuum_mfimage_minorcycle):
                         if not stop:
@@ -260,8 +264,8 @@ class continuum(BaseModule):
                                     continuumtargetbeamsmfmaskthreshold[0] = maskth
                                     Cc = masking.calc_clean_cutoff(maskth, self.continuum_mfimage_c1)  # Clean cutoff
                                     continuumtargetbeamsmfcleanthreshold[0] = Cc
-                                    beampars = masking.get_beam(self, invert.map, invert.beam)
-                                    masking.create_mask(self, 'map_mf_00', 'mask_mf_00', maskth, TN, beampars=beampars, rms_map=False)
+                                    beampars = masking.get_beam(self, invert.map, invert.beam, dataset=invert.vis, imsize=invert.imsize, cell=invert.cell, robust=invert.robust)
+                                    masking.create_mask(self, 'map_mf_00', 'mask_mf_00', maskth, TN, beampars=beampars, rms_map=False, engine=self.continuum_maskengine)
                                     # Check if mask is there and ok
                                     if os.path.isdir('mask_mf_00'):
                                         continuumtargetbeamsmfmaskstats[minc, :] = imstats.getmaskstats(self, 'mask_mf_00', self.continuum_mfimage_imsize)
@@ -358,7 +362,7 @@ class continuum(BaseModule):
                                         continuumtargetbeamsmfmaskthreshold[minc] = maskth
                                     Cc = masking.calc_clean_cutoff(maskth, self.continuum_mfimage_c1)  # Clean cutoff
                                     continuumtargetbeamsmfcleanthreshold[minc] = Cc
-                                    masking.create_mask(self, 'image_mf_' + str(minc-1).zfill(2), 'mask_mf_' + str(minc).zfill(2), maskth, TN, beampars=None)
+                                    masking.create_mask(self, 'image_mf_' + str(minc-1).zfill(2), 'mask_mf_' + str(minc).zfill(2), maskth, TN, beampars=None, engine=self.continuum_maskengine)
                                     # Check if mask is there and ok
                                     if os.path.isdir('mask_mf_' + str(minc).zfill(2)):
                                         continuumtargetbeamsmfmaskstats[minc, :] = imstats.getmaskstats(self, 'mask_mf_' + str(minc).zfill(2), self.continuum_mfimage_imsize)
@@ -445,6 +449,10 @@ class continuum(BaseModule):
                                     continuumtargetbeamsmfresidualstats[minc, :] = residualstats
                                     currdr = dirtystats[1] / residualstats[2]
                                     logger.info('Beam ' + self.beam + ': Dynamic range is ' + '%.3f' % currdr + ' for cycle ' + str(minc))
+                                    if qa.checkconvergence(self, continuumtargetbeamsmfresidualstats[:minc + 1, 2], continuumtargetbeamsmfmodelstats[:minc + 1, 1], self.continuum_mfimage_convergence, ncycles=2):
+                                        converged = True
+                                        logger.info('Beam ' + self.beam + ': Cleaning converged in cycle ' + str(minc) + '. Stopping iterations and creating final image!')
+                                        break
                             else:
                                 break
                         else:
@@ -452,7 +460,7 @@ class continuum(BaseModule):
                     else:
                         continuumtargetbeamsmfstatus = False
                     # Final checks if continuum mf imaging was successful
-                    if TNreached:
+                    if TNreached or converged:
                         if qa.checkimagegaussianity(self, 'residual_mf_' + str(continuumtargetbeamsmffinalminor).zfill(2), self.continuum_gaussianity):
                             continuumtargetbeamsmfresidualstatus = True
                             continuumtargetbeamsmfstatus = True
@@ -497,23 +505,23 @@ class continuum(BaseModule):
             logger.info('Beam ' + self.beam + ': Multi-frequency continuum imaging not selected!')
 
         # Save the derived parameters to the parameter file
-
-        subs_param.add_param(self, beam + '_targetbeams_mf_status', continuumtargetbeamsmfstatus)
-        subs_param.add_param(self, beam + '_targetbeams_mf_mapstatus', continuumtargetbeamsmfmapstatus)
-        subs_param.add_param(self, beam + '_targetbeams_mf_mapstats', continuumtargetbeamsmfmapstats)
-        subs_param.add_param(self, beam + '_targetbeams_mf_beamstatus', continuumtargetbeamsmfbeamstatus)
-        subs_param.add_param(self, beam + '_targetbeams_mf_maskstatus', continuumtargetbeamsmfmaskstatus)
-        subs_param.add_param(self, beam + '_targetbeams_mf_maskstats', continuumtargetbeamsmfmaskstats)
-        subs_param.add_param(self, beam + '_targetbeams_mf_modelstatus', continuumtargetbeamsmfmodelstatus)
-        subs_param.add_param(self, beam + '_targetbeams_mf_modelstats', continuumtargetbeamsmfmodelstats)
-        subs_param.add_param(self, beam + '_targetbeams_mf_imagestatus', continuumtargetbeamsmfimagestatus)
-        subs_param.add_param(self, beam + '_targetbeams_mf_imagestats', continuumtargetbeamsmfimagestats)
-        subs_param.add_param(self, beam + '_targetbeams_mf_residualstatus', continuumtargetbeamsmfresidualstatus)
-        subs_param.add_param(self, beam + '_targetbeams_mf_residualstats', continuumtargetbeamsmfresidualstats)
-        subs_param.add_param(self, beam + '_targetbeams_mf_maskthreshold', continuumtargetbeamsmfmaskthreshold)
-        subs_param.add_param(self, beam + '_targetbeams_mf_cleanthreshold', continuumtargetbeamsmfcleanthreshold)
-        subs_param.add_param(self, beam + '_targetbeams_mf_thresholdtype', continuumtargetbeamsmfthresholdtype)
-        subs_param.add_param(self, beam + '_targetbeams_mf_final_minorcycle', continuumtargetbeamsmffinalminor)
+        with subs_param.param_batch(self):
+            subs_param.add_param(self, beam + '_targetbeams_mf_status', continuumtargetbeamsmfstatus)
+            subs_param.add_param(self, beam + '_targetbeams_mf_mapstatus', continuumtargetbeamsmfmapstatus)
+            subs_param.add_param(self, beam + '_targetbeams_mf_mapstats', continuumtargetbeamsmfmapstats)
+            subs_param.add_param(self, beam + '_targetbeams_mf_beamstatus', continuumtargetbeamsmfbeamstatus)
+            subs_param.add_param(self, beam + '_targetbeams_mf_maskstatus', continuumtargetbeamsmfmaskstatus)
+            subs_param.add_param(self, beam + '_targetbeams_mf_maskstats', continuumtargetbeamsmfmaskstats)
+            subs_param.add_param(self, beam + '_targetbeams_mf_modelstatus', continuumtargetbeamsmfmodelstatus)
+            subs_param.add_param(self, beam + '_targetbeams_mf_modelstats', continuumtargetbeamsmfmodelstats)
+            subs_param.add_param(self, beam + '_targetbeams_mf_imagestatus', continuumtargetbeamsmfimagestatus)
+            subs_param.add_param(self, beam + '_targetbeams_mf_imagestats', continuumtargetbeamsmfimagestats)
+            subs_param.add_param(self, beam + '_targetbeams_mf_residualstatus', continuumtargetbeamsmfresidualstatus)
+            subs_param.add_param(self, beam + '_targetbeams_mf_residualstats', continuumtargetbeamsmfresidualstats)
+            subs_param.add_param(self, beam + '_targetbeams_mf_maskthreshold', continuumtargetbeamsmfmaskthreshold)
+            subs_param.add_param(self, beam + '_targetbeams_mf_cleanthreshold', continuumtargetbeamsmfcleanthreshold)
+            subs_param.add_param(self, beam + '_targetbeams_mf_thresholdtype', continuumtargetbeamsmfthresholdtype)
+            subs_param.add_param(self, beam + '_targetbeams_mf_final_minorcycle', continuumtargetbeamsmffinalminor)
 
     def chunkimage(self):
         """
@@ -581,7 +589,7 @@ class continuum(BaseModule):
                         cn = 'Chunk ' + str(chunk).zfill(2) + ': '
                         # Calculate the theoretical noise and check Stokes V for gaussianity parameter for each chunk
                         try:
-                            gaussianity, TN = masking.get_theoretical_noise(self, dataset, self.continuum_gaussianity, startchan=startchanarray[chunk], endchan=endchanarray[chunk])
+                            gaussianity, TN = masking.get_theoretical_noise(self, dataset, self.continuum_gaussianity, startchan=startchanarray[chunk], endchan=endchanarray[chunk], engine=self.continuum_noiseengine)
                         except Exception as e:
                             logger.info("Imaging chunk " + str(chunk) + " failed, probably all flagged.")
                             continue
@@ -636,8 +644,8 @@ class continuum(BaseModule):
                                         continuumtargetbeamschunkmaskthreshold[chunk, 0] = maskth
                                         Cc = masking.calc_clean_cutoff(maskth, self.continuum_chunkimage_c1)  # Clean cutoff
                                         continuumtargetbeamschunkcleanthreshold[chunk, 0] = Cc
-                                        beampars = masking.get_beam(self, invert.map, invert.beam)
-                                        masking.create_mask(self, 'map_C' + str(chunk).zfill(2) + '_00', 'mask_C' + str(chunk).zfill(2) + '_00', maskth, TN, beampars=beampars, rms_map=False)
+                                        beampars = masking.get_beam(self, invert.map, invert.beam, dataset=invert.vis, imsize=invert.imsize, cell=invert.cell, robust=invert.robust, line=invert.line)
+                                        masking.create_mask(self, 'map_C' + str(chunk).zfill(2) + '_00', 'mask_C' + str(chunk).zfill(2) + '_00', maskth, TN, beampars=beampars, rms_map=False, engine=self.continuum_maskengine)
                                         # Check if mask is there and ok
                                         if os.path.isdir('mask_C' + str(chunk).zfill(2) + '_00'):
                                             continuumtargetbeamschunkmaskstats[chunk, minc, :] = imstats.getmaskstats(self, 'mask_C' + str(chunk).zfill(2) + '_00', self.continuum_chunkimage_imsize)
@@ -734,7 +742,7 @@ class continuum(BaseModule):
                                             continuumtargetbeamschunkmaskthreshold[chunk, minc] = maskth
                                         Cc = masking.calc_clean_cutoff(maskth, self.continuum_chunkimage_c1)  # Clean cutoff
                                         continuumtargetbeamschunkcleanthreshold[chunk, minc] = Cc
-                                        masking.create_mask(self, 'image_C' + str(chunk).zfill(2) + '_' + str(minc-1).zfill(2), 'mask_C' + str(chunk).zfill(2) + '_' + str(minc).zfill(2), maskth, TN, beampars=None)
+                                        masking.create_mask(self, 'image_C' + str(chunk).zfill(2) + '_' + str(minc-1).zfill(2), 'mask_C' + str(chunk).zfill(2) + '_' + str(minc).zfill(2), maskth, TN, beampars=None, engine=self.continuum_maskengine)
                                         # Check if mask is there and ok
                                         if os.path.isdir('mask_C' + str(chunk).zfill(2) + '_' + str(minc).zfill(2)):
                                             continuumtargetbeamschunkmaskstats[chunk, minc, :] = imstats.getmaskstats(self, 'mask_C' + str(chunk).zfill(2) + '_' + str(minc).zfill(2), self.continuum_chunkimage_imsize)
@@ -845,24 +853,24 @@ class continuum(BaseModule):
                 logger.info('Beam ' + self.beam + ': All chunks were already successfully imaged!')
 
         # Save the derived parameters to the parameter file
-
-        subs_param.add_param(self, beam + '_targetbeams_chunkall_status', continuumtargetbeamschunkallstatus)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_status', continuumtargetbeamschunkstatus)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_mapstatus', continuumtargetbeamschunkmapstatus)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_mapstats', continuumtargetbeamschunkmapstats)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_beamstatus', continuumtargetbeamschunkbeamstatus)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_maskstatus', continuumtargetbeamschunkmaskstatus)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_maskstats', continuumtargetbeamschunkmaskstats)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_modelstatus', continuumtargetbeamschunkmodelstatus)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_modelstats', continuumtargetbeamschunkmodelstats)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_imagestatus', continuumtargetbeamschunkimagestatus)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_imagestats', continuumtargetbeamschunkimagestats)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_residualstatus', continuumtargetbeamschunkresidualstatus)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_residualstats', continuumtargetbeamschunkresidualstats)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_maskthreshold', continuumtargetbeamschunkmaskthreshold)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_cleanthreshold', continuumtargetbeamschunkcleanthreshold)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_thresholdtype', continuumtargetbeamschunkthresholdtype)
-        subs_param.add_param(self, beam + '_targetbeams_chunk_final_minorcycle', continuumtargetbeamschunkfinalminor)
+        with subs_param.param_batch(self):
+            subs_param.add_param(self, beam + '_targetbeams_chunkall_status', continuumtargetbeamschunkallstatus)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_status', continuumtargetbeamschunkstatus)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_mapstatus', continuumtargetbeamschunkmapstatus)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_mapstats', continuumtargetbeamschunkmapstats)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_beamstatus', continuumtargetbeamschunkbeamstatus)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_maskstatus', continuumtargetbeamschunkmaskstatus)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_maskstats', continuumtargetbeamschunkmaskstats)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_modelstatus', continuumtargetbeamschunkmodelstatus)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_modelstats', continuumtargetbeamschunkmodelstats)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_imagestatus', continuumtargetbeamschunkimagestatus)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_imagestats', continuumtargetbeamschunkimagestats)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_residualstatus', continuumtargetbeamschunkresidualstatus)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_residualstats', continuumtargetbeamschunkresidualstats)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_maskthreshold', continuumtargetbeamschunkmaskthreshold)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_cleanthreshold', continuumtargetbeamschunkcleanthreshold)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_thresholdtype', continuumtargetbeamschunkthresholdtype)
+            subs_param.add_param(self, beam + '_targetbeams_chunk_final_minorcycle', continuumtargetbeamschunkfinalminor)
 
 
     def show(self, showall=False):
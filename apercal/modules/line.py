@@ -14,6 +14,7 @@ from apercal.libs.calculations import calc_dr_maj, calc_theoretical_noise, calc_
     calc_dr_min, calc_line_masklevel, calc_miniter
 from apercal.subs import setinit as subs_setinit
 from apercal.subs import managefiles as subs_managefiles
+from apercal.subs import imstats
 from apercal.subs.param import get_param_def
 
 from apercal.libs import lib
@@ -956,16 +957,7 @@ class line(BaseModule):
         image (string): The name of the image file. Must be in MIRIAD-format
         returns (float): the maximum in the image
         """
-        fits = lib.miriad('fits')
-        fits.op = 'xyout'
-        fits.in_ = image
-        fits.out = image + '.fits'
-        fits.go()
-        image_data = pyfits.open(image + '.fits')  # Open the image
-        data = image_data[0].data
-        imax = np.nanstd(data)  # Get the standard deviation
-        image_data.close()  # Close the image
-        subs_managefiles.director(self, 'rm', image + '.fits', ignore_nonexistent=True)
+        imax = imstats.getstats(image)['std']  # Get the standard deviation
         return imax
 
     def calc_imax(self, image):
@@ -974,16 +966,7 @@ class line(BaseModule):
         image (string): The name of the image file. Must be in MIRIAD-format
         returns (float): the maximum in the image
         """
-        fits = lib.miriad('fits')
-        fits.op = 'xyout'
-        fits.in_ = image
-        fits.out = image + '.fits'
-        fits.go()
-        image_data = pyfits.open(image + '.fits')  # Open the image
-        data = image_data[0].data
-        imax = np.nanmax(data)  # Get the maximum
-        image_data.close()  # Close the image
-        subs_managefiles.director(self, 'rm', image + '.fits', ignore_nonexistent=True)
+        imax = imstats.getstats(image)['max']  # Get the maximum
         return imax
 
     def calc_max_min_ratio(self, image):
@@ -992,20 +975,12 @@ class line(BaseModule):
         image (string): The name of the image file. Must be in MIRIAD-format
         returns (float): the ratio
         """
-        fits = lib.miriad('fits')
-        fits.op = 'xyout'
-        fits.in_ = image
-        fits.out = image + '.fits'
-        fits.go()
-        image_data = pyfits.open(image + '.fits')  # Open the image
-        data = image_data[0].data
-        imax = np.nanmax(data)  # Get the maximum
-        imin = np.nanmin(data)  # Get the minimum
+        stats = imstats.getstats(image)
+        imax = stats['max']  # Get the maximum
+        imin = stats['min']  # Get the minimum
         max_min = np.abs(imax / imin)  # Calculate the ratios
         min_max = np.abs(imin / imax)
         ratio = np.nanmax([max_min, min_max])  # Take the maximum of both ratios and return it
-        image_data.close()  # Close the image
-        subs_managefiles.director(self, 'rm', image + '.fits', ignore_nonexistent=True)
         return ratio
 
     def calc_isum(self, image):
@@ -1014,16 +989,7 @@ class line(BaseModule):
         image (string): The name of the image file. Must be in MIRIAD-format
         returns (float): the sum of the pxiels in the image
         """
-        fits = lib.miriad('fits')
-        fits.op = 'xyout'
-        fits.in_ = image
-        fits.out = image + '.fits'
-        fits.go()
-        image_data = pyfits.open(image + '.fits')  # Open the image
-        data = image_data[0].data
-        isum = np.nansum(data)  # Get the maximum
-        image_data.close()  # Close the image
-        subs_managefiles.director(self, 'rm', image + '.fits', ignore_nonexistent=True)
+        isum = imstats.getstats(image)['nansum']  # Get the maximum
         return isum
 
     def list_chunks(self):
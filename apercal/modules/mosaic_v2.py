@@ -5,13 +5,19 @@ import os
 import socket
 import subprocess
 import glob
+import hashlib
 import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import astropy.io.fits as pyfits
 
 from apercal.modules.base import BaseModule
 from apercal.subs import setinit as subs_setinit
 from apercal.subs import managefiles as subs_managefiles
 from apercal.subs import readmirhead as subs_readmirhead
 from apercal.subs import param as subs_param
+from apercal.subs import linmos as subs_linmos
+from apercal.subs import mirio as subs_mirio
 from apercal.subs.param import get_param_def
 from apercal.libs import lib
 import apercal.subs.mosaic_utils as mosaic_utils
@@ -71,8 +77,12 @@ class mosaic(BaseModule):
     mosaic_gaussian_beam_map_cellsize = 4.0
     mosaic_gaussian_beam_map_fwhm_arcsec = 1950.0
     mosaic_beam_map_cutoff = 0.25
+    mosaic_beam_map_cache = None
     mosaic_use_askap_based_matrix = False
     mosaic_common_beam_type = ''
+    mosaic_math_engine = 'miriad'
+    mosaic_math_tile_rows = 64
+    mosaic_regrid_engine = 'miriad'
 
     # continuumm-specific settings
     mosaic_continuum_subdir = None
@@ -89,6 +99,8 @@ class mosaic(BaseModule):
     mosaic_continuum_clean_up = None
     mosaic_continuum_clean_up_level = None
     mosaic_continuum_image_validation = None
+    mosaic_continuum_incremental = False
+    mosaic_continuum_update_beams = None
 
     # polarisation specific settings
     mosaic_polarisation_subdir = None
@@ -119,6 +131,12 @@ class mosaic(BaseModule):
                 "Type of common beam for convolving was not provided. Using circular beam")
             self.mosaic_common_beam_type = 'circular'
 
+        if self.mosaic_regrid_engine == 'python' and self.mosaic_math_engine != 'numpy':
+            logger.warning(
+                "Reprojecting images in python requires the numpy math engine. Overriding mosaic_math_engine = '{0}' "
+                "and using the numpy engine for the mosaic maths".format(self.mosaic_math_engine))
+            self.mosaic_math_engine = 'numpy'
+
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
     # The main function for the module
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -861,6 +879,22 @@ class mosaic(BaseModule):
             self, 'mosaic_polarisation_images_status', mosaic_polarisation_images_status)
 
 
+    # +++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function to get the location of the beam map cache
+    # +++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_beam_map_cache_dir(self):
+        """
+        Function to get the directory of the cache of beam maps
+
+        Beam maps in the cache are reused by the continuum and polarisation mosaics. Set mosaic_beam_map_cache to a
+        shared directory to reuse them for other mosaics as well.
+
+        returns (str): Absolute path of the cache directory
+        """
+        if self.mosaic_beam_map_cache:
+            return os.path.abspath(self.mosaic_beam_map_cache)
+        return os.path.join(os.path.abspath(self.mosdir), 'beam_map_cache')
+
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function to get the beam maps
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -887,7 +921,8 @@ class mosaic(BaseModule):
                                              bm_size=self.mosaic_gaussian_beam_map_size,
                                              cell=self.mosaic_gaussian_beam_map_cellsize,
                                              fwhm=self.mosaic_gaussian_beam_map_fwhm_arcsec,
-                                             cutoff=self.mosaic_beam_map_cutoff)
+                                             cutoff=self.mosaic_beam_map_cutoff,
+                                             cache_dir=self.get_beam_map_cache_dir())
                 except Exception as e:
                     error = "Creating continuum beam map of beam {} ... Failed".format(beam)
                     logger.warning(error)
@@ -933,7 +968,8 @@ class mosaic(BaseModule):
                                              bm_size=self.mosaic_gaussian_beam_map_size,
                                              cell=self.mosaic_gaussian_beam_map_cellsize,
                                              fwhm=self.mosaic_gaussian_beam_map_fwhm_arcsec,
-                                             cutoff=self.mosaic_beam_map_cutoff)
+                                             cutoff=self.mosaic_beam_map_cutoff,
+                                             cache_dir=self.get_beam_map_cache_dir())
                 except Exception as e:
                     error = "Creating polarisation beam maps of beam {} ... Failed".format(beam)
                     logger.warning(error)
@@ -966,8 +1002,7 @@ class mosaic(BaseModule):
         At the moment the function is only successful
         if all beams were successfully.
 
-        TODO:
-            Conversion should be parallelised.
+        The beams are converted in parallel if mosaic_parallelisation is enabled.
         """
 
         logger.info("Converting continuum fits images to miriad images")
@@ -980,8 +1015,8 @@ class mosaic(BaseModule):
 
         if not mosaic_continuum_convert_fits_images_status:
 
-            # go through the list of beams
-            for beam in self.mosaic_beam_list:
+            # convert a single beam
+            def convert_image(beam):
 
                 logger.debug(
                     "Converting continuum fits image of beam {} to miriad image".format(beam))
@@ -997,28 +1032,24 @@ class mosaic(BaseModule):
                     try:
                         fits.go()
                     except Exception as e:
-                        mosaic_continuum_convert_fits_images_status = False
                         error = "Converting continuum fits image of beam {} to miriad image ... Failed".format(
                             beam)
                         logger.error(error)
                         logger.exception(e)
                         raise RuntimeError(error)
                     else:
-                        mosaic_continuum_convert_fits_images_status = True
                         logger.debug(
                             "Converting continuum fits image of beam {} to miriad image ... Done".format(beam))
 
                 else:
                     logger.warning(
                         "Miriad continuum image already exists for beam {}. Did not convert from fits again".format(beam))
-                    mosaic_continuum_convert_fits_images_status = True
 
-            if mosaic_continuum_convert_fits_images_status:
-                logger.info(
-                    "Converting continuum fits images to miriad images ... Done")
-            else:
-                logger.warning(
-                    "Converting continuum fits images to miriad images ... Failed for at least one beam. Please check the log")
+            self.run_beam_tasks(convert_image)
+            mosaic_continuum_convert_fits_images_status = True
+
+            logger.info(
+                "Converting continuum fits images to miriad images ... Done")
         else:
             logger.info("Continuum images have already been converted.")
 
@@ -1042,7 +1073,8 @@ class mosaic(BaseModule):
 
         if not mosaic_polarisation_convert_fits_images_status:
 
-            for beam in self.mosaic_beam_list:
+            # convert the images of a single beam
+            def convert_images(beam):
                 # Convert the Q and U cubes to MIRIAD
                 try:
                     fits = lib.miriad('fits')
@@ -1057,23 +1089,20 @@ class mosaic(BaseModule):
                     fits.out = os.path.join(beam, "image_mf_V")
                     fits.go()
                 except Exception as e:
-                    mosaic_polarisation_convert_fits_images_status = False
                     error = "Converting polarisation fits images of beam {} to miriad image ... Failed".format(
                         beam)
                     logger.error(error)
                     logger.exception(e)
                     raise RuntimeError(error)
                 else:
-                    mosaic_polarisation_convert_fits_images_status = True
                     logger.debug(
                         "Converting polarisation fits images of beam {} to miriad image ... Done".format(beam))
 
-            if mosaic_polarisation_convert_fits_images_status:
-                logger.info(
-                    "Converting polarisation fits images to miriad images ... Successful")
-            else:
-                logger.warning(
-                    "Converting polarisation fits images to miriad images ... Failed for at least one beam. Please check the log.")
+            self.run_beam_tasks(convert_images)
+            mosaic_polarisation_convert_fits_images_status = True
+
+            logger.info(
+                "Converting polarisation fits images to miriad images ... Successful")
         else:
             logger.info("Polarisation images have already been converted.")
 
@@ -1630,12 +1659,15 @@ class mosaic(BaseModule):
         mosaic_continuum_regrid_images_status = get_param_def(
             self, 'mosaic_continuum_regrid_images_status', False)
 
-        if not mosaic_continuum_regrid_images_status:
+        if not mosaic_continuum_regrid_images_status and self.mosaic_regrid_engine == 'python':
+            logger.info("Continuum images will be reprojected when combining them")
+            mosaic_continuum_regrid_images_status = True
+        elif not mosaic_continuum_regrid_images_status:
             # switch to continuum mosaic directory
             subs_managefiles.director(self, 'ch', self.mosaic_continuum_dir)
 
             # Put images on mosaic template grid
-            for beam in self.mosaic_beam_list:
+            def regrid_image(beam):
                 logger.debug("Regridding continuum beam {}".format(beam))
                 regrid = lib.miriad('regrid')
                 input_file = os.path.join(self.mosaic_continuum_images_subdir, '{0}/image_{0}.map'.format(beam))
@@ -1661,6 +1693,8 @@ class mosaic(BaseModule):
                 else:
                     logger.warning("Regridded continuum image of beam {} already exists".format(beam))
 
+            self.run_beam_tasks(regrid_image)
+
             logger.info("Regridding continuum images ... Done")
             mosaic_continuum_regrid_images_status = True
         else:
@@ -1688,7 +1722,7 @@ class mosaic(BaseModule):
             subs_managefiles.director(self, 'ch', self.mosaic_polarisation_dir)
 
             # Put images on mosaic template grid
-            for beam in self.mosaic_beam_list:
+            def regrid_images(beam):
 
                 # Get the needed information from the param files
                 pbeam = 'polarisation_B' + str(beam).zfill(2)
@@ -1784,6 +1818,8 @@ class mosaic(BaseModule):
                 else:
                     logger.warning("Regridded Stokes V image of beam {} already exists".format(beam))
 
+            self.run_beam_tasks(regrid_images)
+
             logger.info("Regridding polarisation images ... Done")
             mosaic_polarisation_regrid_images_status = True
         else:
@@ -1811,7 +1847,7 @@ class mosaic(BaseModule):
             subs_managefiles.director(self, 'ch', self.mosaic_continuum_dir)
 
             # Put images on mosaic template grid
-            for beam in self.mosaic_beam_list:
+            def regrid_beam_map(beam):
                 input_file = os.path.join(
                     self.mosaic_continuum_beam_subdir, 'beam_{}.map'.format(beam))
                 output_file = os.path.join(
@@ -1839,6 +1875,8 @@ class mosaic(BaseModule):
                 else:
                     logger.warning("Regridded continuum beam map of beam {} already exists".format(beam))
 
+            self.run_beam_tasks(regrid_beam_map)
+
             logger.info("Regridding continuum beam maps ... Done")
 
             mosaic_continuum_regrid_beam_maps_status = True
@@ -1867,7 +1905,7 @@ class mosaic(BaseModule):
             subs_managefiles.director(self, 'ch', self.mosaic_polarisation_dir)
 
             # Put images on mosaic template grid
-            for beam in self.mosaic_beam_list:
+            def regrid_beam_map(beam):
                 input_file = os.path.join(
                     self.mosaic_polarisation_beam_subdir, 'beam_{}.map'.format(beam))
                 output_file = os.path.join(
@@ -1895,6 +1933,8 @@ class mosaic(BaseModule):
                 else:
                     logger.warning("Regridded polarisation beam map of beam {} already exists".format(beam))
 
+            self.run_beam_tasks(regrid_beam_map)
+
             logger.info("Regridding polarisation beam maps ... Done")
 
             mosaic_polarisation_regrid_beam_maps_status = True
@@ -1908,6 +1948,37 @@ class mosaic(BaseModule):
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function to get the common beam for the continuum images
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_common_beam(self, images, common_beam_type):
+        """
+        Function to get the common beam of a set of images from their headers
+
+        Args:
+            images (list): MIRIAD or FITS images
+            common_beam_type (str): circular for the smallest circular beam or elliptical for the smallest elliptical
+                beam to which all images can be convolved
+
+        returns (list): bmaj and bmin in arcsec and bpa in degrees of the common beam, increased by 5 percent
+        """
+        if common_beam_type == 'circular':
+            logger.debug("Using circular beam")
+        elif common_beam_type == "elliptical":
+            logger.debug("Using elliptical beam")
+        else:
+            error = "Unknown type of common beam requested. Abort"
+            logger.error(error)
+            raise RuntimeError(error)
+
+        try:
+            c_beam = subs_linmos.get_common_beam(images, circular=(common_beam_type == 'circular'), margin=1.05,
+                                                 nworkers=self.get_mosaic_nworkers())
+        except Exception as e:
+            error = "Determining the common beam of {} images ... Failed".format(len(images))
+            logger.error(error)
+            logger.exception(e)
+            raise RuntimeError(error)
+
+        return [float(x) for x in c_beam]
+
     def get_continuum_common_beam(self):
         """
         Function to calculate a common beam to convolve images
@@ -1916,7 +1987,7 @@ class mosaic(BaseModule):
 
         There are several options
         1. Calculate a circular beam (default)
-        2. Calculate the maximum beam
+        2. Calculate the smallest elliptical beam all images can be convolved to
         """
 
         mosaic_continuum_common_beam_status = get_param_def(
@@ -1931,43 +2002,8 @@ class mosaic(BaseModule):
         subs_managefiles.director(self, 'ch', self.mosaic_continuum_images_dir)
 
         if not mosaic_continuum_common_beam_status:
-            # this is where the beam information will be stored
-            bmaj = []
-            bmin = []
-            bpa = []
-
-            # go through the beams and get the information
-            for beam in self.mosaic_beam_list:
-                gethd = lib.miriad('gethd')
-                gethd.in_ = '{0}/image_{0}.map/bmaj'.format(beam)
-                bmaj.append(gethd.go())
-                gethd.in_ = '{0}/image_{0}.map/bmin'.format(beam)
-                bmin.append(gethd.go())
-                gethd.in_ = '{0}/image_{0}.map/bpa'.format(beam)
-                bpa.append(gethd.go())
-
-            # Calculate maximum bmaj and bmin and median bpa for final convolved beam shape
-            bmajor = [float(x[0]) for x in bmaj]
-            bmajor = 3600. * np.degrees(bmajor)
-
-            bminor = [float(x[0]) for x in bmin]
-            bminor = 3600. * np.degrees(bminor)
-
-            bangle = [float(x[0]) for x in bpa]
-            bangle = np.degrees(bangle)
-
-            if self.mosaic_continuum_common_beam_type == 'circular':
-                logger.debug("Using circular beam")
-                max_axis = np.nanmax([bmajor, bminor])
-                c_beam = [1.05 * max_axis, 1.05 * max_axis, 0.]
-            elif self.mosaic_continuum_common_beam_type == "elliptical":
-                logger.debug("Using elliptical beam")
-                c_beam = [1.05 * np.nanmax(bmajor), 1.05 *
-                          np.nanmax(bminor), np.nanmedian(bangle)]
-            else:
-                error = "Unknown type of common beam requested. Abort"
-                logger.error(error)
-                raise RuntimeError(error)
+            images = ['{0}/image_{0}.map'.format(beam) for beam in self.mosaic_beam_list]
+            c_beam = self.get_common_beam(images, self.mosaic_continuum_common_beam_type)
 
             logger.debug(
                 'The final, convolved, synthesized beam has bmaj, bmin, bpa of: {}'.format(str(c_beam)))
@@ -1996,7 +2032,7 @@ class mosaic(BaseModule):
 
         There are several options
         1. Calculate a circular beam (default)
-        2. Calculate the maximum beam
+        2. Calculate the smallest elliptical beam all images can be convolved to
         """
 
         mosaic_polarisation_common_beam_status = get_param_def(
@@ -2022,43 +2058,8 @@ class mosaic(BaseModule):
 
             # Calculate the common beam values for the Stokes Q images
             for qplane in range(qimages):
-                # this is where the beam information will be stored
-                bmaj = []
-                bmin = []
-                bpa = []
-
-                # go through the beams and get the information
-                for beam in self.mosaic_beam_list:
-                    gethd = lib.miriad('gethd')
-                    gethd.in_ = os.path.join(beam, "Qcube_" + str(qplane).zfill(3) + '/bmaj')
-                    bmaj.append(gethd.go())
-                    gethd.in_ = os.path.join(beam, "Qcube_" + str(qplane).zfill(3) + '/bmin')
-                    bmin.append(gethd.go())
-                    gethd.in_ = os.path.join(beam, "Qcube_" + str(qplane).zfill(3) + '/bpa')
-                    bpa.append(gethd.go())
-
-                # Calculate maximum bmaj and bmin and median bpa for final convolved beam shape
-                bmajor = [float(x[0]) for x in bmaj]
-                bmajor = 3600. * np.degrees(bmajor)
-
-                bminor = [float(x[0]) for x in bmin]
-                bminor = 3600. * np.degrees(bminor)
-
-                bangle = [float(x[0]) for x in bpa]
-                bangle = np.degrees(bangle)
-
-                if self.mosaic_polarisation_common_beam_type == 'circular':
-                    logger.debug("Using circular beam")
-                    max_axis = np.nanmax([bmajor, bminor])
-                    c_beam = [1.05 * max_axis, 1.05 * max_axis, 0.]
-                elif self.mosaic_polarisation_common_beam_type == "elliptical":
-                    logger.debug("Using elliptical beam")
-                    c_beam = [1.05 * np.nanmax(bmajor), 1.05 *
-                              np.nanmax(bminor), np.nanmedian(bangle)]
-                else:
-                    error = "Unknown type of common beam requested. Abort"
-                    logger.error(error)
-                    raise RuntimeError(error)
+                images = [os.path.join(beam, "Qcube_" + str(qplane).zfill(3)) for beam in self.mosaic_beam_list]
+                c_beam = self.get_common_beam(images, self.mosaic_polarisation_common_beam_type)
 
                 logger.debug('The final, convolved, synthesized beam has bmaj, bmin, bpa of: {}'.format(str(c_beam)))
 
@@ -2066,86 +2067,16 @@ class mosaic(BaseModule):
 
             # Calculate the common beam values for the Stokes U images
             for uplane in range(qimages):
-                # this is where the beam information will be stored
-                bmaj = []
-                bmin = []
-                bpa = []
-
-                # go through the beams and get the information
-                for beam in self.mosaic_beam_list:
-                    gethd = lib.miriad('gethd')
-                    gethd.in_ = os.path.join(beam, "Ucube_" + str(uplane).zfill(3) + '/bmaj')
-                    bmaj.append(gethd.go())
-                    gethd.in_ = os.path.join(beam, "Ucube_" + str(uplane).zfill(3) + '/bmin')
-                    bmin.append(gethd.go())
-                    gethd.in_ = os.path.join(beam, "Ucube_" + str(uplane).zfill(3) + '/bpa')
-                    bpa.append(gethd.go())
-
-                # Calculate maximum bmaj and bmin and median bpa for final convolved beam shape
-                bmajor = [float(x[0]) for x in bmaj]
-                bmajor = 3600. * np.degrees(bmajor)
-
-                bminor = [float(x[0]) for x in bmin]
-                bminor = 3600. * np.degrees(bminor)
-
-                bangle = [float(x[0]) for x in bpa]
-                bangle = np.degrees(bangle)
-
-                if self.mosaic_polarisation_common_beam_type == 'circular':
-                    logger.debug("Using circular beam")
-                    max_axis = np.nanmax([bmajor, bminor])
-                    c_beam = [1.05 * max_axis, 1.05 * max_axis, 0.]
-                elif self.mosaic_polarisation_common_beam_type == "elliptical":
-                    logger.debug("Using elliptical beam")
-                    c_beam = [1.05 * np.nanmax(bmajor), 1.05 *
-                              np.nanmax(bminor), np.nanmedian(bangle)]
-                else:
-                    error = "Unknown type of common beam requested. Abort"
-                    logger.error(error)
-                    raise RuntimeError(error)
+                images = [os.path.join(beam, "Ucube_" + str(uplane).zfill(3)) for beam in self.mosaic_beam_list]
+                c_beam = self.get_common_beam(images, self.mosaic_polarisation_common_beam_type)
 
                 logger.debug('The final, convolved, synthesized beam has bmaj, bmin, bpa of: {}'.format(str(c_beam)))
 
                 mosaic_polarisation_common_beam_values_qu[1, uplane, :] = c_beam
 
             # Calculate the common beam values for the Stokes V images
-            # this is where the beam information will be stored
-            bmaj = []
-            bmin = []
-            bpa = []
-
-            # go through the beams and get the information
-            for beam in self.mosaic_beam_list:
-                gethd = lib.miriad('gethd')
-                gethd.in_ = '{0}/image_mf_V/bmaj'.format(beam)
-                bmaj.append(gethd.go())
-                gethd.in_ = '{0}/image_mf_V/bmin'.format(beam)
-                bmin.append(gethd.go())
-                gethd.in_ = '{0}/image_mf_V/bpa'.format(beam)
-                bpa.append(gethd.go())
-
-            # Calculate maximum bmaj and bmin and median bpa for final convolved beam shape
-            bmajor = [float(x[0]) for x in bmaj]
-            bmajor = 3600. * np.degrees(bmajor)
-
-            bminor = [float(x[0]) for x in bmin]
-            bminor = 3600. * np.degrees(bminor)
-
-            bangle = [float(x[0]) for x in bpa]
-            bangle = np.degrees(bangle)
-
-            if self.mosaic_polarisation_common_beam_type == 'circular':
-                logger.debug("Using circular beam")
-                max_axis = np.nanmax([bmajor, bminor])
-                c_beam = [1.05 * max_axis, 1.05 * max_axis, 0.]
-            elif self.mosaic_polarisation_common_beam_type == "elliptical":
-                logger.debug("Using elliptical beam")
-                c_beam = [1.05 * np.nanmax(bmajor), 1.05 *
-                          np.nanmax(bminor), np.nanmedian(bangle)]
-            else:
-                error = "Unknown type of common beam requested. Abort"
-                logger.error(error)
-                raise RuntimeError(error)
+            images = ['{0}/image_mf_V'.format(beam) for beam in self.mosaic_beam_list]
+            c_beam = self.get_common_beam(images, self.mosaic_polarisation_common_beam_type)
 
             logger.debug('The final, convolved, synthesized beam has bmaj, bmin, bpa of: {}'.format(str(c_beam)))
 
@@ -2188,12 +2119,29 @@ class mosaic(BaseModule):
         logger.info("Convolving continuum images with common beam with beam {}".format(
             mosaic_continuum_common_beam_values))
 
+        mosaic_continuum_convolved_beam_values = get_param_def(
+            self, 'mosaic_continuum_convolved_beam_values', [])
+
         # change to directory of continuum images
         subs_managefiles.director(self, 'ch', self.mosaic_continuum_dir)
 
-        if not mosaic_continuum_convolve_images_status:
+        # existing convolved images cannot be used if the common beam has changed since they were convolved
+        if not mosaic_continuum_convolve_images_status and len(mosaic_continuum_convolved_beam_values) != 0 and \
+                not np.allclose(mosaic_continuum_convolved_beam_values, mosaic_continuum_common_beam_values):
+            logger.info("Common beam has changed. Convolving all continuum images again")
+            for fl in glob.glob(os.path.join(self.mosaic_continuum_mosaic_dir, 'image_*_mos.map')) + \
+                    glob.glob(os.path.join(self.mosaic_continuum_mosaic_dir, 'image_*_conv.npy')):
+                subs_managefiles.director(self, 'rm', fl, ignore_nonexistent=True)
 
-            for beam in self.mosaic_beam_list:
+        if not mosaic_continuum_convolve_images_status and self.mosaic_regrid_engine == 'python':
+            # Convolve the images on their own grid, they are reprojected when combining them
+            self.run_beam_tasks(self.mosaic_continuum_convolve_image_python)
+            mosaic_continuum_convolve_images_status = True
+
+            logger.info("Convolving continuum images with common beam ... Done")
+        elif not mosaic_continuum_convolve_images_status:
+
+            def convolve_image(beam):
                 logger.info("Convolving continuum image of beam {}".format(beam))
 
                 # output map and input map
@@ -2222,16 +2170,88 @@ class mosaic(BaseModule):
                 else:
                     logger.warning("Convolved continuum image of beam {} already exists".format(beam))
 
-                    mosaic_continuum_convolve_images_status = True
+            self.run_beam_tasks(convolve_image)
+            mosaic_continuum_convolve_images_status = True
 
             logger.info("Convolving continuum images with common beam ... Done")
         else:
             logger.info("Continuum images have already been convolved")
 
+        if mosaic_continuum_convolve_images_status:
+            subs_param.add_param(
+                self, 'mosaic_continuum_convolved_beam_values', mosaic_continuum_common_beam_values)
+
         subs_param.add_param(
             self, 'mosaic_continuum_convolve_images_status', mosaic_continuum_convolve_images_status)
 
 
+    def mosaic_continuum_convolve_image_python(self, beam):
+        """
+        Function to convolve the continuum image of a beam with the common beam in memory
+
+        The image is convolved on its own grid and stored as a numpy file in the mosaic directory
+        """
+
+        logger.info("Convolving continuum image of beam {}".format(beam))
+
+        mosaic_continuum_common_beam_values = get_param_def(
+            self, 'mosaic_continuum_common_beam_values', np.zeros(3))
+
+        input_file = os.path.join(self.mosaic_continuum_images_dir, '{0}/image_{0}.map'.format(beam))
+        output_file = os.path.join(self.mosaic_continuum_mosaic_dir, 'image_{0}_conv.npy'.format(beam))
+
+        if os.path.isfile(output_file):
+            logger.warning("Convolved continuum image of beam {} already exists".format(beam))
+            return
+
+        try:
+            header = subs_mirio.readheader(input_file)
+            data = subs_mirio.readimage(input_file)
+            image_beam = (3600. * np.degrees(float(header['bmaj'])), 3600. * np.degrees(float(header['bmin'])),
+                          float(header['bpa']))
+            cdelt = (3600. * np.degrees(float(header['cdelt1'])), 3600. * np.degrees(float(header['cdelt2'])))
+            convolved = subs_linmos.convolve_to_beam(data.reshape((-1,) + data.shape[-2:])[0], cdelt, image_beam,
+                                                     [float(x) for x in mosaic_continuum_common_beam_values])
+            # write to a temporary file first, so an interrupted run does not leave an incomplete image
+            tmp_file = output_file[:-len('.npy')] + '_tmp.npy'
+            np.save(tmp_file, convolved)
+            os.rename(tmp_file, output_file)
+        except Exception as e:
+            error = "Convolving continuum image of beam {} ... Failed".format(beam)
+            logger.error(error)
+            logger.exception(e)
+            raise RuntimeError(error)
+        else:
+            logger.debug("Convolving continuum image of beam {} ... Done".format(beam))
+
+    # +++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function to get the continuum images reprojected in memory
+    # +++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_continuum_reprojected_images(self):
+        """
+        Function to get the convolved continuum images of all beams reprojected onto the mosaic template
+
+        returns (dict): ReprojectedImage for each beam
+        """
+
+        template_file = os.path.join(self.mosaic_continuum_mosaic_dir, "mosaic_continuum_template.map")
+        template_header = subs_mirio.readheader(template_file)
+        template_wcs = subs_mirio.getwcs(template_header)
+        template_shape = subs_mirio.getshape(template_header)
+
+        images = {}
+        for beam in self.mosaic_beam_list:
+            input_file = os.path.join(self.mosaic_continuum_images_dir, '{0}/image_{0}.map'.format(beam))
+            convolved_file = os.path.join(self.mosaic_continuum_mosaic_dir, 'image_{0}_conv.npy'.format(beam))
+            if not os.path.isfile(convolved_file):
+                error = "Could not find the convolved continuum image for beam {0}".format(beam)
+                logger.error(error)
+                raise RuntimeError(error)
+            images[beam] = subs_linmos.ReprojectedImage(
+                np.load(convolved_file, mmap_mode='r'), subs_mirio.getwcs(subs_mirio.readheader(input_file)),
+                template_wcs, template_shape)
+        return images
+
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function to convolve polarisation images
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -2267,74 +2287,78 @@ class mosaic(BaseModule):
         if not mosaic_polarisation_convolve_images_status:
 
             # Calculate the common beam values for the Stokes Q images
-            for qplane in range(qimages):
-                for beam in self.mosaic_beam_list:
-                    logger.debug("Convolving Stokes Q image of beam {}".format(beam))
+            def convolve_q_image(task):
+                qplane, beam = task
+                logger.debug("Convolving Stokes Q image of beam {}".format(beam))
 
-                    # output map and input map
-                    input_file = os.path.join(
-                        self.mosaic_polarisation_images_subdir, "Qcube_" + str(beam).zfill(2) + '_' + str(qplane).zfill(3) + '_regrid.map')
-                    output_file = os.path.join(
-                        self.mosaic_polarisation_mosaic_subdir, "Qcube_" + str(beam).zfill(2) + '_' + str(qplane).zfill(3) + '_mos.map')
+                # output map and input map
+                input_file = os.path.join(
+                    self.mosaic_polarisation_images_subdir, "Qcube_" + str(beam).zfill(2) + '_' + str(qplane).zfill(3) + '_regrid.map')
+                output_file = os.path.join(
+                    self.mosaic_polarisation_mosaic_subdir, "Qcube_" + str(beam).zfill(2) + '_' + str(qplane).zfill(3) + '_mos.map')
 
-                    if not os.path.isdir(output_file):
-                        convol = lib.miriad('convol')
-                        convol.map = input_file
-                        convol.out = output_file
-                        convol.fwhm = '{0},{1}'.format(
-                            str(mosaic_polarisation_common_beam_values_qu[0, qplane, 0]), str(mosaic_polarisation_common_beam_values_qu[0, qplane, 1]))
-                        convol.pa = mosaic_polarisation_common_beam_values_qu[0, qplane, 2]
-                        convol.options = 'final'
-                        try:
-                            convol.go()
-                        except Exception as e:
-                            error = "Convolving Stokes Q image {0} of beam {1} ... Failed".format(
-                                qplane, beam)
-                            logger.error(error)
-                            logger.exception(e)
-                            raise RuntimeError(error)
-                        else:
-                            logger.debug("Convolving Stokes Q image {0} of beam {1} ... Done".format(qplane, beam))
+                if not os.path.isdir(output_file):
+                    convol = lib.miriad('convol')
+                    convol.map = input_file
+                    convol.out = output_file
+                    convol.fwhm = '{0},{1}'.format(
+                        str(mosaic_polarisation_common_beam_values_qu[0, qplane, 0]), str(mosaic_polarisation_common_beam_values_qu[0, qplane, 1]))
+                    convol.pa = mosaic_polarisation_common_beam_values_qu[0, qplane, 2]
+                    convol.options = 'final'
+                    try:
+                        convol.go()
+                    except Exception as e:
+                        error = "Convolving Stokes Q image {0} of beam {1} ... Failed".format(
+                            qplane, beam)
+                        logger.error(error)
+                        logger.exception(e)
+                        raise RuntimeError(error)
                     else:
-                        logger.warning(
-                            "Convolved Stokes Q image {0} of beam {1} already exists".format(qplane, beam))
+                        logger.debug("Convolving Stokes Q image {0} of beam {1} ... Done".format(qplane, beam))
+                else:
+                    logger.warning(
+                        "Convolved Stokes Q image {0} of beam {1} already exists".format(qplane, beam))
 
-            # Calculate the common beam values for the Stokes Q images
-            for uplane in range(qimages):
-                for beam in self.mosaic_beam_list:
-                    logger.info("Convolving Stokes U image of beam {}".format(beam))
+            self.run_beam_tasks(convolve_q_image, [(qplane, beam) for qplane in range(qimages) for beam in self.mosaic_beam_list])
 
-                    # output map and input map
-                    input_file = os.path.join(
-                        self.mosaic_polarisation_images_subdir, "Ucube_" + str(beam).zfill(2) + '_' + str(uplane).zfill(3) + '_regrid.map')
-                    output_file = os.path.join(
-                        self.mosaic_polarisation_mosaic_subdir, "Ucube_" + str(beam).zfill(2) + '_' + str(uplane).zfill(3) + '_mos.map')
+            # Calculate the common beam values for the Stokes U images
+            def convolve_u_image(task):
+                uplane, beam = task
+                logger.info("Convolving Stokes U image of beam {}".format(beam))
 
-                    if not os.path.isdir(output_file):
-                        convol = lib.miriad('convol')
-                        convol.map = input_file
-                        convol.out = output_file
-                        convol.fwhm = '{0},{1}'.format(
-                            str(mosaic_polarisation_common_beam_values_qu[1, uplane, 0]),
-                            str(mosaic_polarisation_common_beam_values_qu[1, uplane, 1]))
-                        convol.pa = mosaic_polarisation_common_beam_values_qu[1, uplane, 2]
-                        convol.options = 'final'
-                        try:
-                            convol.go()
-                        except Exception as e:
-                            error = "Convolving Stokes U image {0} of beam {1} ... Failed".format(
-                                uplane, beam)
-                            logger.error(error)
-                            logger.exception(e)
-                            raise RuntimeError(error)
-                        else:
-                            logger.debug(
-                                "Convolving Stokes U image {0} of beam {1} ... Done".format(uplane, beam))
+                # output map and input map
+                input_file = os.path.join(
+                    self.mosaic_polarisation_images_subdir, "Ucube_" + str(beam).zfill(2) + '_' + str(uplane).zfill(3) + '_regrid.map')
+                output_file = os.path.join(
+                    self.mosaic_polarisation_mosaic_subdir, "Ucube_" + str(beam).zfill(2) + '_' + str(uplane).zfill(3) + '_mos.map')
+
+                if not os.path.isdir(output_file):
+                    convol = lib.miriad('convol')
+                    convol.map = input_file
+                    convol.out = output_file
+                    convol.fwhm = '{0},{1}'.format(
+                        str(mosaic_polarisation_common_beam_values_qu[1, uplane, 0]),
+                        str(mosaic_polarisation_common_beam_values_qu[1, uplane, 1]))
+                    convol.pa = mosaic_polarisation_common_beam_values_qu[1, uplane, 2]
+                    convol.options = 'final'
+                    try:
+                        convol.go()
+                    except Exception as e:
+                        error = "Convolving Stokes U image {0} of beam {1} ... Failed".format(
+                            uplane, beam)
+                        logger.error(error)
+                        logger.exception(e)
+                        raise RuntimeError(error)
                     else:
-                        logger.warning(
-                            "Convolved Stokes U image {0} of beam {1} already exists".format(uplane, beam))
+                        logger.debug(
+                            "Convolving Stokes U image {0} of beam {1} ... Done".format(uplane, beam))
+                else:
+                    logger.warning(
+                        "Convolved Stokes U image {0} of beam {1} already exists".format(uplane, beam))
 
-            for beam in self.mosaic_beam_list:
+            self.run_beam_tasks(convolve_u_image, [(uplane, beam) for uplane in range(qimages) for beam in self.mosaic_beam_list])
+
+            def convolve_v_image(beam):
                 logger.info("Convolving Stokes V image of beam {}".format(beam))
 
                 # output map and input map
@@ -2364,6 +2388,7 @@ class mosaic(BaseModule):
                 else:
                     logger.warning("Convolved Stokes V image of beam {} already exists".format(beam))
 
+            self.run_beam_tasks(convolve_v_image)
             mosaic_polarisation_convolve_images_status = True
 
             logger.info("Convolving polarisation images with common beam ... Done")
@@ -2393,6 +2418,9 @@ class mosaic(BaseModule):
         mosaic_continuum_inverse_covariance_matrix = get_param_def(
             self, 'mosaic_continuum_inverse_covariance_matrix', [])
 
+        mosaic_continuum_beam_noise = get_param_def(
+            self, 'mosaic_continuum_beam_noise', {})
+
         # change to directory of continuum images
         subs_managefiles.director(self, 'ch', self.mosaic_continuum_dir)
 
@@ -2413,7 +2441,14 @@ class mosaic(BaseModule):
         if mosaic_continuum_correlation_matrix_status:
             if len(mosaic_continuum_inverse_covariance_matrix) == 0:
                 logger.info("Calculating inverse continuum covariance matrix ...")
-                mosaic_continuum_inverse_covariance_matrix = mosaic_utils.inverted_covariance_matrix('images/{0}/image_{0}.map', correlation_matrix_file, self.NBEAMS, self.mosaic_beam_list)
+                missing_beams = [beam for beam in self.mosaic_beam_list if beam not in mosaic_continuum_beam_noise]
+                if len(missing_beams) != 0:
+                    logger.info("Estimating noise of continuum images")
+                    mosaic_continuum_beam_noise.update(mosaic_utils.get_beam_noise('images/{0}/image_{0}.map', missing_beams, nworkers=self.get_mosaic_nworkers()))
+                    for beam in missing_beams:
+                        logger.debug("Noise of continuum image of beam {0} is {1}".format(beam, mosaic_continuum_beam_noise[beam]))
+                    subs_param.add_param(self, 'mosaic_continuum_beam_noise', mosaic_continuum_beam_noise)
+                mosaic_continuum_inverse_covariance_matrix = mosaic_utils.inverted_covariance_matrix('images/{0}/image_{0}.map', correlation_matrix_file, self.NBEAMS, self.mosaic_beam_list, noise=mosaic_continuum_beam_noise)
                 logger.info("Calculating inverse continuum covariance matrix ... Done")
             else:
                 logger.info("Inverse of covariance matrix for continuum is available on disk already.")
@@ -2489,7 +2524,7 @@ class mosaic(BaseModule):
                     logger.info("Inverse of covariance matrix for polarisation Stokes Q image {} is available on disk already.".format(qplane))
                 else:
                     try:
-                        mosaic_polarisation_inverse_covariance_matrix_q[qplane] = mosaic_utils.inverted_covariance_matrix('images/{0}/Qcube_' + str(qplane).zfill(3), correlation_matrix_file, self.NBEAMS, self.mosaic_beam_list)
+                        mosaic_polarisation_inverse_covariance_matrix_q[qplane] = mosaic_utils.inverted_covariance_matrix('images/{0}/Qcube_' + str(qplane).zfill(3), correlation_matrix_file, self.NBEAMS, self.mosaic_beam_list, nworkers=self.get_mosaic_nworkers())
                     except:
                         logger.warning("Could not derive inverse covariance matrix for Stokes Q plane {}!".format(qplane))
                         continue
@@ -2501,7 +2536,7 @@ class mosaic(BaseModule):
                     logger.info("Inverse of covariance matrix for polarisation Stokes U image {} is available on disk already.".format(uplane))
                 else:
                     try:
-                        mosaic_polarisation_inverse_covariance_matrix_u[uplane] = mosaic_utils.inverted_covariance_matrix('images/{0}/Ucube_' + str(uplane).zfill(3), correlation_matrix_file, self.NBEAMS, self.mosaic_beam_list)
+                        mosaic_polarisation_inverse_covariance_matrix_u[uplane] = mosaic_utils.inverted_covariance_matrix('images/{0}/Ucube_' + str(uplane).zfill(3), correlation_matrix_file, self.NBEAMS, self.mosaic_beam_list, nworkers=self.get_mosaic_nworkers())
                     except:
                         logger.warning("Could not derive inverse covariance matrix for Stokes U plane {}!".format(uplane))
                         continue
@@ -2509,7 +2544,7 @@ class mosaic(BaseModule):
 
             if len(mosaic_polarisation_inverse_covariance_matrix_v) == 0:
                 logger.info("Calculating inverse polarisation covariance matrix for Stokes V images ...")
-                mosaic_polarisation_inverse_covariance_matrix_v = mosaic_utils.inverted_covariance_matrix('images/{0}/image_mf_V', correlation_matrix_file, self.NBEAMS, self.mosaic_beam_list)
+                mosaic_polarisation_inverse_covariance_matrix_v = mosaic_utils.inverted_covariance_matrix('images/{0}/image_mf_V', correlation_matrix_file, self.NBEAMS, self.mosaic_beam_list, nworkers=self.get_mosaic_nworkers())
                 logger.info("Calculating inverse polarisation covariance matrix for Stokes V images ... Done")
             else:
                 logger.info("Inverse of covariance matrix for polarisation Stokes V is available on disk already.")
@@ -2534,6 +2569,140 @@ class mosaic(BaseModule):
         subs_param.add_param(self, 'mosaic_polarisation_inverse_covariance_matrix_status', mosaic_polarisation_inverse_covariance_matrix_status)
 
 
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function to get the footprints of the continuum beam maps and images
+    # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
+
+    def get_continuum_footprints(self):
+        """
+        Function to get the footprints of the regridded continuum beam maps and images on the mosaic template
+
+        The footprint of a map is the bounding box of its valid pixels. They are determined once and stored in the
+        parameter file.
+
+        returns (tuple): Dictionaries with the footprints of the beam maps and the images for each beam
+        """
+
+        mosaic_continuum_beam_footprints = get_param_def(self, 'mosaic_continuum_beam_footprints', {})
+        mosaic_continuum_image_footprints = get_param_def(self, 'mosaic_continuum_image_footprints', {})
+
+        missing_beams = [beam for beam in self.mosaic_beam_list if beam not in mosaic_continuum_beam_footprints or
+                         beam not in mosaic_continuum_image_footprints]
+        if len(missing_beams) != 0:
+            logger.info("Determining footprints of continuum beam maps and images on the mosaic")
+            if self.mosaic_regrid_engine == 'python':
+                reprojected_images = self.get_continuum_reprojected_images()
+            for beam in missing_beams:
+                beam_map = os.path.join(self.mosaic_continuum_beam_dir, "beam_{0}_mos.map".format(beam))
+                image_map = os.path.join(self.mosaic_continuum_mosaic_dir, "image_{0}_mos.map".format(beam))
+                if not os.path.isdir(beam_map):
+                    error = "Could not find continuum mosaic beam map for beam {}".format(beam)
+                    logger.error(error)
+                    raise RuntimeError(error)
+                mosaic_continuum_beam_footprints[beam] = subs_linmos.footprint(beam_map)
+                if self.mosaic_regrid_engine == 'python':
+                    mosaic_continuum_image_footprints[beam] = reprojected_images[beam].footprint()
+                elif os.path.isdir(image_map):
+                    mosaic_continuum_image_footprints[beam] = subs_linmos.footprint(image_map)
+                else:
+                    mosaic_continuum_image_footprints[beam] = None
+                logger.debug("Beam {0}: footprint of beam map is {1}, footprint of image is {2}".format(
+                    beam, mosaic_continuum_beam_footprints[beam], mosaic_continuum_image_footprints[beam]))
+            logger.info("Determining footprints of continuum beam maps and images on the mosaic ... Done")
+
+            subs_param.add_param(self, 'mosaic_continuum_beam_footprints', mosaic_continuum_beam_footprints)
+            subs_param.add_param(self, 'mosaic_continuum_image_footprints', mosaic_continuum_image_footprints)
+
+        return mosaic_continuum_beam_footprints, mosaic_continuum_image_footprints
+
+    def get_continuum_beam_fingerprints(self, inv_cov):
+        """
+        Function to get a fingerprint of the contribution of each beam to the continuum mosaic
+
+        The fingerprint of a beam changes if its image, its beam map, the common beam, its coefficients in the inverse
+        covariance matrix or the mosaic template change. With mosaic_use_askap_based_matrix the inverse covariance
+        matrix is dense, so a changed noise of one beam changes the coefficients of all beams and the whole mosaic is
+        recomputed. Only changes which keep the noise of all beams, e.g. a new beam map, give a partial update then.
+
+        Args:
+            inv_cov (numpy array): Inverse covariance matrix of all beams
+
+        returns (dict): Fingerprint of each beam
+        """
+
+        common_beam = get_param_def(self, 'mosaic_continuum_common_beam_values', np.zeros(3))
+        template_header = os.path.join(self.mosaic_continuum_mosaic_dir, 'mosaic_continuum_template.map', 'header')
+        template_hash = mosaic_utils.get_image_hash(template_header)
+
+        image_hashes = {}
+
+        def get_image_hash(beam):
+            fits_files = glob.glob(os.path.join(self.mosaic_continuum_images_dir, beam, "*.fits"))
+            fits_files.sort()
+            if len(fits_files) == 0:
+                error = "Did not find the continuum fits image of beam {}".format(beam)
+                logger.error(error)
+                raise RuntimeError(error)
+            image_hashes[beam] = mosaic_utils.get_image_hash(fits_files[0])
+
+        self.run_beam_tasks(get_image_hash)
+
+        fingerprints = {}
+        for beam in self.mosaic_beam_list:
+            beam_map_key = mosaic_utils.get_beam_map_key(beam, self.mosaic_primary_beam_type,
+                                                         self.mosaic_primary_beam_shape_files_location,
+                                                         self.mosaic_gaussian_beam_map_size,
+                                                         self.mosaic_gaussian_beam_map_cellsize,
+                                                         self.mosaic_gaussian_beam_map_fwhm_arcsec,
+                                                         self.mosaic_beam_map_cutoff)
+            coefficients = [(b, float(inv_cov[int(b), int(beam)])) for b in self.mosaic_beam_list
+                            if inv_cov[int(b), int(beam)] != 0.]
+            components = (image_hashes[beam], beam_map_key, [float(x) for x in common_beam], coefficients,
+                          template_hash, self.mosaic_regrid_engine)
+            fingerprints[beam] = hashlib.sha1(repr(components).encode('ascii')).hexdigest()
+
+        return fingerprints
+
+    def get_continuum_update_regions(self, fingerprints, beam_footprints, image_footprints):
+        """
+        Function to get the regions of the continuum mosaic affected by beams which were added, removed or changed
+        since the mosaic was calculated
+
+        Args:
+            fingerprints (dict): Current fingerprint of each beam
+            beam_footprints (dict): Current footprint of the beam map of each beam
+            image_footprints (dict): Current footprint of the image of each beam
+
+        returns (list): Footprints of the changed beams before and after the change, None if the whole mosaic has to
+            be calculated
+        """
+
+        mosaic_continuum_beam_fingerprints = get_param_def(self, 'mosaic_continuum_beam_fingerprints', {})
+
+        variance_map = os.path.join(self.mosaic_continuum_mosaic_dir, 'variance_mos.map')
+        mosaic_map = os.path.join(self.mosaic_continuum_mosaic_dir, 'mosaic_im.map')
+        if len(mosaic_continuum_beam_fingerprints) == 0 or not os.path.isdir(variance_map) or not os.path.isdir(mosaic_map):
+            logger.info("No previous continuum mosaic available to update")
+            return None
+
+        changed_beams = []
+        regions = []
+        for beam in sorted(set(mosaic_continuum_beam_fingerprints) | set(self.mosaic_beam_list)):
+            previous = mosaic_continuum_beam_fingerprints.get(beam)
+            if previous is not None and beam in fingerprints and previous[0] == fingerprints[beam]:
+                continue
+            changed_beams.append(beam)
+            # the contribution of the beam has to be removed from where it was and added where it is now
+            if previous is not None:
+                regions.extend(previous[1:])
+            if beam in fingerprints:
+                regions.extend([beam_footprints[beam], image_footprints[beam]])
+
+        if len(changed_beams) != 0:
+            logger.info("Contributions of beams {} to the continuum mosaic have changed".format(", ".join(changed_beams)))
+
+        return regions
+
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function to calculate the product of continuum beam matrix and continuum covariance matrix
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -2561,65 +2730,73 @@ class mosaic(BaseModule):
         # important because previous step switched to a different dir
         subs_managefiles.director(self, 'ch', self.mosaic_continuum_dir)
 
-        if not mosaic_continuum_product_beam_covariance_matrix_status:
+        if not mosaic_continuum_product_beam_covariance_matrix_status and self.mosaic_math_engine == 'numpy':
+            # Calculate the variance map and the weighted image sum in one pass over the images
+            self.math_continuum_linear_mosaic(inv_cov)
+            logger.info(
+                "Multiplying continuum beam matrix by continuum covariance matrix ... Done")
+            mosaic_continuum_product_beam_covariance_matrix_status = True
+        elif not mosaic_continuum_product_beam_covariance_matrix_status:
             # First calculate transpose of beam matrix multiplied by the inverse covariance matrix
             # Will use *maths* in Miriad
 
             # Using "beams" list to account for missing beams/images
-            # Only doing math where inv_cov value is non-zero
+            # Only doing math where inv_cov value is non-zero and the beams overlap
+            # With mosaic_use_askap_based_matrix all values are non-zero and only the overlap check skips terms
+            beam_footprints, image_footprints = self.get_continuum_footprints()
+
             maths = lib.miriad('maths')
             for bm in self.mosaic_beam_list:
                 logger.debug("Processing beam {}".format(bm))
                 # This was not in the notebook.
                 # Are you it should be here ???? Yes, according to DJ
-                operate = ""
-                for b in self.mosaic_beam_list:
+                # since the beam list is made of strings, need to convert to integers
+                terms = [b for b in self.mosaic_beam_list if inv_cov[int(b), int(bm)] != 0. and (
+                    subs_linmos.overlaps(beam_footprints[b], beam_footprints[bm]) or
+                    subs_linmos.overlaps(beam_footprints[b], image_footprints[bm]))]
+                if len(terms) == 0:
+                    # keep an empty map for this beam
+                    terms = [bm]
+                logger.debug("Beam {0} is combined with {1} of {2} beams".format(
+                    bm, len(terms), len(self.mosaic_beam_list)))
+                for b in terms:
                     maths.out = os.path.join(
                         self.mosaic_continuum_mosaic_subdir, 'tmp_{}.map'.format(b))
-                    # since the beam list is made of strings, need to convert to integers
                     beam_map = os.path.join(
                         self.mosaic_continuum_beam_subdir, "beam_{0}_mos.map".format(b))
-                    if os.path.isdir(beam_map):
-                        if inv_cov[int(b), int(bm)] != 0.:
-                            operate = "'<{0}>*({1})'".format(beam_map, inv_cov[int(b), int(bm)])
-                        else:
-                            operate = "'<{0}>*(0)'".format(beam_map)
-                        logger.debug("for beam combination {0},{1}: operate = {2}".format(bm, b, operate))
-                        maths.exp = operate
-                        maths.options = 'unmask'
-                        maths.go()
-                    else:
-                        error = "Could not find continuum mosaic beam map for beam {}".format(b)
-                        logger.error(error)
-                        raise RuntimeError(error)
+                    operate = "'<{0}>*({1})'".format(beam_map, inv_cov[int(b), int(bm)])
+                    logger.debug("for beam combination {0},{1}: operate = {2}".format(bm, b, operate))
+                    maths.exp = operate
+                    maths.options = 'unmask'
+                    maths.go()
                 i = 1
-                while i < len(self.mosaic_beam_list):
-                    if os.path.isdir(os.path.join(self.mosaic_continuum_mosaic_subdir, "tmp_{}.map".format(self.mosaic_beam_list[i-1]))) and os.path.isdir(os.path.join(self.mosaic_continuum_mosaic_subdir, "tmp_{}.map".format(self.mosaic_beam_list[i]))):
+                while i < len(terms):
+                    if os.path.isdir(os.path.join(self.mosaic_continuum_mosaic_subdir, "tmp_{}.map".format(terms[i-1]))) and os.path.isdir(os.path.join(self.mosaic_continuum_mosaic_subdir, "tmp_{}.map".format(terms[i]))):
                         if i == 1:
                             operate = "'<" + self.mosaic_continuum_mosaic_subdir + "/tmp_{}.map>+<".format(str(
-                                self.mosaic_beam_list[i-1]))+self.mosaic_continuum_mosaic_subdir + "/tmp_{}.map>'".format(str(self.mosaic_beam_list[i]))
+                                terms[i-1]))+self.mosaic_continuum_mosaic_subdir + "/tmp_{}.map>'".format(str(terms[i]))
                         else:
                             operate = "'<" + self.mosaic_continuum_mosaic_subdir + "/tmp_{}.map>".format(str(
-                                self.mosaic_beam_list[i])) + "+<" + self.mosaic_continuum_mosaic_subdir + "/sum_{}.map>'".format(str(self.mosaic_beam_list[i-1]))
+                                terms[i])) + "+<" + self.mosaic_continuum_mosaic_subdir + "/sum_{}.map>'".format(str(terms[i-1]))
                         maths.out = self.mosaic_continuum_mosaic_subdir + \
-                            '/sum_{}.map'.format(str(self.mosaic_beam_list[i]))
+                            '/sum_{}.map'.format(str(terms[i]))
                         maths.exp = operate
                         maths.options = 'unmask'
                         maths.go()
                     else:
                         error = "Could not find temporary continuum maps for beam {0} or beam {1}".format(
-                            self.mosaic_beam_list[i-1], self.mosaic_beam_list[i])
+                            terms[i-1], terms[i])
                         logger.error(error)
                         raise RuntimeError(error)
                     i += 1
 
-                if os.path.isdir(os.path.join(self.mosaic_continuum_mosaic_subdir, 'sum_{}.map'.format(self.mosaic_beam_list[i-1]))):
+                # a single term does not need to be summed
+                result_map = 'sum_{}.map' if len(terms) > 1 else 'tmp_{}.map'
+                if os.path.isdir(os.path.join(self.mosaic_continuum_mosaic_subdir, result_map.format(terms[-1]))):
                     subs_managefiles.director(self, 'rn', self.mosaic_continuum_mosaic_subdir + '/btci_{}.map'.format(
-                        bm), file_=self.mosaic_continuum_mosaic_subdir + '/sum_{}.map'.format(str(self.mosaic_beam_list[i-1])))
-                    # os.rename(,self.mosaic_continuum_mosaic_subdir+'/btci_{}.map'.format(bm))
+                        bm), file_=os.path.join(self.mosaic_continuum_mosaic_subdir, result_map.format(terms[-1])))
                 else:
-                    error = "Could not find temporary continuum sum map for beam {}".format(
-                        self.mosaic_beam_list[i-1])
+                    error = "Could not find temporary continuum sum map for beam {}".format(terms[-1])
                     logger.error(error)
                     raise RuntimeError(error)
 
@@ -2640,6 +2817,182 @@ class mosaic(BaseModule):
         subs_param.add_param(
             self, 'mosaic_continuum_product_beam_covariance_matrix_status', mosaic_continuum_product_beam_covariance_matrix_status)
 
+    def math_continuum_linear_mosaic(self, inv_cov):
+        """
+        Function to calculate the continuum variance map and the product of beam matrix, covariance matrix and image
+        in memory instead of using maths
+
+        Writes variance_mos.map and mosaic_im.map and sets the status of the corresponding maths steps
+        """
+
+        logger.info("Calculating continuum variance map and weighted image sum in memory")
+
+        if self.mosaic_regrid_engine == 'python':
+            reprojected_images = self.get_continuum_reprojected_images()
+
+        beam_maps = []
+        image_maps = []
+        for beam in self.mosaic_beam_list:
+            beam_map = os.path.join(self.mosaic_continuum_beam_subdir, "beam_{0}_mos.map".format(beam))
+            image_map = os.path.join(self.mosaic_continuum_mosaic_subdir, "image_{0}_mos.map".format(beam))
+            if self.mosaic_regrid_engine == 'python':
+                # the images are reprojected while combining them
+                image_map = reprojected_images[beam]
+            elif not os.path.isdir(image_map):
+                image_map = None
+            if not os.path.isdir(beam_map) or image_map is None:
+                error = "Could not find the continuum maps for beam {0}".format(beam)
+                logger.error(error)
+                raise RuntimeError(error)
+            beam_maps.append(beam_map)
+            image_maps.append(image_map)
+
+        # since the beam list is made of strings, need to convert to integers
+        beam_index = [int(beam) for beam in self.mosaic_beam_list]
+        variance_map = os.path.join(self.mosaic_continuum_mosaic_subdir, 'variance_mos.map')
+        mosaic_map = os.path.join(self.mosaic_continuum_mosaic_subdir, 'mosaic_im.map')
+        beam_footprints, image_footprints = self.get_continuum_footprints()
+
+        # only update the parts of an existing mosaic to which changed beams contribute
+        regions = None
+        if self.mosaic_continuum_incremental:
+            if np.all(np.asarray(inv_cov)[np.ix_(beam_index, beam_index)] != 0.):
+                logger.info("The inverse covariance matrix is dense, a changed noise of any beam updates the whole "
+                            "continuum mosaic")
+            fingerprints = self.get_continuum_beam_fingerprints(np.asarray(inv_cov))
+            regions = self.get_continuum_update_regions(fingerprints, beam_footprints, image_footprints)
+        if regions is None:
+            for fl in [variance_map, mosaic_map]:
+                subs_managefiles.director(self, 'rm', fl, ignore_nonexistent=True)
+        elif len(regions) == 0:
+            logger.info("Continuum variance map and weighted image sum are up to date")
+
+        try:
+            if regions is None or len(regions) != 0:
+                subs_linmos.combine(beam_maps, image_maps, np.asarray(inv_cov)[np.ix_(beam_index, beam_index)],
+                                    variance_map, mosaic_map, tile_rows=self.mosaic_math_tile_rows,
+                                    beam_footprints=[beam_footprints[beam] for beam in self.mosaic_beam_list],
+                                    image_footprints=[image_footprints[beam] for beam in self.mosaic_beam_list],
+                                    regions=regions)
+            if self.mosaic_regrid_engine == 'python':
+                # the header was taken from a beam map, set the unit and beam of the convolved images
+                common_beam = get_param_def(self, 'mosaic_continuum_common_beam_values', np.zeros(3))
+                subs_mirio.writeheader(mosaic_map, {'bunit': 'JY/BEAM',
+                                                    'bmaj': float(np.radians(common_beam[0] / 3600.)),
+                                                    'bmin': float(np.radians(common_beam[1] / 3600.)),
+                                                    'bpa': float(common_beam[2])})
+        except Exception as e:
+            error = "Calculating continuum variance map and weighted image sum ... Failed"
+            logger.error(error)
+            logger.exception(e)
+            raise RuntimeError(error)
+
+        logger.info("Calculating continuum variance map and weighted image sum in memory ... Done")
+
+        if self.mosaic_continuum_incremental:
+            # store what the mosaic was calculated from to be able to update it later
+            mosaic_continuum_beam_fingerprints = dict(
+                (beam, (fingerprints[beam], beam_footprints[beam], image_footprints[beam]))
+                for beam in self.mosaic_beam_list)
+            subs_param.add_param(self, 'mosaic_continuum_beam_fingerprints', mosaic_continuum_beam_fingerprints)
+
+        subs_param.add_param(self, 'mosaic_continuum_variance_map_status', True)
+        subs_param.add_param(self, 'mosaic_continuum_product_beam_covariance_matrix_image_status', True)
+
+    def math_polarisation_linear_mosaic(self, stokes, inv_cov, nplanes=None):
+        """
+        Function to calculate the polarisation variance maps and the products of beam matrix, covariance matrix and
+        image in memory instead of using maths
+
+        The planes of the Stokes Q and U cubes are combined one after the other and in parallel if mosaic_parallelisation
+        is enabled. Every plane is written to a temporary map first, so planes which were finished before an interrupted
+        run are not combined again. Writes variance_<stokes>_<plane>_mos.map and mosaic_<stokes>_<plane>_im.map
+        (variance_V_mos.map and mosaic_V_im.map for Stokes V) and sets the status of the corresponding maths steps
+
+        Args:
+            stokes (str): Stokes parameter, Q, U or V
+            inv_cov (list or numpy array): Inverse covariance matrices of all planes, single matrix for Stokes V
+            nplanes (int): Number of planes of the Stokes Q and U cubes
+        """
+
+        logger.info("Calculating Stokes {} variance maps and weighted image sums in memory".format(stokes))
+
+        beam_maps = []
+        for beam in self.mosaic_beam_list:
+            beam_map = os.path.join(self.mosaic_polarisation_beam_subdir, "beam_{0}_mos.map".format(beam))
+            if not os.path.isdir(beam_map):
+                error = "Could not find polarisation mosaic beam map for beam {0}".format(beam)
+                logger.error(error)
+                raise RuntimeError(error)
+            beam_maps.append(beam_map)
+
+        # the beam maps are the same for all planes
+        beam_footprints = [subs_linmos.footprint(beam_map) for beam_map in beam_maps]
+
+        # since the beam list is made of strings, need to convert to integers
+        beam_index = [int(beam) for beam in self.mosaic_beam_list]
+
+        def combine_plane(plane):
+            if stokes == 'V':
+                image_maps = [os.path.join(self.mosaic_polarisation_mosaic_subdir, "image_mf_V_{}_mos.map".format(beam))
+                              for beam in self.mosaic_beam_list]
+                variance_map = os.path.join(self.mosaic_polarisation_mosaic_subdir, 'variance_V_mos.map')
+                mosaic_map = os.path.join(self.mosaic_polarisation_mosaic_subdir, 'mosaic_V_im.map')
+                plane_inv_cov = inv_cov
+            else:
+                image_maps = [os.path.join(self.mosaic_polarisation_mosaic_subdir, "{0}cube_{1}_{2}_mos.map".format(
+                    stokes, str(beam).zfill(2), str(plane).zfill(3))) for beam in self.mosaic_beam_list]
+                variance_map = os.path.join(self.mosaic_polarisation_mosaic_subdir, 'variance_{0}_{1}_mos.map'.format(
+                    stokes, str(plane).zfill(3)))
+                mosaic_map = os.path.join(self.mosaic_polarisation_mosaic_subdir, 'mosaic_{0}_{1}_im.map'.format(
+                    stokes, str(plane).zfill(3)))
+                plane_inv_cov = inv_cov[plane]
+
+            if os.path.isdir(variance_map) and os.path.isdir(mosaic_map):
+                logger.debug("Stokes {0} image plane {1} has already been combined".format(stokes, plane))
+                return
+
+            for beam, image_map in zip(self.mosaic_beam_list, image_maps):
+                if not os.path.isdir(image_map):
+                    error = "Could not find the Stokes {0} image of beam {1} for image plane {2}".format(
+                        stokes, beam, plane)
+                    logger.error(error)
+                    raise RuntimeError(error)
+            if plane_inv_cov is None or len(plane_inv_cov) == 0:
+                error = "Stokes {0} inverse covariance matrix of image plane {1} is not available".format(stokes, plane)
+                logger.error(error)
+                raise RuntimeError(error)
+
+            tmp_variance_map = variance_map.replace('.map', '_tmp.map')
+            tmp_mosaic_map = mosaic_map.replace('.map', '_tmp.map')
+            for fl in [tmp_variance_map, tmp_mosaic_map]:
+                subs_managefiles.director(self, 'rm', fl, ignore_nonexistent=True)
+            try:
+                subs_linmos.combine(beam_maps, image_maps, np.asarray(plane_inv_cov)[np.ix_(beam_index, beam_index)],
+                                    tmp_variance_map, tmp_mosaic_map, tile_rows=self.mosaic_math_tile_rows,
+                                    beam_footprints=beam_footprints)
+            except Exception as e:
+                error = "Combining Stokes {0} image plane {1} ... Failed".format(stokes, plane)
+                logger.error(error)
+                logger.exception(e)
+                raise RuntimeError(error)
+            for fl in [variance_map, mosaic_map]:
+                subs_managefiles.director(self, 'rm', fl, ignore_nonexistent=True)
+            os.rename(tmp_variance_map, variance_map)
+            os.rename(tmp_mosaic_map, mosaic_map)
+            logger.debug("Combining Stokes {0} image plane {1} ... Done".format(stokes, plane))
+
+        if stokes == 'V':
+            combine_plane(None)
+        else:
+            self.run_beam_tasks(combine_plane, range(nplanes))
+
+        logger.info("Calculating Stokes {} variance maps and weighted image sums in memory ... Done".format(stokes))
+
+        subs_param.add_param(self, 'mosaic_polarisation_variance_map_status_{}'.format(stokes.lower()), True)
+        subs_param.add_param(self, 'mosaic_polarisation_product_beam_covariance_matrix_image_status_{}'.format(
+            stokes.lower()), True)
+
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function to calculate the product of polarisation beam matrix and polarisation covariance matrix
     # ++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -2672,6 +3025,19 @@ class mosaic(BaseModule):
         # switch to mosaic directory
         subs_managefiles.director(self, 'ch', self.mosaic_polarisation_dir)
 
+        if self.mosaic_math_engine == 'numpy':
+            # Stream the planes of the cubes through the in-memory combiner, this also calculates the variance maps
+            # and the weighted image sums
+            if not mosaic_polarisation_product_beam_covariance_matrix_status_q:
+                self.math_polarisation_linear_mosaic('Q', inv_cov_q, qimages)
+                mosaic_polarisation_product_beam_covariance_matrix_status_q = True
+            if not mosaic_polarisation_product_beam_covariance_matrix_status_u:
+                self.math_polarisation_linear_mosaic('U', inv_cov_u, qimages)
+                mosaic_polarisation_product_beam_covariance_matrix_status_u = True
+            if not mosaic_polarisation_product_beam_covariance_matrix_status_v:
+                self.math_polarisation_linear_mosaic('V', inv_cov_v)
+                mosaic_polarisation_product_beam_covariance_matrix_status_v = True
+
         if not mosaic_polarisation_product_beam_covariance_matrix_status_q:
             # First calculate transpose of beam matrix multiplied by the inverse covariance matrix
             # Will use *maths* in Miriad
@@ -3581,6 +3947,13 @@ class mosaic(BaseModule):
                 logger.exception(e)
                 raise RuntimeError(error)
 
+            # the beam noise only enters the noise map through the covariance matrix, log it for reference
+            mosaic_continuum_beam_noise = get_param_def(self, 'mosaic_continuum_beam_noise', {})
+            if len(mosaic_continuum_beam_noise) != 0:
+                beam_noise = np.array(list(mosaic_continuum_beam_noise.values()), dtype=np.float64)
+                logger.debug("Noise of the continuum images of the beams ranges from {0:.3e} to {1:.3e} (median {2:.3e})".format(
+                    np.min(beam_noise), np.max(beam_noise), np.median(beam_noise)))
+
             logger.info("Getting continuum mosaic noise map ... Done")
             mosaic_continuum_get_mosaic_noise_map_status = True
         else:
@@ -3827,6 +4200,8 @@ class mosaic(BaseModule):
                     logger.error(error)
                     logger.exception(e)
                     raise RuntimeError(error)
+            if self.mosaic_math_engine == 'numpy':
+                self.write_polarisation_mosaic_cube('Q', qimages)
             mosaic_polarisation_write_mosaic_fits_files_status_q = True
         else:
             logger.info("Stokes Q mosaic images and noise maps have already been converted to fits")
@@ -3860,6 +4235,8 @@ class mosaic(BaseModule):
                     logger.error(error)
                     logger.exception(e)
                     raise RuntimeError(error)
+            if self.mosaic_math_engine == 'numpy':
+                self.write_polarisation_mosaic_cube('U', qimages)
             mosaic_polarisation_write_mosaic_fits_files_status_u = True
         else:
             logger.info("Stokes U mosaic images and noise maps have already been converted to fits")
@@ -3902,6 +4279,51 @@ class mosaic(BaseModule):
         subs_param.add_param(self, 'mosaic_polarisation_write_mosaic_fits_files_status_u', mosaic_polarisation_write_mosaic_fits_files_status_u)
         subs_param.add_param(self, 'mosaic_polarisation_write_mosaic_fits_files_status_v', mosaic_polarisation_write_mosaic_fits_files_status_v)
 
+    def write_polarisation_mosaic_cube(self, stokes, nplanes):
+        """
+        Function to combine the fits files of the mosaic planes into a Stokes Q or U mosaic cube and noise cube
+
+        The cubes are written plane by plane, so only a single plane is kept in memory
+
+        Args:
+            stokes (str): Stokes parameter, Q or U
+            nplanes (int): Number of planes
+        """
+
+        for suffix in ['', '_noise']:
+            plane_files = ["{0}_{1}_{2}_mosaic{3}.fits".format(self.mosaic_taskid, stokes, str(plane).zfill(3), suffix)
+                           for plane in range(nplanes)]
+            cube_name = "{0}_{1}_mosaic{2}.fits".format(self.mosaic_taskid, stokes, suffix)
+            logger.info("Writing Stokes {0} mosaic cube {1}".format(stokes, cube_name))
+
+            # frequency of the planes
+            headers = [pyfits.getheader(plane_file) for plane_file in plane_files]
+            freqs = np.array([hdr['CRVAL3'] + (1. - hdr['CRPIX3']) * hdr['CDELT3'] for hdr in headers])
+            header = headers[0].copy()
+            header['NAXIS3'] = nplanes
+            header['CRPIX3'] = 1.
+            header['CRVAL3'] = freqs[0]
+            if nplanes > 1:
+                header['CDELT3'] = freqs[1] - freqs[0]
+                if not np.allclose(np.diff(freqs), header['CDELT3']):
+                    logger.warning("Stokes {} mosaic planes are not equally spaced in frequency".format(stokes))
+            for key in ['DATAMIN', 'DATAMAX']:
+                header.remove(key, ignore_missing=True)
+
+            subs_managefiles.director(self, 'rm', cube_name, ignore_nonexistent=True)
+            try:
+                cube = pyfits.StreamingHDU(cube_name, header)
+                for plane_file in plane_files:
+                    cube.write(pyfits.getdata(plane_file).astype(np.float32))
+                cube.close()
+            except Exception as e:
+                error = "Writing Stokes {0} mosaic cube {1} ... Failed".format(stokes, cube_name)
+                logger.error(error)
+                logger.exception(e)
+                raise RuntimeError(error)
+
+        logger.info("Writing Stokes {} mosaic cubes ... Done".format(stokes))
+
 
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function to run validation tool
@@ -3968,8 +4390,9 @@ class mosaic(BaseModule):
         At the moment the function is only successful
         if all beams were successfully.
 
+        The beams are converted in parallel if mosaic_parallelisation is enabled.
+
         TODO:
-            Conversion should be parallelised.
             Could be moved to submodule taking care of creating beam maps
         """
 
@@ -3981,7 +4404,7 @@ class mosaic(BaseModule):
         # change to directory of continuum images
         subs_managefiles.director(self, 'ch', self.mosaic_continuum_beam_dir)
 
-        for beam in self.mosaic_beam_list:
+        def convert_beam(beam):
             # This function will import the FITS image of a beam into Miriad format, placing it in the mosaicdir
             fits = lib.miriad('fits')
             fits.op = 'xyin'
@@ -3990,28 +4413,86 @@ class mosaic(BaseModule):
             try:
                 fits.go()
             except Exception as e:
-                mosaic_continuum_convert_fits_beam_status = False
                 error = "Converting fits image of beam {} to miriad image ... Failed".format(
                     beam)
                 logger.error(error)
                 logger.exception(e)
                 raise RuntimeError(error)
             else:
-                mosaic_continuum_convert_fits_beam_status = True
                 logger.debug(
                     "Converting fits image of beam {} to miriad image ... Done".format(beam))
 
-        if mosaic_continuum_convert_fits_beam_status:
-            logger.info(
-                "Converting fits images to miriad images ... Successful")
-        else:
-            logger.warning(
-                "Converting fits images to miriad images ... Failed for at least one beam. Please check the log")
+        self.run_beam_tasks(convert_beam)
+        mosaic_continuum_convert_fits_beam_status = True
+
+        logger.info(
+            "Converting fits images to miriad images ... Successful")
 
         subs_param.add_param(
             self, 'mosaic_continuum_convert_fits_beam_status', mosaic_continuum_convert_fits_beam_status)
 
 
+    # +++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function to get the number of parallel workers
+    # +++++++++++++++++++++++++++++++++++++++++++++++++++
+    def get_mosaic_nworkers(self):
+        """
+        Function to get the number of beams processed at the same time
+
+        returns (int): mosaic_parallelisation_cpus or the number of available cpus if mosaic_parallelisation is
+            enabled, otherwise 1
+        """
+        if not self.mosaic_parallelisation:
+            return 1
+        if self.mosaic_parallelisation_cpus:
+            return int(self.mosaic_parallelisation_cpus)
+        return multiprocessing.cpu_count()
+
+    # +++++++++++++++++++++++++++++++++++++++++++++++++++
+    # Function to run independent tasks for each beam
+    # +++++++++++++++++++++++++++++++++++++++++++++++++++
+    def run_beam_tasks(self, function, tasks=None):
+        """
+        Function to run a function for each beam, in parallel if mosaic_parallelisation is enabled
+
+        The function runs MIRIAD tasks as separate processes, so a pool of threads is enough to run them concurrently.
+        The number of workers is limited by mosaic_parallelisation_cpus (all available cpus if not set). In parallel
+        mode, all tasks are finished before the failed ones are reported in the order of the tasks.
+
+        function (function): Function to call for each task
+        tasks (list): Arguments for the function, by default the list of beams
+        """
+        if tasks is None:
+            tasks = self.mosaic_beam_list
+
+        nworkers = min(self.get_mosaic_nworkers(), len(tasks))
+
+        if nworkers < 2:
+            for task in tasks:
+                function(task)
+            return
+
+        logger.debug("Running {0} tasks with {1} workers".format(len(tasks), nworkers))
+        pool = ThreadPool(nworkers)
+        try:
+            results = [pool.apply_async(function, (task,)) for task in tasks]
+            failed_tasks = []
+            for task, result in zip(tasks, results):
+                try:
+                    result.get()
+                except Exception as e:
+                    logger.error("Task for {0} failed: {1}".format(task, e))
+                    failed_tasks.append(task)
+        finally:
+            pool.close()
+            pool.join()
+
+        if len(failed_tasks) != 0:
+            error = "Failed {0} of {1} tasks: {2}".format(
+                len(failed_tasks), len(tasks), ", ".join(str(task) for task in failed_tasks))
+            logger.error(error)
+            raise RuntimeError(error)
+
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function to make the mosaic stop after a certain number of steps
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
@@ -4029,12 +4510,85 @@ class mosaic(BaseModule):
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
     # Function to create the continuum mosaic
     # +++++++++++++++++++++++++++++++++++++++++++++++++++
+    def prepare_continuum_mosaic_update(self):
+        """
+        Function to prepare updating the continuum mosaic for the beams in mosaic_continuum_update_beams
+
+        The products of these beams are removed and the steps of the mosaic are reset, so they are done again for
+        these beams. The steps skip the beams whose products still exist. With mosaic_continuum_incremental and the numpy
+        math engine, only the parts of the mosaic to which the changed beams contribute are calculated again.
+        """
+
+        update_beams = [str(beam).strip().zfill(2) for beam in str(self.mosaic_continuum_update_beams).split(",")]
+
+        logger.info("Preparing update of continuum mosaic for beams {}".format(", ".join(update_beams)))
+
+        if not self.mosaic_continuum_incremental:
+            logger.warning("Incremental mosaic updates are not enabled. The whole continuum mosaic will be calculated again")
+
+        # to be sure, set the paths
+        self.mosaic_setup()
+        self.set_mosaic_subdirs(continuum=True)
+
+        # remove the products of the beams
+        for beam in update_beams:
+            logger.debug("Removing continuum products of beam {}".format(beam))
+            local_beam_dir = os.path.join(self.mosaic_continuum_images_dir, beam)
+            # do not remove the fits images if they are taken directly from the image directory
+            if self.mosaic_continuum_image_origin in ["ALTA", "", None] or \
+                    os.path.realpath(local_beam_dir) != os.path.realpath(os.path.join(self.mosaic_continuum_image_origin, beam, self.contsubdir)):
+                for fl in glob.glob(os.path.join(local_beam_dir, "*.fits")):
+                    subs_managefiles.director(self, 'rm', fl, ignore_nonexistent=True)
+            for fl in [os.path.join(local_beam_dir, 'image_{}.map'.format(beam)),
+                       os.path.join(self.mosaic_continuum_images_dir, 'image_{}_regrid.map'.format(beam)),
+                       os.path.join(self.mosaic_continuum_mosaic_dir, 'image_{}_mos.map'.format(beam)),
+                       os.path.join(self.mosaic_continuum_mosaic_dir, 'image_{}_conv.npy'.format(beam))]:
+                subs_managefiles.director(self, 'rm', fl, ignore_nonexistent=True)
+
+        # remove the derived information of the beams
+        mosaic_continuum_failed_beams = get_param_def(self, 'mosaic_continuum_failed_beams', [])
+        subs_param.add_param(self, 'mosaic_continuum_failed_beams',
+                             [beam for beam in mosaic_continuum_failed_beams if beam not in update_beams])
+        for param in ['mosaic_continuum_beam_noise', 'mosaic_continuum_beam_footprints',
+                      'mosaic_continuum_image_footprints']:
+            values = get_param_def(self, param, {})
+            subs_param.add_param(self, param, dict((beam, value) for beam, value in values.items()
+                                                   if beam not in update_beams))
+
+        # reset the steps which depend on the images
+        for param in ['mosaic_continuum_images_status',
+                      'mosaic_continuum_beam_status',
+                      'mosaic_continuum_convert_fits_images_status',
+                      'mosaic_continuum_transfer_coordinates_to_beam_status',
+                      'mosaic_continuum_regrid_images_status',
+                      'mosaic_continuum_regrid_beam_maps_status',
+                      'mosaic_continuum_common_beam_status',
+                      'mosaic_continuum_convolve_images_status',
+                      'mosaic_continuum_inverse_covariance_matrix',
+                      'mosaic_continuum_product_beam_covariance_matrix_status',
+                      'mosaic_continuum_variance_map_status',
+                      'mosaic_continuum_product_beam_covariance_matrix_image_status',
+                      'mosaic_continuum_get_max_variance_status',
+                      'mosaic_continuum_max_variance',
+                      'mosaic_continuum_divide_image_variance_status',
+                      'mosaic_continuum_get_mosaic_noise_map_status',
+                      'mosaic_continuum_write_mosaic_fits_files_status',
+                      'mosaic_continuum_run_image_validation_status',
+                      'mosaic_continuum_mf_status']:
+            subs_param.del_param(self, param)
+
+        logger.info("Preparing update of continuum mosaic ... Done")
+
     def create_mosaic_continuum_mf(self):
         """
         Function to create the continuum mosaic
         """
         # subs_setinit.setinitdirs(self)
 
+        # beams were added or reprocessed since the mosaic was created
+        if self.mosaic_continuum_mf and self.mosaic_continuum_update_beams:
+            self.prepare_continuum_mosaic_update()
+
         mosaic_continuum_mf_status = get_param_def(
             self, 'mosaic_continuum_mf_status', False)
 
@@ -4718,8 +5272,18 @@ class mosaic(BaseModule):
         for fl in glob.glob('*_regrid.map'):
             subs_managefiles.director(self, 'rm', fl, ignore_nonexistent=True)
 
-        subs_managefiles.director(
-            self, 'rm', 'mosaic_im.map', ignore_nonexistent=True)
+        # incremental updates need the weighted image sum and the products of all beams
+        if self.mosaic_continuum_incremental:
+            if level:
+                logger.warning(
+                    "Ignoring clean up level {} in incremental mode to keep the products needed to update the "
+                    "continuum mosaic".format(level))
+            else:
+                logger.info("Keeping the products needed to update the continuum mosaic")
+            level = 0
+        else:
+            subs_managefiles.director(
+                self, 'rm', 'mosaic_im.map', ignore_nonexistent=True)
 
         # shutil.rmtree(mosaicdir+'mosaic_im.map')
 
@@ -4762,6 +5326,9 @@ class mosaic(BaseModule):
             for fl in glob.glob('image_*_mos.map'):
                 subs_managefiles.director(
                     self, 'rm', fl, ignore_nonexistent=True)
+            for fl in glob.glob('image_*_conv.npy'):
+                subs_managefiles.director(
+                    self, 'rm', fl, ignore_nonexistent=True)
 
         logger.info("Removing scratch files ... Done")
 
@@ -4894,8 +5461,14 @@ class mosaic(BaseModule):
             subs_param.del_param(self, 'mosaic_continuum_convolve_images_status')
             subs_param.del_param(self, 'mosaic_polarisation_convolve_images_status')
 
+            subs_param.del_param(self, 'mosaic_continuum_convolved_beam_values')
+            subs_param.del_param(self, 'mosaic_continuum_beam_footprints')
+            subs_param.del_param(self, 'mosaic_continuum_image_footprints')
+            subs_param.del_param(self, 'mosaic_continuum_beam_fingerprints')
+
             subs_param.del_param(self, 'mosaic_continuum_correlation_matrix_status')
             subs_param.del_param(self, 'mosaic_continuum_inverse_covariance_matrix')
+            subs_param.del_param(self, 'mosaic_continuum_beam_noise')
             subs_param.del_param(self, 'mosaic_polarisation_correlation_matrix_status')
             subs_param.del_param(self, 'mosaic_polarisation_inverse_covariance_matrix_q')
             subs_param.del_param(self, 'mosaic_polarisation_inverse_covariance_matrix_u')
@@ -4,6 +4,8 @@ import numpy as np
 import pandas as pd
 import json
 import os
+from collections import OrderedDict
+from contextlib import contextmanager
 from os import path
 from time import time
 
@@ -14,6 +16,7 @@ from apercal.subs import setinit as subs_setinit
 from apercal.subs.msutils import get_nchan
 from apercal.subs import managefiles as subs_managefiles
 from apercal.subs import param as subs_param
+from apercal.subs import msflag
 from apercal.subs.param import get_param_def
 from apercal.subs.bandpass import create_bandpass
 from apercal.ao_strategies import ao_strategies
@@ -47,6 +50,9 @@ class preflag(BaseModule):
     preflag_shadow = None
     preflag_edges = None
     preflag_ghosts = None
+    preflag_flagplan = None
+    preflag_flagengine = 'casa'
+    preflag_flagengine_chunksize = 10000
     preflag_manualflag = None
     preflag_manualflag_fluxcal = None
     preflag_manualflag_polcal = None
@@ -79,6 +85,8 @@ class preflag(BaseModule):
     def __init__(self, filename=None, **kwargs):
         self.default = lib.load_config(self, filename)
         subs_setinit.setinitdirs(self)
+        self.flagplan = None
+        self.flagplanparams = None
 
     def go(self):
         """
@@ -115,20 +123,10 @@ class preflag(BaseModule):
             logger.debug('Beam ' + self.beam + ': All visibilities     flagged after aoflag: ' + str(query_result[0]["all_flagged"]))
             logger.debug('Beam ' + self.beam + ': All visibilities not flagged after aoflag: ' + str(query_result[0]["all_unflagged"]))
 
-        logger.info('Beam ' + self.beam + ': Running shadow for {0}'.format(self.target))
-        start_time = time()
-        self.shadow()
-        logger.info('Beam ' + self.beam + ': Running shadow for {0} ... Done ({1:.0f}s)'.format(self.target, time() - start_time))
-
-        logger.info('Beam ' + self.beam + ': Running edge for {0}'.format(self.target))
-        start_time = time()
-        self.edges()
-        logger.info('Beam ' + self.beam + ': Running edge for {0} ... Done ({1:.0f}s)'.format(self.target, time() - start_time))
-
-        logger.info('Beam ' + self.beam + ': Running ghosts for {0}'.format(self.target))
-        start_time = time()
-        self.ghosts()
-        logger.info('Beam ' + self.beam + ': Running ghosts for {0} ... Done ({1:.0f}s)'.format(self.target, time() - start_time))
+        with self.flag_plan():
+            self.run_flag_step('shadow', self.shadow)
+            self.run_flag_step('edge', self.edges)
+            self.run_flag_step('ghosts', self.ghosts)
 
         logger.info('Beam ' + self.beam + ': Pre-flagging step done')
 
@@ -140,6 +138,108 @@ class preflag(BaseModule):
             return path.join(os.getcwd(), 'Bpass.txt')
 
 
+    def run_flag_step(self, name, step):
+        """
+        Runs a flagging step and logs its duration. Inside a flag plan the step only collects its flag commands, which
+        are applied and timed when the plan ends.
+
+        name (str): Name of the step for the log
+        step (function): The flagging step
+        """
+        logger.info('Beam ' + self.beam + ': Running {0} for {1}'.format(name, self.target))
+        start_time = time()
+        step()
+        if self.flagplan is None:
+            logger.info('Beam ' + self.beam + ': Running {0} for {1} ... Done ({2:.0f}s)'.format(name, self.target, time() - start_time))
+        else:
+            logger.info('Beam ' + self.beam + ': Running {0} for {1} ... Flag commands collected'.format(name, self.target))
+
+    @staticmethod
+    def _flagdata_args(kwargs, sep):
+        """
+        Formats keyword arguments for flagdata, either as a call (sep=', ') or as a line for mode='list' (sep=' ')
+        """
+        args = []
+        for key, value in kwargs.items():
+            if isinstance(value, (bool, int, float)):
+                args.append('{0}={1}'.format(key, value))
+            else:
+                args.append("{0}='{1}'".format(key, value))
+        return sep.join(args)
+
+    def flagdata(self, vis, **kwargs):
+        """
+        Flag a dataset with the CASA task flagdata or the native flagger (see preflag_flagengine). Inside a flag plan
+        (see flag_plan) the command is only recorded and executed later together with all other commands for the same
+        dataset.
+
+        vis (str): Path to the measurement set
+        kwargs: Parameters for flagdata, e.g. mode='shadow' or spw='0:0;64'
+        """
+        if self.flagplan is not None:
+            self.flagplan.setdefault(vis, []).append(kwargs)
+        else:
+            self.execute_flag_plan({vis: [kwargs]})
+
+    def add_flag_param(self, parameter, values):
+        """
+        Stores the status of a flagging step in the parameter file. Inside a flag plan the status is only stored after
+        the flags of the plan have been applied successfully, so that a failed plan is repeated in the next run.
+
+        parameter (str): Name of the parameter
+        values (diverse): The value of the parameter
+        """
+        if self.flagplan is not None:
+            self.flagplanparams.append((parameter, values))
+        else:
+            subs_param.add_param(self, parameter, values)
+
+    @contextmanager
+    def flag_plan(self):
+        """
+        Collects all flagdata commands issued within the block and applies them with a single flagdata(mode='list')
+        call per dataset when the block ends, so that the flags of each dataset are only read and written once. The
+        statuses of the flagging steps are stored afterwards. If the block or the flagging fails, no status is stored.
+        Does nothing if preflag_flagplan is disabled or a flag plan is already active.
+        """
+        if not self.preflag_flagplan or self.flagplan is not None:
+            yield
+            return
+        self.flagplan, self.flagplanparams = OrderedDict(), []
+        try:
+            yield
+            plan, params = self.flagplan, self.flagplanparams
+        finally:
+            self.flagplan, self.flagplanparams = None, None
+        self.execute_flag_plan(plan, raise_on_severe=True)
+        with subs_param.param_batch(self):
+            for parameter, values in params:
+                subs_param.add_param(self, parameter, values)
+
+    def execute_flag_plan(self, plan, raise_on_severe=False):
+        """
+        Applies the flag commands of a flag plan, with one pass over the data for each dataset. With the native flag
+        engine the commands are applied with python-casacore and only commands it does not support are passed on to
+        CASA.
+
+        plan (dict): Lists of flag commands (dictionaries of flagdata parameters) for each measurement set
+        raise_on_severe (bool): Raise an exception if CASA fails instead of only logging the error
+        """
+        for vis, commands in plan.items():
+            logger.info('Beam ' + self.beam + ': Applying {0} flag command(s) to {1}'.format(len(commands), vis))
+            start_time = time()
+            if self.preflag_flagengine == 'native':
+                commands = msflag.apply_flag_commands(vis, commands, chunksize=self.preflag_flagengine_chunksize)
+            if len(commands) == 1:
+                lib.run_casa(['flagdata(vis="' + vis + '", ' + self._flagdata_args(commands[0], ', ') +
+                              ', flagbackup=False)'], raise_on_severe=raise_on_severe)
+            elif len(commands) > 1:
+                inpfile = [self._flagdata_args(command, ' ') for command in commands]
+                lib.run_casa(['flagdata(vis="{0}", mode="list", inpfile={1!r}, flagbackup=False)'.format(vis, inpfile)],
+                             raise_on_severe=raise_on_severe)
+            logger.info('Beam ' + self.beam + ': Applying flag command(s) to {0} ... Done ({1:.0f}s)'.format(
+                vis, time() - start_time))
+
     def shadow(self):
         """
         Flag all data sets for shadowed antennas using drivecasa and the CASA task flagdata
@@ -171,8 +271,7 @@ class preflag(BaseModule):
             else:
                 if self.fluxcal != '' and os.path.isdir(self.get_fluxcal_path()):
                     logger.debug('Beam ' + self.beam + ': Flagging shadowed antennas for flux calibrator')
-                    fc_shadow = 'flagdata(vis="' + self.get_fluxcal_path() + '", mode="shadow", flagbackup=False)'
-                    lib.run_casa([fc_shadow])
+                    self.flagdata(self.get_fluxcal_path(), mode='shadow')
                     preflagfluxcalshadow = True
                 else:
                     logger.warning('Beam ' + self.beam + ': Flux calibrator dataset not available or dataset not specified. Not flagging '
@@ -184,8 +283,7 @@ class preflag(BaseModule):
             else:
                 if self.polcal != '' and os.path.isdir(self.get_polcal_path()):
                     logger.debug('Beam ' + self.beam + ': Flagging shadowed antennas for polarised calibrator')
-                    pc_shadow = 'flagdata(vis="' + self.get_polcal_path() + '", mode="shadow", flagbackup=False)'
-                    lib.run_casa([pc_shadow])
+                    self.flagdata(self.get_polcal_path(), mode='shadow')
                     preflagpolcalshadow = True
                 else:
                     logger.warning('Beam ' + self.beam + ': Polarised calibrator dataset not available or dataset not specified. Not '
@@ -197,8 +295,7 @@ class preflag(BaseModule):
             else:
                 if self.target !='' and os.path.isdir(self.get_target_path()):
                     logger.debug('Beam ' + self.beam + ': Flagging shadowed antennas for target')
-                    tg_shadow = 'flagdata(vis="' + self.get_target_path() + '", mode="shadow", flagbackup=False)'
-                    lib.run_casa([tg_shadow])
+                    self.flagdata(self.get_target_path(), mode='shadow')
                     preflagtargetbeamsshadow = True
                 else:
                     logger.warning('Beam ' + self.beam + ': Target dataset not available or dataset not specified. Not '
@@ -210,9 +307,9 @@ class preflag(BaseModule):
 
         # Save the derived parameters for the shadow flagging to the parameter file
 
-        subs_param.add_param(self, pbeam + '_fluxcal_shadow', preflagfluxcalshadow)
-        subs_param.add_param(self, pbeam + '_polcal_shadow', preflagpolcalshadow)
-        subs_param.add_param(self, pbeam + '_targetbeams_shadow', preflagtargetbeamsshadow)
+        self.add_flag_param(pbeam + '_fluxcal_shadow', preflagfluxcalshadow)
+        self.add_flag_param(pbeam + '_polcal_shadow', preflagpolcalshadow)
+        self.add_flag_param(pbeam + '_targetbeams_shadow', preflagtargetbeamsshadow)
 
 
     def edges(self):
@@ -256,8 +353,7 @@ class preflag(BaseModule):
                     #only flag subband 0
                     l = a
                     m = ';'.join(str(ch) for ch in l)
-                    fc_edges_flagcmd = 'flagdata(vis="' + self.get_fluxcal_path() + '", spw="0:' + m + '", flagbackup=False)'
-                    lib.run_casa([fc_edges_flagcmd])
+                    self.flagdata(self.get_fluxcal_path(), spw='0:' + m)
                     preflagfluxcaledges = True
                 else:
                     logger.warning('Beam ' + self.beam + ': No flux calibrator dataset specified. Subband edges of flux calibrator '
@@ -280,8 +376,7 @@ class preflag(BaseModule):
                     #only flag first channel
                     l = a
                     m = ';'.join(str(ch) for ch in l)
-                    pc_edges_flagcmd = 'flagdata(vis="' + self.get_polcal_path() + '", spw="0:' + m + '", flagbackup=False)'
-                    lib.run_casa([pc_edges_flagcmd])
+                    self.flagdata(self.get_polcal_path(), spw='0:' + m)
                     preflagpolcaledges = True
                 else:
                     logger.warning('Beam ' + self.beam + ': No polarised calibrator dataset specified. Subband edges of polarised '
@@ -302,8 +397,7 @@ class preflag(BaseModule):
                     #only flag first subband chan
                     l = a
                     m = ';'.join(str(ch) for ch in l)
-                    tg_edges_flagcmd = 'flagdata(vis="' + self.get_target_path() + '", spw="0:' + m + '", flagbackup=False)'
-                    lib.run_casa([tg_edges_flagcmd])
+                    self.flagdata(self.get_target_path(), spw='0:' + m)
                     preflagtargetbeamsedges = True
                 else:
                     logger.warning('Beam ' + self.beam + ': No target dataset specified. Subband edges of target dataset will not be flagged!')
@@ -314,9 +408,9 @@ class preflag(BaseModule):
 
         # Save the derived parameters for the subband edges flagging to the parameter file
 
-        subs_param.add_param(self, pbeam + '_fluxcal_edges', preflagfluxcaledges)
-        subs_param.add_param(self, pbeam + '_polcal_edges', preflagpolcaledges)
-        subs_param.add_param(self, pbeam + '_targetbeams_edges', preflagtargetbeamsedges)
+        self.add_flag_param(pbeam + '_fluxcal_edges', preflagfluxcaledges)
+        self.add_flag_param(pbeam + '_polcal_edges', preflagpolcaledges)
+        self.add_flag_param(pbeam + '_targetbeams_edges', preflagtargetbeamsedges)
 
     def ghosts(self):
         """
@@ -355,8 +449,7 @@ class preflag(BaseModule):
                     b = range(48, nchannel, 64)
                     l = a + b
                     m = ';'.join(str(ch) for ch in l)
-                    fc_ghosts_flagcmd = 'flagdata(vis="' + self.get_fluxcal_path() + '", spw="0:' + m + '", flagbackup=False)'
-                    lib.run_casa([fc_ghosts_flagcmd])
+                    self.flagdata(self.get_fluxcal_path(), spw='0:' + m)
                     preflagfluxcalghosts = True
                 else:
                     logger.warning('Beam ' + self.beam + ': No flux calibrator dataset specified. Ghosts in flux calibrator dataset '
@@ -376,8 +469,7 @@ class preflag(BaseModule):
                     b = range(48, nchannel, 64)
                     l = a + b
                     m = ';'.join(str(ch) for ch in l)
-                    pc_ghosts_flagcmd = 'flagdata(vis="' + self.get_polcal_path() + '", spw="0:' + m + '", flagbackup=False)'
-                    lib.run_casa([pc_ghosts_flagcmd])
+                    self.flagdata(self.get_polcal_path(), spw='0:' + m)
                     preflagpolcalghosts = True
                 else:
                     logger.warning('Beam ' + self.beam + ': No polarised calibrator dataset specified. Ghosts in polarised calibrator '
@@ -396,8 +488,7 @@ class preflag(BaseModule):
                     b = range(48, nchannel, 64)
                     l = a + b
                     m = ';'.join(str(ch) for ch in l)
-                    tg_ghosts_flagcmd = 'flagdata(vis="' + self.get_target_path() + '", spw="0:' + m + '", flagbackup=False)'
-                    lib.run_casa([tg_ghosts_flagcmd])
+                    self.flagdata(self.get_target_path(), spw='0:' + m)
                     preflagtargetbeamsghosts = True
                 else:
                     logger.warning('Beam ' + self.beam + ': No target dataset specified. Ghosts in target dataset will not be flagged!')
@@ -408,9 +499,9 @@ class preflag(BaseModule):
 
         # Save the derived parameters for the subband edges flagging to the parameter file
 
-        subs_param.add_param(self, pbeam + '_fluxcal_ghosts', preflagfluxcalghosts)
-        subs_param.add_param(self, pbeam + '_polcal_ghosts', preflagpolcalghosts)
-        subs_param.add_param(self, pbeam + '_targetbeams_ghosts', preflagtargetbeamsghosts)
+        self.add_flag_param(pbeam + '_fluxcal_ghosts', preflagfluxcalghosts)
+        self.add_flag_param(pbeam + '_polcal_ghosts', preflagpolcalghosts)
+        self.add_flag_param(pbeam + '_targetbeams_ghosts', preflagtargetbeamsghosts)
 
 
     def manualflag(self):
@@ -420,14 +511,15 @@ class preflag(BaseModule):
         """
         if self.preflag_manualflag:
             logger.info('Beam ' + self.beam + ': Manual flagging step started')
-            self.manualflag_auto()
-            self.manualflag_from_file()
-            self.manualflag_antenna()
-            self.manualflag_corr()
-            self.manualflag_baseline()
-            self.manualflag_channel()
-            self.manualflag_time()
-            self.manualflag_clipzeros()
+            with self.flag_plan():
+                self.manualflag_auto()
+                self.manualflag_from_file()
+                self.manualflag_antenna()
+                self.manualflag_corr()
+                self.manualflag_baseline()
+                self.manualflag_channel()
+                self.manualflag_time()
+                self.manualflag_clipzeros()
             logger.info('Beam ' + self.beam + ': Manual flagging step done')
 
 
@@ -485,8 +577,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Auto-correlations for flux calibrator were already flagged')
             else:
                 if self.preflag_manualflag_fluxcal and os.path.isdir(self.get_fluxcal_path()) and self.fluxcal != '':
-                    fc_auto = 'flagdata(vis="' + self.get_fluxcal_path() + '", autocorr=True, flagbackup=False)'
-                    lib.run_casa([fc_auto])
+                    self.flagdata(self.get_fluxcal_path(), autocorr=True)
                     logger.debug('Beam ' + self.beam + ': Flagged auto-correlations for flux calibrator')
                     preflagfluxcalmanualflagauto = True
                 else:
@@ -498,8 +589,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Auto-correlations for polarised calibrator were already flagged')
             else:
                 if self.preflag_manualflag_polcal and os.path.isdir(self.get_polcal_path()) and self.polcal != '':
-                    pc_auto = 'flagdata(vis="' + self.get_polcal_path() + '", autocorr=True, flagbackup=False)'
-                    lib.run_casa([pc_auto])
+                    self.flagdata(self.get_polcal_path(), autocorr=True)
                     logger.debug('Beam ' + self.beam + ': Flagged auto-correlations for polarised calibrator')
                     preflagpolcalmanualflagauto = True
                 else:
@@ -511,8 +601,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Auto-correlations for target beam dataset were already flagged')
             else:
                 if self.preflag_manualflag_target and os.path.isdir(self.get_target_path()):
-                    tg_auto = 'flagdata(vis="' + self.get_target_path() + '", autocorr=True, flagbackup=False)'
-                    lib.run_casa([tg_auto])
+                    self.flagdata(self.get_target_path(), autocorr=True)
                     logger.debug('Beam ' + self.beam + ': Flagging auto-correlations for target beam dataset')
                     preflagtargetbeamsmanualflagauto = True
                 else:
@@ -522,9 +611,9 @@ class preflag(BaseModule):
 
         # Save the derived parameters for the auto-correlation flagging to the parameter file
 
-        subs_param.add_param(self, pbeam + '_fluxcal_manualflag_auto', preflagfluxcalmanualflagauto)
-        subs_param.add_param(self, pbeam + '_polcal_manualflag_auto', preflagpolcalmanualflagauto)
-        subs_param.add_param(self, pbeam + '_targetbeams_manualflag_auto', preflagtargetbeamsmanualflagauto)
+        self.add_flag_param(pbeam + '_fluxcal_manualflag_auto', preflagfluxcalmanualflagauto)
+        self.add_flag_param(pbeam + '_polcal_manualflag_auto', preflagpolcalmanualflagauto)
+        self.add_flag_param(pbeam + '_targetbeams_manualflag_auto', preflagtargetbeamsmanualflagauto)
 
     def manualflag_from_file(self):
         """
@@ -686,8 +775,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Antenna(s) ' + self.preflag_manualflag_antenna + ' for flux calibrator were already flagged')
             else:
                 if self.preflag_manualflag_fluxcal and os.path.isdir(self.get_fluxcal_path()) and self.fluxcal != '':
-                    fc_ant = 'flagdata(vis="' + self.get_fluxcal_path() + '", antenna="' + self.preflag_manualflag_antenna + '", flagbackup=False)'
-                    lib.run_casa([fc_ant])
+                    self.flagdata(self.get_fluxcal_path(), antenna=self.preflag_manualflag_antenna)
                     logger.debug('Beam ' + self.beam + ': Flagged antenna(s) ' + self.preflag_manualflag_antenna + ' for flux calibrator')
                     spltant = self.preflag_manualflag_antenna.split(',')
                     for ant in spltant:
@@ -703,8 +791,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Antenna(s) ' + self.preflag_manualflag_antenna + ' for polarised calibrator were already flagged')
             else:
                 if self.preflag_manualflag_polcal and os.path.isdir(self.get_polcal_path()) and self.polcal != '':
-                    pc_ant = 'flagdata(vis="' + self.get_polcal_path() + '", antenna="' + self.preflag_manualflag_antenna + '", flagbackup=False)'
-                    lib.run_casa([pc_ant])
+                    self.flagdata(self.get_polcal_path(), antenna=self.preflag_manualflag_antenna)
                     logger.debug('Beam ' + self.beam + ': Flagged antenna(s) ' + self.preflag_manualflag_antenna + ' for polarised calibrator')
                     spltant = self.preflag_manualflag_antenna.split(',')
                     for ant in spltant:
@@ -720,8 +807,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Antenna(s) ' + self.preflag_manualflag_antenna + ' for target beam dataset were already flagged')
             else:
                 if self.preflag_manualflag_target and os.path.isdir(self.get_target_path()):
-                    tg_ant = 'flagdata(vis="' + self.get_target_path() + '", antenna="' + self.preflag_manualflag_antenna + '", flagbackup=False)'
-                    lib.run_casa([tg_ant])
+                    self.flagdata(self.get_target_path(), antenna=self.preflag_manualflag_antenna)
                     logger.debug('Beam ' + self.beam + ': Flagged antenna(s) ' + self.preflag_manualflag_antenna + ' for target')
                     spltant = self.preflag_manualflag_antenna.split(',')
                     for ant in spltant:
@@ -735,9 +821,9 @@ class preflag(BaseModule):
 
         # Save the derived parameters for the antenna flagging to the parameter file
 
-        subs_param.add_param(self, pbeam + '_fluxcal_manualflag_antenna', preflagfluxcalmanualflagantenna)
-        subs_param.add_param(self, pbeam + '_polcal_manualflag_antenna', preflagpolcalmanualflagantenna)
-        subs_param.add_param(self, pbeam + '_targetbeams_manualflag_antenna', preflagtargetbeamsmanualflagantenna)
+        self.add_flag_param(pbeam + '_fluxcal_manualflag_antenna', preflagfluxcalmanualflagantenna)
+        self.add_flag_param(pbeam + '_polcal_manualflag_antenna', preflagpolcalmanualflagantenna)
+        self.add_flag_param(pbeam + '_targetbeams_manualflag_antenna', preflagtargetbeamsmanualflagantenna)
 
 
     def manualflag_corr(self):
@@ -763,8 +849,7 @@ class preflag(BaseModule):
             else:
                 if self.preflag_manualflag_fluxcal and os.path.isdir(self.get_fluxcal_path()) and self.fluxcal != '':
                     subs_setinit.setinitdirs(self)
-                    fc_corr = 'flagdata(vis="' + self.get_fluxcal_path() + '", correlation="' + self.preflag_manualflag_corr + '", flagbackup=False)'
-                    lib.run_casa([fc_corr])
+                    self.flagdata(self.get_fluxcal_path(), correlation=self.preflag_manualflag_corr)
                     logger.debug('Beam ' + self.beam + ': Flagged correlation(s) ' + self.preflag_manualflag_corr + ' for flux calibrator')
                     spltcorr = self.preflag_manualflag_corr.split(',')
                     for corr in spltcorr:
@@ -781,8 +866,7 @@ class preflag(BaseModule):
             else:
                 if self.preflag_manualflag_polcal and os.path.isdir(self.get_polcal_path()) and self.polcal != '':
                     subs_setinit.setinitdirs(self)
-                    pc_corr = 'flagdata(vis="' + self.get_polcal_path() + '", correlation="' + self.preflag_manualflag_corr + '", flagbackup=False)'
-                    lib.run_casa([pc_corr])
+                    self.flagdata(self.get_polcal_path(), correlation=self.preflag_manualflag_corr)
                     logger.debug('Beam ' + self.beam + ': Flagged correlation(s) ' + self.preflag_manualflag_corr + ' for polarised calibrator')
                     spltcorr = self.preflag_manualflag_corr.split(',')
                     for corr in spltcorr:
@@ -799,8 +883,7 @@ class preflag(BaseModule):
             else:
                 if self.preflag_manualflag_target and os.path.isdir(self.get_target_path()):
                     subs_setinit.setinitdirs(self)
-                    tg_corr = 'flagdata(vis="' + self.get_target_path() + '", correlation="' + self.preflag_manualflag_corr + '", flagbackup=False)'
-                    lib.run_casa([tg_corr])
+                    self.flagdata(self.get_target_path(), correlation=self.preflag_manualflag_corr)
                     logger.debug('Beam ' + self.beam + ': Flagged correlation(s) ' + self.preflag_manualflag_corr + ' for target dataset')
                     spltcorr = self.preflag_manualflag_corr.split(',')
                     for corr in spltcorr:
@@ -814,9 +897,9 @@ class preflag(BaseModule):
 
         # Save the derived parameters for the correlation flagging to the parameter file
 
-        subs_param.add_param(self, pbeam + '_fluxcal_manualflag_corr', preflagfluxcalmanualflagcorr)
-        subs_param.add_param(self, pbeam + '_polcal_manualflag_corr', preflagpolcalmanualflagcorr)
-        subs_param.add_param(self, pbeam + '_targetbeams_manualflag_corr', preflagtargetbeamsmanualflagcorr)
+        self.add_flag_param(pbeam + '_fluxcal_manualflag_corr', preflagfluxcalmanualflagcorr)
+        self.add_flag_param(pbeam + '_polcal_manualflag_corr', preflagpolcalmanualflagcorr)
+        self.add_flag_param(pbeam + '_targetbeams_manualflag_corr', preflagtargetbeamsmanualflagcorr)
 
 
     def manualflag_baseline(self):
@@ -842,8 +925,7 @@ class preflag(BaseModule):
             else:
                 if self.preflag_manualflag_fluxcal and os.path.isdir(
                         self.get_fluxcal_path()) and self.fluxcal != '':
-                    fc_baseline = 'flagdata(vis="' + self.get_fluxcal_path() + '", antenna="' + self.preflag_manualflag_baseline + '", flagbackup=False)'
-                    lib.run_casa([fc_baseline])
+                    self.flagdata(self.get_fluxcal_path(), antenna=self.preflag_manualflag_baseline)
                     logger.debug('Beam ' + self.beam + ': Flagged baseline(s) ' + self.preflag_manualflag_baseline + ' for flux calibrator')
                     spltbaseline = self.preflag_manualflag_baseline.split(',')
                     for baseline in spltbaseline:
@@ -860,8 +942,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Baseline(s) ' + self.preflag_manualflag_baseline + ' for polarised calibrator were already flagged')
             else:
                 if self.preflag_manualflag_polcal and os.path.isdir(self.get_polcal_path()) and self.polcal != '':
-                    pc_baseline = 'flagdata(vis="' + self.get_polcal_path() + '", antenna="' + self.preflag_manualflag_baseline + '", flagbackup=False)'
-                    lib.run_casa([pc_baseline])
+                    self.flagdata(self.get_polcal_path(), antenna=self.preflag_manualflag_baseline)
                     logger.debug('Beam ' + self.beam + ': Flagged baseline(s) ' + self.preflag_manualflag_baseline + ' for polarised calibrator')
                     spltbaseline = self.preflag_manualflag_baseline.split(',')
                     for baseline in spltbaseline:
@@ -877,8 +958,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Baseline(s) ' + self.preflag_manualflag_baseline + ' for target beam dataset were already flagged!')
             else:
                 if self.preflag_manualflag_target and os.path.isdir(self.get_target_path()):
-                    tg_baseline = 'flagdata(vis="' + self.get_target_path() + '", antenna="' + self.preflag_manualflag_baseline + '", flagbackup=False)'
-                    lib.run_casa([tg_baseline])
+                    self.flagdata(self.get_target_path(), antenna=self.preflag_manualflag_baseline)
                     logger.debug('Beam ' + self.beam + ': Flagging baseline(s) ' + self.preflag_manualflag_baseline + ' for target beam dataset')
                     spltbaseline = self.preflag_manualflag_baseline.split(',')
                     for baseline in spltbaseline:
@@ -892,9 +972,9 @@ class preflag(BaseModule):
 
         # Save the derived parameters for the baseline flagging to the parameter file
 
-        subs_param.add_param(self, pbeam + '_fluxcal_manualflag_baseline', preflagfluxcalmanualflagbaseline)
-        subs_param.add_param(self, pbeam + '_polcal_manualflag_baseline', preflagpolcalmanualflagbaseline)
-        subs_param.add_param(self, pbeam + '_targetbeams_manualflag_baseline', preflagtargetbeamsmanualflagbaseline)
+        self.add_flag_param(pbeam + '_fluxcal_manualflag_baseline', preflagfluxcalmanualflagbaseline)
+        self.add_flag_param(pbeam + '_polcal_manualflag_baseline', preflagpolcalmanualflagbaseline)
+        self.add_flag_param(pbeam + '_targetbeams_manualflag_baseline', preflagtargetbeamsmanualflagbaseline)
 
 
     def manualflag_channel(self):
@@ -919,8 +999,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Channel(s) ' + self.preflag_manualflag_channel + ' for flux calibrator were already flagged')
             else:
                 if self.preflag_manualflag_fluxcal and os.path.isdir(self.get_fluxcal_path()) and self.fluxcal != '':
-                    fc_channel = 'flagdata(vis="' + self.get_fluxcal_path() + '", spw="0:' + self.preflag_manualflag_channel + '", flagbackup=False)'
-                    lib.run_casa([fc_channel])
+                    self.flagdata(self.get_fluxcal_path(), spw='0:' + self.preflag_manualflag_channel)
                     logger.debug('Beam ' + self.beam + ': Flagged channel(s) ' + self.preflag_manualflag_channel + ' for flux calibrator')
                     spltchannel = self.preflag_manualflag_channel.split(',')
                     for channel in spltchannel:
@@ -936,8 +1015,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Channel(s) ' + self.preflag_manualflag_channel + ' for polarised calibrator were already flagged')
             else:
                 if self.preflag_manualflag_polcal and os.path.isdir(self.get_polcal_path()) and self.polcal != '':
-                    pc_channel = 'flagdata(vis="' + self.get_polcal_path() + '", spw="0:' + self.preflag_manualflag_channel + '", flagbackup=False)'
-                    lib.run_casa([pc_channel])
+                    self.flagdata(self.get_polcal_path(), spw='0:' + self.preflag_manualflag_channel)
                     logger.debug('Beam ' + self.beam + ': Flagged channel(s) ' + self.preflag_manualflag_channel + ' for polarised calibrator')
                     spltchannel = self.preflag_manualflag_channel.split(',')
                     for channel in spltchannel:
@@ -953,8 +1031,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Correlation(s) ' + self.preflag_manualflag_channel + ' for target beam dataset were already flagged')
             else:
                 if self.preflag_manualflag_target and os.path.isdir(self.get_target_path()):
-                    tg_channel = 'flagdata(vis="' + self.get_target_path() + '", spw="0:' + self.preflag_manualflag_channel + '", flagbackup=False)'
-                    lib.run_casa([tg_channel])
+                    self.flagdata(self.get_target_path(), spw='0:' + self.preflag_manualflag_channel)
                     logger.debug('Beam ' + self.beam + ': Flagging channel(s) ' + self.preflag_manualflag_channel + ' for target beam dataset')
                     spltchannel = self.preflag_manualflag_channel.split(',')
                     for channel in spltchannel:
@@ -968,9 +1045,9 @@ class preflag(BaseModule):
 
         # Save the derived parameters for the channel flagging to the parameter file
 
-        subs_param.add_param(self, pbeam + '_fluxcal_manualflag_channel', preflagfluxcalmanualflagchannel)
-        subs_param.add_param(self, pbeam + '_polcal_manualflag_channel', preflagpolcalmanualflagchannel)
-        subs_param.add_param(self, pbeam + '_targetbeams_manualflag_channel', preflagtargetbeamsmanualflagchannel)
+        self.add_flag_param(pbeam + '_fluxcal_manualflag_channel', preflagfluxcalmanualflagchannel)
+        self.add_flag_param(pbeam + '_polcal_manualflag_channel', preflagpolcalmanualflagchannel)
+        self.add_flag_param(pbeam + '_targetbeams_manualflag_channel', preflagtargetbeamsmanualflagchannel)
 
 
     def manualflag_time(self):
@@ -995,8 +1072,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Time range ' + self.preflag_manualflag_time + ' for flux calibrator was already flagged')
             else:
                 if self.preflag_manualflag_fluxcal and os.path.isdir(self.get_fluxcal_path()) and self.fluxcal != '':
-                    fc_time = 'flagdata(vis="' + self.get_fluxcal_path() + '", timerange="' + self.preflag_manualflag_time + '", flagbackup=False)'
-                    lib.run_casa([fc_time])
+                    self.flagdata(self.get_fluxcal_path(), timerange=self.preflag_manualflag_time)
                     logger.debug('Beam ' + self.beam + ': Flagged time range ' + self.preflag_manualflag_time + ' for flux calibrator')
                     splttime = self.preflag_manualflag_time.split(',')
                     for time in splttime:
@@ -1013,8 +1089,7 @@ class preflag(BaseModule):
                 logger.info('Time range ' + self.preflag_manualflag_time + ' for polarised calibrator was already flagged')
             else:
                 if self.preflag_manualflag_polcal and os.path.isdir(self.get_polcal_path()) and self.polcal != '':
-                    pc_time = 'flagdata(vis="' + self.get_polcal_path() + '", timerange="' + self.preflag_manualflag_time + '", flagbackup=False)'
-                    lib.run_casa([pc_time])
+                    self.flagdata(self.get_polcal_path(), timerange=self.preflag_manualflag_time)
                     logger.debug('Beam ' + self.beam + ': Flagged time range ' + self.preflag_manualflag_time + ' for polarised calibrator')
                     splttime = self.preflag_manualflag_time.split(',')
                     for time in splttime:
@@ -1031,8 +1106,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Time range ' + self.preflag_manualflag_time + ' for target beam dataset was already flagged!')
             else:
                 if self.preflag_manualflag_target and os.path.isdir(self.get_target_path()):
-                    tg_time = 'flagdata(vis="' + self.get_target_path() + '", timerange="' + self.preflag_manualflag_time + '", flagbackup=False)'
-                    lib.run_casa([tg_time])
+                    self.flagdata(self.get_target_path(), timerange=self.preflag_manualflag_time)
                     logger.debug('Beam ' + self.beam + ': Flagging time range(s) ' + self.preflag_manualflag_time + ' for target beam dataset')
                     splttime = self.preflag_manualflag_time.split(',')
                     for time in splttime:
@@ -1046,9 +1120,9 @@ class preflag(BaseModule):
 
         # Save the derived parameters for the channel flagging to the parameter file
 
-        subs_param.add_param(self, pbeam + '_fluxcal_manualflag_time', preflagfluxcalmanualflagtime)
-        subs_param.add_param(self, pbeam + '_polcal_manualflag_time', preflagpolcalmanualflagtime)
-        subs_param.add_param(self, pbeam + '_targetbeams_manualflag_time', preflagtargetbeamsmanualflagtime)
+        self.add_flag_param(pbeam + '_fluxcal_manualflag_time', preflagfluxcalmanualflagtime)
+        self.add_flag_param(pbeam + '_polcal_manualflag_time', preflagpolcalmanualflagtime)
+        self.add_flag_param(pbeam + '_targetbeams_manualflag_time', preflagtargetbeamsmanualflagtime)
 
 
     def manualflag_clipzeros(self):
@@ -1076,8 +1150,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Zero-valued data for flux calibrator were already flagged')
             else:
                 if self.preflag_manualflag_fluxcal and os.path.isdir(self.get_fluxcal_path()) and self.fluxcal != '':
-                    fc_clipzeros = 'flagdata(vis="' + self.get_fluxcal_path() + '", mode="clip", clipzeros=True, flagbackup=False)'
-                    lib.run_casa([fc_clipzeros])
+                    self.flagdata(self.get_fluxcal_path(), mode='clip', clipzeros=True)
                     logger.debug('Beam ' + self.beam + ': Flagged Zero-valued data for flux calibrator')
                     preflagfluxcalmanualflagclipzeros = True
                 else:
@@ -1089,8 +1162,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Zero-values data for polarised calibrator were already flagged')
             else:
                 if self.preflag_manualflag_polcal and os.path.isdir(self.get_polcal_path()) and self.polcal != '':
-                    pc_clipzeros = 'flagdata(vis="' + self.get_polcal_path() + '", mode="clip", clipzeros=True, flagbackup=False)'
-                    lib.run_casa([pc_clipzeros])
+                    self.flagdata(self.get_polcal_path(), mode='clip', clipzeros=True)
                     logger.debug('Beam ' + self.beam + ': Flagged Zero-valued data for polarised calibrator')
                     preflagpolcalmanualflagclipzeros = True
                 else:
@@ -1102,8 +1174,7 @@ class preflag(BaseModule):
                 logger.info('Beam ' + self.beam + ': Zero-valued data for target beam dataset were already flagged')
             else:
                 if self.preflag_manualflag_target and os.path.isdir(self.get_target_path()):
-                    tg_clipzeros = 'flagdata(vis="' + self.get_target_path() + '", mode="clip", clipzeros=True, flagbackup=False)'
-                    lib.run_casa([tg_clipzeros])
+                    self.flagdata(self.get_target_path(), mode='clip', clipzeros=True)
                     logger.debug('Beam ' + self.beam + ': Zero-valued data for target beam flagged!')
                     preflagtargetbeamsmanualflagclipzeros = True
                 else:
@@ -1112,9 +1183,9 @@ class preflag(BaseModule):
 
         # Save the derived parameters for the auto-correlation flagging to the parameter file
 
-        subs_param.add_param(self, pbeam + '_fluxcal_manualflag_clipzeros', preflagfluxcalmanualflagclipzeros)
-        subs_param.add_param(self, pbeam + '_polcal_manualflag_clipzeros', preflagpolcalmanualflagclipzeros)
-        subs_param.add_param(self, pbeam + '_targetbeams_manualflag_clipzeros', preflagtargetbeamsmanualflagclipzeros)
+        self.add_flag_param(pbeam + '_fluxcal_manualflag_clipzeros', preflagfluxcalmanualflagclipzeros)
+        self.add_flag_param(pbeam + '_polcal_manualflag_clipzeros', preflagpolcalmanualflagclipzeros)
+        self.add_flag_param(pbeam + '_targetbeams_manualflag_clipzeros', preflagtargetbeamsmanualflagclipzeros)
 
 
     def aoflagger_bandpass(self):
@@ -18,6 +18,7 @@ from apercal.subs.param import get_param_def
 from apercal.subs import param as subs_param
 from apercal.subs import masking
 from apercal.subs import qa
+from apercal.subs import checkpoint as subs_checkpoint
 
 from apercal.exceptions import ApercalException
 
@@ -48,6 +49,8 @@ class scal(BaseModule):
     selfcal_image_cellsize = None
     selfcal_refant = None
     selfcal_gaussianity = None
+    selfcal_maskengine = 'pybdsf'
+    selfcal_noiseengine = 'image'
     selfcal_average = None
     selfcal_flagline = None
     selfcal_flagline_sigma = None
@@ -77,6 +80,7 @@ class scal(BaseModule):
     selfcal_phase_solint = None
     selfcal_phase_nfbin = None
     selfcal_phase_robust = None
+    selfcal_phase_convergence = None
     selfcal_amp = None
     selfcal_amp_auto_limit = None
     selfcal_amp_minorcycle = None
@@ -92,6 +96,10 @@ class scal(BaseModule):
     selfcal_amp_nfbin = None
     selfcal_amp_ratio = None
     selfcal_amp_robust = None
+    selfcal_amp_convergence = None
+
+    # Prefixes of the settings the cycles of the phase self-calibration depend on
+    PHASE_CHECKPOINT_PREFIXES = ('selfcal_image', 'selfcal_phase', 'selfcal_refant', 'selfcal_gaussianity', 'selfcal_maskengine', 'selfcal_noiseengine')
 
     selfcaldir = None
     crosscaldir = None
@@ -217,7 +225,6 @@ class scal(BaseModule):
                 selfcaltargetbeamsaverage = True
 
         # Save the derived parameters to the parameter file
-
         subs_param.add_param(self, beam + '_targetbeams_average', selfcaltargetbeamsaverage)
 
 
@@ -283,9 +290,9 @@ class scal(BaseModule):
             logger.warning('Beam ' + self.beam + ': Automatic HI-line/RFI flagging disabled!')
 
         # Save the derived parameters to the parameter file
-
-        subs_param.add_param(self, beam + '_targetbeams_flagline', selfcaltargetbeamsflagline)
-        subs_param.add_param(self, beam + '_targetbeams_flagline_channels', selfcaltargetbeamsflaglinechannels)
+        with subs_param.param_batch(self):
+            subs_param.add_param(self, beam + '_targetbeams_flagline', selfcaltargetbeamsflagline)
+            subs_param.add_param(self, beam + '_targetbeams_flagline_channels', selfcaltargetbeamsflaglinechannels)
 
 
     def parametric(self):
@@ -338,7 +345,7 @@ class scal(BaseModule):
                         parflux = np.sum(parmodelarray[:,2])
                     else:
                         parflux = np.sum(parmodelarray[2])
-                    gaussianity, TN = masking.get_theoretical_noise(self, self.target, self.selfcal_gaussianity)  # Gaussianity test and theoretical noise calculation using Stokes V image
+                    gaussianity, TN = masking.get_theoretical_noise(self, self.target, self.selfcal_gaussianity, engine=self.selfcal_noiseengine)  # Gaussianity test and theoretical noise calculation using Stokes V image
                     if self.selfcal_parametric_amp:
                         selfcal.interval = calc_scal_interval(parflux, TN, 720, 66, self.selfcal_parametric_nfbin, 2, 10.0, 1)
                     else:
@@ -369,7 +376,6 @@ class scal(BaseModule):
             logger.info('Beam ' + self.beam + ': Parametric self calibration disabled!')
 
         # Save the derived parameters to the parameter file
-
         subs_param.add_param(self, beam + '_targetbeams_parametric', selfcaltargetbeamsparametric)
 
 
@@ -401,6 +407,29 @@ class scal(BaseModule):
         selfcaltargetbeamsphasefinalmajor = get_param_def(self, beam + '_targetbeams_phase_final_majorcycle', np.full((1), 0))
         selfcaltargetbeamsphasefinalminor = get_param_def(self, beam + '_targetbeams_phase_final_minorcycle', np.full((1), 0))
 
+        def save_params():
+            with subs_param.param_batch(self):
+                subs_param.add_param(self, beam + '_targetbeams_phase_status', selfcaltargetbeamsphasestatus)
+                subs_param.add_param(self, beam + '_targetbeams_phase_mapstatus', selfcaltargetbeamsphasemapstatus)
+                subs_param.add_param(self, beam + '_targetbeams_phase_mapstats', selfcaltargetbeamsphasemapstats)
+                subs_param.add_param(self, beam + '_targetbeams_phase_beamstatus', selfcaltargetbeamsphasebeamstatus)
+                subs_param.add_param(self, beam + '_targetbeams_phase_maskstatus', selfcaltargetbeamsphasemaskstatus)
+                subs_param.add_param(self, beam + '_targetbeams_phase_maskstats', selfcaltargetbeamsphasemaskstats)
+                subs_param.add_param(self, beam + '_targetbeams_phase_modelstatus', selfcaltargetbeamsphasemodelstatus)
+                subs_param.add_param(self, beam + '_targetbeams_phase_modelstats', selfcaltargetbeamsphasemodelstats)
+                subs_param.add_param(self, beam + '_targetbeams_phase_imagestatus', selfcaltargetbeamsphaseimagestatus)
+                subs_param.add_param(self, beam + '_targetbeams_phase_imagestats', selfcaltargetbeamsphaseimagestats)
+                subs_param.add_param(self, beam + '_targetbeams_phase_residualstatus', selfcaltargetbeamsphaseresidualstatus)
+                subs_param.add_param(self, beam + '_targetbeams_phase_residualstats', selfcaltargetbeamsphaseresidualstats)
+                subs_param.add_param(self, beam + '_targetbeams_phase_maskthreshold', selfcaltargetbeamsphasemaskthreshold)
+                subs_param.add_param(self, beam + '_targetbeams_phase_cleanthreshold', selfcaltargetbeamsphasecleanthreshold)
+                subs_param.add_param(self, beam + '_targetbeams_phase_thresholdtype', selfcaltargetbeamsphasethresholdtype)
+                subs_param.add_param(self, beam + '_targetbeams_phase_final_majorcycle', selfcaltargetbeamsphasefinalmajor)
+                subs_param.add_param(self, beam + '_targetbeams_phase_final_minorcycle', selfcaltargetbeamsphasefinalminor)
+                if checkpoint is not None:
+                    subs_param.add_param(self, beam + '_targetbeams_phase_checkpoint', checkpoint)
+
+        checkpoint = None
         if self.selfcal_phase:
             subs_setinit.setinitdirs(self)
             subs_setinit.setdatasetnamestomiriad(self)
@@ -410,13 +439,26 @@ class scal(BaseModule):
                 majdr_list = masking.calc_dr_maj(self.selfcal_phase_drinit, self.selfcal_phase_dr0, self.selfcal_phase_majorcycle, self.selfcal_phase_majorcycle_function) # List with dynamic range dynamic range for major cycle
                 TNreached = False # Stop self-calibration if theoretical noise is reached
                 stop = False # Variable to stop self-calibration, if something goes wrong
+                converged = False # Stop self-calibration if the major cycles do not improve the image anymore
+                checkpoint = self.get_phase_checkpoint(beam) # Continue after the last finished cycle of a previous run
+                if checkpoint['TN'] is not None:
+                    gaussianity, TN = checkpoint['TN']
                 for majc in range(self.selfcal_phase_majorcycle):
-                    if stop:
+                    if stop or converged:
                         break
                     else:
+                        cycle = checkpoint['cycles'][majc] if majc < len(checkpoint['cycles']) else None
+                        if cycle is not None and cycle['gains'] is not None:
+                            TNreached = cycle['TNreached']
+                            converged = cycle.get('converged', False)
+                            selfcaltargetbeamsphasefinalmajor = cycle['finalmajor']
+                            selfcaltargetbeamsphasefinalminor = cycle['finalminor']
+                            logger.info('Beam ' + self.beam + ': Major cycle ' + str(majc) + ' was already done. Skipping it!')
+                            continue
                         if not TNreached:
-                            if majc == 0: # Calculate theoretical noise at the beginning of the first major cycle
-                                gaussianity, TN = masking.get_theoretical_noise(self, self.target, self.selfcal_gaussianity)  # Gaussianity test and theoretical noise calculation using Stokes V image
+                            if checkpoint['TN'] is None: # Calculate theoretical noise at the beginning of the first major cycle
+                                gaussianity, TN = masking.get_theoretical_noise(self, self.target, self.selfcal_gaussianity, engine=self.selfcal_noiseengine)  # Gaussianity test and theoretical noise calculation using Stokes V image
+                                checkpoint['TN'] = (gaussianity, TN)
                                 if gaussianity:
                                     pass
                                 else:
@@ -427,7 +469,15 @@ class scal(BaseModule):
                             subs_managefiles.director(self, 'mk', self.selfcaldir + '/' + str(majc).zfill(2))
                             mindr_list = masking.calc_dr_min(majdr_list, majc, self.selfcal_phase_minorcycle, self.selfcal_phase_mindr, self.selfcal_phase_minorcycle_function) # List with dynamic range dynamic range for minor cycles
                             for minc in range(self.selfcal_phase_minorcycle):
+                                if cycle is not None and minc < len(cycle['minors']):
+                                    TNreached = cycle['minors'][minc]['TNreached']
+                                    selfcaltargetbeamsphasefinalminor = minc
+                                    dirtystats = selfcaltargetbeamsphasemapstats[majc, :]
+                                    logger.info('Beam ' + self.beam + ': Cycle ' + str(majc) + '/' + str(minc) + ' was already done. Skipping it!')
+                                    continue
                                 if not TNreached:
+                                    for output in self.get_phase_outputs(majc, minc): # Remove outputs of an interrupted run
+                                        subs_managefiles.director(self, 'rm', output, ignore_nonexistent=True)
                                     if minc == 0: # Create a new dirty image after self-calibration
                                         invert = lib.miriad('invert')  # Create the dirty image
                                         invert.vis = self.target
@@ -488,8 +538,8 @@ class scal(BaseModule):
                                         selfcaltargetbeamsphasethresholdtype[majc, minc] = Mth[1]
                                         selfcaltargetbeamsphasecleanthreshold[majc, minc] = Cc
                                         if majc == 0: # Create mask from dirty image in the first major cycle
-                                            beampars = masking.get_beam(self, invert.map, invert.beam)
-                                            masking.create_mask(self, str(majc).zfill(2) + '/map_00', str(majc).zfill(2) + '/mask_00', Mth[0], TN, beampars=beampars, rms_map=False)
+                                            beampars = masking.get_beam(self, invert.map, invert.beam, dataset=invert.vis, imsize=invert.imsize, cell=invert.cell, robust=invert.robust)
+                                            masking.create_mask(self, str(majc).zfill(2) + '/map_00', str(majc).zfill(2) + '/mask_00', Mth[0], TN, beampars=beampars, rms_map=False, engine=self.selfcal_maskengine)
                                         else: # Otherwise copy the mask from the last minor cycle of the previous major iteration
                                             subs_managefiles.director(self, 'cp', str(majc).zfill(2) + '/mask_00', file_=str(majc-1).zfill(2) + '/mask_' + str(self.selfcal_phase_minorcycle-1).zfill(2))
                                         # Check if mask is there and ok
@@ -624,7 +674,7 @@ class scal(BaseModule):
                                         selfcaltargetbeamsphasemaskthreshold[majc, minc] = Mth[0]
                                         selfcaltargetbeamsphasethresholdtype[majc, minc] = Mth[1]
                                         selfcaltargetbeamsphasecleanthreshold[majc, minc] = Cc
-                                        masking.create_mask(self, str(majc).zfill(2) + '/image_' + str(minc-1).zfill(2), str(majc).zfill(2) + '/mask_' + str(minc).zfill(2), Mth[0], TN, beampars=None)
+                                        masking.create_mask(self, str(majc).zfill(2) + '/image_' + str(minc-1).zfill(2), str(majc).zfill(2) + '/mask_' + str(minc).zfill(2), Mth[0], TN, beampars=None, engine=self.selfcal_maskengine)
                                         # Check if mask is there and ok
                                         if os.path.isdir(str(majc).zfill(2) + '/mask_' + str(minc).zfill(2)):
                                             selfcaltargetbeamsphasemaskstats[majc, minc, :] = imstats.getmaskstats(self, str(majc).zfill(2) + '/mask_' + str(minc).zfill(2), self.selfcal_image_imsize)
@@ -748,6 +798,10 @@ class scal(BaseModule):
                                             logger.info('Beam ' + self.beam + ': Theoretical noise threshold reached. Using last model for final self-calibration!')
                                         else:
                                             TNreached = False
+                                    # Checkpoint the finished cycle with the fingerprints of its outputs
+                                    cycle = self.get_phase_checkpoint_cycle(checkpoint, majc)
+                                    cycle['minors'].append({'outputs': dict((output, subs_checkpoint.get_output_hash(output)) for output in self.get_phase_outputs(majc, minc)), 'TNreached': TNreached})
+                                    save_params()
                                 else:
                                     # set the minc counter back by one to when it reached the noise level before completing all minor cycles
                                     minc -= 1
@@ -769,7 +823,21 @@ class scal(BaseModule):
                                 selfcal.refant = self.selfcal_refant
                             selfcal.options = 'phase,mfs'
                             selfcal.nfbin = self.selfcal_phase_nfbin
+                            checkpoint['selfcal'] = majc
+                            save_params()
                             selfcal.go()
+                            self.checkpoint_phase_gains(checkpoint, majc, TNreached, selfcaltargetbeamsphasefinalmajor, selfcaltargetbeamsphasefinalminor)
+                            if majc > 0 and not TNreached:
+                                # Compare the last residual and model of each major cycle and the gains to the ones of the previous major cycle
+                                lastminor = [np.flatnonzero(np.isfinite(stats))[-1] if np.any(np.isfinite(stats)) else 0 for stats in selfcaltargetbeamsphaseresidualstats[:majc + 1, :, 2]]
+                                residualrms = [selfcaltargetbeamsphaseresidualstats[m, lastminor[m], 2] for m in range(majc + 1)]
+                                modelflux = [selfcaltargetbeamsphasemodelstats[m, lastminor[m], 1] for m in range(majc + 1)]
+                                gainchange = qa.getgainchange(self, self.target, 'checkpoint_phase/' + str(majc - 1).zfill(2))
+                                converged = qa.checkconvergence(self, residualrms, modelflux, self.selfcal_phase_convergence, gainchange=gainchange)
+                                checkpoint['cycles'][majc]['converged'] = converged
+                                if converged:
+                                    logger.info('Beam ' + self.beam + ': Phase self-calibration converged after major cycle ' + str(majc) + '. Skipping the remaining major cycles!')
+                            save_params()
                         else:
                             # When theoretical noise is reached, do a last self-calibration round
                             selfcal = lib.miriad('selfcal')
@@ -786,9 +854,13 @@ class scal(BaseModule):
                                 selfcal.refant = self.selfcal_refant
                             selfcal.options = 'phase,mfs'
                             selfcal.nfbin = self.selfcal_phase_nfbin
+                            checkpoint['selfcal'] = majc
+                            save_params()
                             selfcal.go()
+                            self.checkpoint_phase_gains(checkpoint, majc, TNreached, selfcaltargetbeamsphasefinalmajor, selfcaltargetbeamsphasefinalminor)
+                            save_params()
                 # Check final residual image for gaussianity, we should add more metrics here to check selfcal
-                if TNreached or ((self.selfcal_phase_minorcycle-1) == selfcaltargetbeamsphasefinalminor and (self.selfcal_phase_majorcycle-1) == selfcaltargetbeamsphasefinalmajor):
+                if TNreached or converged or ((self.selfcal_phase_minorcycle-1) == selfcaltargetbeamsphasefinalminor and (self.selfcal_phase_majorcycle-1) == selfcaltargetbeamsphasefinalmajor):
                     if qa.checkimagegaussianity(self, str(selfcaltargetbeamsphasefinalmajor).zfill(2) + '/residual_' + str(selfcaltargetbeamsphasefinalminor).zfill(2), self.selfcal_gaussianity):
                         selfcaltargetbeamsphaseresidualstatus = True
                         selfcaltargetbeamsphasestatus = True
@@ -807,25 +879,105 @@ class scal(BaseModule):
             logger.warning('Beam ' + self.beam + ': Phase self-calibration disabled!')
 
         # Save the derived parameters to the parameter file
+        save_params()
+
 
-        subs_param.add_param(self, beam + '_targetbeams_phase_status', selfcaltargetbeamsphasestatus)
-        subs_param.add_param(self, beam + '_targetbeams_phase_mapstatus', selfcaltargetbeamsphasemapstatus)
-        subs_param.add_param(self, beam + '_targetbeams_phase_mapstats', selfcaltargetbeamsphasemapstats)
-        subs_param.add_param(self, beam + '_targetbeams_phase_beamstatus', selfcaltargetbeamsphasebeamstatus)
-        subs_param.add_param(self, beam + '_targetbeams_phase_maskstatus', selfcaltargetbeamsphasemaskstatus)
-        subs_param.add_param(self, beam + '_targetbeams_phase_maskstats', selfcaltargetbeamsphasemaskstats)
-        subs_param.add_param(self, beam + '_targetbeams_phase_modelstatus', selfcaltargetbeamsphasemodelstatus)
-        subs_param.add_param(self, beam + '_targetbeams_phase_modelstats', selfcaltargetbeamsphasemodelstats)
-        subs_param.add_param(self, beam + '_targetbeams_phase_imagestatus', selfcaltargetbeamsphaseimagestatus)
-        subs_param.add_param(self, beam + '_targetbeams_phase_imagestats', selfcaltargetbeamsphaseimagestats)
-        subs_param.add_param(self, beam + '_targetbeams_phase_residualstatus', selfcaltargetbeamsphaseresidualstatus)
-        subs_param.add_param(self, beam + '_targetbeams_phase_residualstats', selfcaltargetbeamsphaseresidualstats)
-        subs_param.add_param(self, beam + '_targetbeams_phase_maskthreshold', selfcaltargetbeamsphasemaskthreshold)
-        subs_param.add_param(self, beam + '_targetbeams_phase_cleanthreshold', selfcaltargetbeamsphasecleanthreshold)
-        subs_param.add_param(self, beam + '_targetbeams_phase_thresholdtype', selfcaltargetbeamsphasethresholdtype)
-        subs_param.add_param(self, beam + '_targetbeams_phase_final_majorcycle', selfcaltargetbeamsphasefinalmajor)
-        subs_param.add_param(self, beam + '_targetbeams_phase_final_minorcycle', selfcaltargetbeamsphasefinalminor)
+    @staticmethod
+    def get_phase_outputs(majc, minc):
+        """
+        Returns the images created in a cycle of the phase self-calibration
+        majc (int): The major cycle
+        minc (int): The minor cycle
+        returns (list): The paths of the images relative to the selfcal directory
+        """
+        names = ['map_00', 'beam_00'] if minc == 0 else []
+        names += [name + '_' + str(minc).zfill(2) for name in ['mask', 'model', 'image', 'residual']]
+        return [str(majc).zfill(2) + '/' + name for name in names]
+
+    @staticmethod
+    def get_phase_checkpoint_cycle(checkpoint, majc):
+        """
+        Returns the state of a major cycle in the checkpoint of the phase self-calibration, adds it if it does not exist
+        checkpoint (dict): The checkpoint as returned by get_phase_checkpoint
+        majc (int): The major cycle
+        returns (dict): The fingerprints of the finished minor cycles and the hash of the gains after the self-calibration
+        """
+        if majc == len(checkpoint['cycles']):
+            checkpoint['cycles'].append({'minors': [], 'gains': None, 'TNreached': False, 'finalmajor': majc, 'finalminor': 0})
+        return checkpoint['cycles'][majc]
 
+    def checkpoint_phase_gains(self, checkpoint, majc, TNreached, finalmajor, finalminor):
+        """
+        Saves the gains of the dataset after the self-calibration of a major cycle into the checkpoint
+        checkpoint (dict): The checkpoint as returned by get_phase_checkpoint
+        majc (int): The major cycle
+        TNreached (bool): If the theoretical noise was reached
+        finalmajor (int): The major cycle of the model used for the self-calibration
+        finalminor (int): The minor cycle of the model used for the self-calibration
+        """
+        cycle = self.get_phase_checkpoint_cycle(checkpoint, majc)
+        cycle['gains'] = subs_checkpoint.save_items(self.target, 'checkpoint_phase/' + str(majc).zfill(2))
+        cycle['TNreached'] = TNreached
+        cycle['finalmajor'] = finalmajor
+        cycle['finalminor'] = finalminor
+        checkpoint['selfcal'] = None
+
+    def get_phase_checkpoint(self, beam):
+        """
+        Loads the checkpoint of the iterative phase self-calibration and verifies it. Cycles with changed or missing
+        outputs are dropped together with all following cycles and the gains of the dataset are restored to the ones
+        after the last finished major cycle. A new checkpoint is started if the settings changed or if the gains were
+        changed outside of the phase self-calibration. Must be called in the selfcal directory.
+        beam (string): The prefix of the parameters of the beam
+        returns (dict): The checkpoint with the hash of the settings, the theoretical noise, the hash of the gains
+                        before the first major cycle, the state of each major cycle and the major cycle with a running
+                        self-calibration
+        """
+        config = subs_checkpoint.get_config_hash(self, self.PHASE_CHECKPOINT_PREFIXES, [self.target])
+        gains = subs_checkpoint.get_items_hash(self.target)
+        checkpoint = get_param_def(self, beam + '_targetbeams_phase_checkpoint', None)
+        if checkpoint is not None:
+            known = [checkpoint['start']] + [cycle['gains'] for cycle in checkpoint['cycles']]
+            if gains not in known and checkpoint['selfcal'] is None:
+                logger.warning('Beam ' + self.beam + ': Gains changed since the last phase self-calibration. Starting from the first cycle!')
+                checkpoint = None
+            elif checkpoint['config'] != config:
+                logger.info('Beam ' + self.beam + ': Phase self-calibration settings changed. Starting from the first cycle!')
+                if subs_checkpoint.get_items_hash('checkpoint_phase/start') == checkpoint['start']:
+                    subs_checkpoint.restore_items(self.target, 'checkpoint_phase/start')
+                checkpoint = None
+        if checkpoint is not None:
+            # Keep the cycles up to the first one with changed outputs or saved gains
+            cycles = []
+            for majc, cycle in enumerate(checkpoint['cycles']):
+                minors = []
+                for minor in cycle['minors']:
+                    if any(subs_checkpoint.get_output_hash(output) != fingerprint for output, fingerprint in minor['outputs'].items()):
+                        break
+                    minors.append(minor)
+                complete = len(minors) == len(cycle['minors']) and cycle['gains'] is not None and \
+                    subs_checkpoint.get_items_hash('checkpoint_phase/' + str(majc).zfill(2)) == cycle['gains']
+                if complete:
+                    cycles.append(cycle)
+                    continue
+                if len(minors) > 0:
+                    cycles.append({'minors': minors, 'gains': None, 'TNreached': False, 'finalmajor': majc, 'finalminor': 0})
+                break
+            checkpoint['cycles'] = cycles
+            checkpoint['selfcal'] = None
+            # Restore the gains after the last finished major cycle
+            finished = [majc for majc, cycle in enumerate(cycles) if cycle['gains'] is not None]
+            expected = cycles[finished[-1]]['gains'] if finished else checkpoint['start']
+            if gains != expected:
+                source = 'checkpoint_phase/' + (str(finished[-1]).zfill(2) if finished else 'start')
+                if subs_checkpoint.restore_items(self.target, source) != expected:
+                    logger.warning('Beam ' + self.beam + ': Could not restore the gains of the last finished cycle. Starting from the first cycle!')
+                    checkpoint = None
+        if checkpoint is None:
+            checkpoint = {'config': config, 'start': subs_checkpoint.save_items(self.target, 'checkpoint_phase/start'), 'TN': None, 'cycles': [], 'selfcal': None}
+        elif checkpoint['cycles']:
+            logger.info('Beam ' + self.beam + ': Continuing phase self-calibration after ' + str(sum(len(cycle['minors']) for cycle in checkpoint['cycles'])) + ' finished cycles')
+        return checkpoint
 
     def amp(self):
         """
@@ -879,13 +1031,14 @@ class scal(BaseModule):
                         lastphaseresidualmax = subs_param.get_param(self, beam + '_targetbeams_phase_residualstats')[phasemajor, phaseminor, 1]
                         lastphasedr = lastphasemapmax/lastphaseresidualmax
                         mindr_list = masking.calc_dr_amp(lastphasedr, self.selfcal_amp_dr0, self.selfcal_amp_minorcycle, self.selfcal_amp_minorcycle_function)  # List with dynamic range dynamic range for minor cycles
-                        gaussianity, TN = masking.get_theoretical_noise(self, self.target.rstrip('.mir') + '_amp.mir', self.selfcal_gaussianity)  # Gaussianity test and theoretical noise calculation using Stokes V image
+                        gaussianity, TN = masking.get_theoretical_noise(self, self.target.rstrip('.mir') + '_amp.mir', self.selfcal_gaussianity, engine=self.selfcal_noiseengine)  # Gaussianity test and theoretical noise calculation using Stokes V image
                         if gaussianity:
                             pass
                         else:
                             logger.warning('Beam ' + self.beam + ': Stokes V image shows non-gaussian distribution. Your theoretical noise value might be off!')
                         logger.info('Beam ' + self.beam + ': Theoretical noise is ' + '%.6f' % TN + ' Jy')
                         TNreached = False  # Stop self-calibration if theoretical noise is reached
+                        converged = False  # Stop self-calibration if cleaning does not improve the model anymore
                         stop = False
                         for minc in range(self.selfcal_amp_minorcycle):
                             if not TNreached:
@@ -1075,7 +1228,7 @@ class scal(BaseModule):
                                     selfcaltargetbeamsampmaskthreshold[minc] = Mth[0]
                                     selfcaltargetbeamsampthresholdtype[minc] = Mth[1]
                                     selfcaltargetbeamsampcleanthreshold[minc] = Cc
-                                    masking.create_mask(self, 'amp/image_' + str(minc - 1).zfill(2), 'amp/mask_' + str(minc).zfill(2), Mth[0], TN, beampars=None)
+                                    masking.create_mask(self, 'amp/image_' + str(minc - 1).zfill(2), 'amp/mask_' + str(minc).zfill(2), Mth[0], TN, beampars=None, engine=self.selfcal_maskengine)
                                     # Check if mask is there and ok
                                     if os.path.isdir('amp/mask_' + str(minc).zfill(2)):
                                         selfcaltargetbeamsampmaskstats[minc, :] = imstats.getmaskstats(self, 'amp/mask_' + str(minc).zfill(2), self.selfcal_image_imsize)
@@ -1193,10 +1346,14 @@ class scal(BaseModule):
                                         logger.info('Beam ' + self.beam + ': Theoretical noise threshold reached. Using last model for final self-calibration!')
                                     else:
                                         TNreached = False
+                                    if qa.checkconvergence(self, selfcaltargetbeamsampresidualstats[:minc + 1, 2], selfcaltargetbeamsampmodelstats[:minc + 1, 1], self.selfcal_amp_convergence, ncycles=2):
+                                        converged = True
+                                        logger.info('Beam ' + self.beam + ': Cleaning converged in cycle ' + str(minc) + '. Using last model for amplitude self-calibration!')
+                                        break
                             else: # If theoretical noise has been reached
                                 break
                         if not stop:
-                            if not TNreached:
+                            if not TNreached and not converged:
                                 logger.warning('Beam ' + self.beam + ': Theoretical noise limit not reached for final amplitude self-calibration model! Your model might be incomplete!')
                             else:
                                 pass
@@ -1276,24 +1433,24 @@ class scal(BaseModule):
             logger.info('Beam ' + self.beam + ': Amplitude self-calibration disabled!')
 
         # Save the derived parameters to the parameter file
-
-        subs_param.add_param(self, beam + '_targetbeams_amp_status', selfcaltargetbeamsampstatus)
-        subs_param.add_param(self, beam + '_targetbeams_amp_applystatus', selfcaltargetbeamsampapplystatus)
-        subs_param.add_param(self, beam + '_targetbeams_amp_mapstatus', selfcaltargetbeamsampmapstatus)
-        subs_param.add_param(self, beam + '_targetbeams_amp_mapstats', selfcaltargetbeamsampmapstats)
-        subs_param.add_param(self, beam + '_targetbeams_amp_beamstatus', selfcaltargetbeamsampbeamstatus)
-        subs_param.add_param(self, beam + '_targetbeams_amp_maskstatus', selfcaltargetbeamsampmaskstatus)
-        subs_param.add_param(self, beam + '_targetbeams_amp_maskstats', selfcaltargetbeamsampmaskstats)
-        subs_param.add_param(self, beam + '_targetbeams_amp_modelstatus', selfcaltargetbeamsampmodelstatus)
-        subs_param.add_param(self, beam + '_targetbeams_amp_modelstats', selfcaltargetbeamsampmodelstats)
-        subs_param.add_param(self, beam + '_targetbeams_amp_imagestatus', selfcaltargetbeamsampimagestatus)
-        subs_param.add_param(self, beam + '_targetbeams_amp_imagestats', selfcaltargetbeamsampimagestats)
-        subs_param.add_param(self, beam + '_targetbeams_amp_residualstatus', selfcaltargetbeamsampresidualstatus)
-        subs_param.add_param(self, beam + '_targetbeams_amp_residualstats', selfcaltargetbeamsampresidualstats)
-        subs_param.add_param(self, beam + '_targetbeams_amp_maskthreshold', selfcaltargetbeamsampmaskthreshold)
-        subs_param.add_param(self, beam + '_targetbeams_amp_cleanthreshold', selfcaltargetbeamsampcleanthreshold)
-        subs_param.add_param(self, beam + '_targetbeams_amp_thresholdtype', selfcaltargetbeamsampthresholdtype)
-        subs_param.add_param(self, beam + '_targetbeams_amp_final_minorcycle', selfcaltargetbeamsampfinalminor)
+        with subs_param.param_batch(self):
+            subs_param.add_param(self, beam + '_targetbeams_amp_status', selfcaltargetbeamsampstatus)
+            subs_param.add_param(self, beam + '_targetbeams_amp_applystatus', selfcaltargetbeamsampapplystatus)
+            subs_param.add_param(self, beam + '_targetbeams_amp_mapstatus', selfcaltargetbeamsampmapstatus)
+            subs_param.add_param(self, beam + '_targetbeams_amp_mapstats', selfcaltargetbeamsampmapstats)
+            subs_param.add_param(self, beam + '_targetbeams_amp_beamstatus', selfcaltargetbeamsampbeamstatus)
+            subs_param.add_param(self, beam + '_targetbeams_amp_maskstatus', selfcaltargetbeamsampmaskstatus)
+            subs_param.add_param(self, beam + '_targetbeams_amp_maskstats', selfcaltargetbeamsampmaskstats)
+            subs_param.add_param(self, beam + '_targetbeams_amp_modelstatus', selfcaltargetbeamsampmodelstatus)
+            subs_param.add_param(self, beam + '_targetbeams_amp_modelstats', selfcaltargetbeamsampmodelstats)
+            subs_param.add_param(self, beam + '_targetbeams_amp_imagestatus', selfcaltargetbeamsampimagestatus)
+            subs_param.add_param(self, beam + '_targetbeams_amp_imagestats', selfcaltargetbeamsampimagestats)
+            subs_param.add_param(self, beam + '_targetbeams_amp_residualstatus', selfcaltargetbeamsampresidualstatus)
+            subs_param.add_param(self, beam + '_targetbeams_amp_residualstats', selfcaltargetbeamsampresidualstats)
+            subs_param.add_param(self, beam + '_targetbeams_amp_maskthreshold', selfcaltargetbeamsampmaskthreshold)
+            subs_param.add_param(self, beam + '_targetbeams_amp_cleanthreshold', selfcaltargetbeamsampcleanthreshold)
+            subs_param.add_param(self, beam + '_targetbeams_amp_thresholdtype', selfcaltargetbeamsampthresholdtype)
+            subs_param.add_param(self, beam + '_targetbeams_amp_final_minorcycle', selfcaltargetbeamsampfinalminor)
 
 
     def show(self, showall=False):
@@ -1393,6 +1550,7 @@ class scal(BaseModule):
         subs_param.del_param(self, beam + '_targetbeams_phase_thresholdtype')
         subs_param.del_param(self, beam + '_targetbeams_phase_final_majorcycle')
         subs_param.del_param(self, beam + '_targetbeams_phase_final_minorcycle')
+        subs_param.del_param(self, beam + '_targetbeams_phase_checkpoint')
         subs_param.del_param(self, beam + '_targetbeams_amp_status')
         subs_param.del_param(self, beam + '_targetbeams_amp_applystatus')
         subs_param.del_param(self, beam + '_targetbeams_amp_mapstatus')
@@ -1448,6 +1606,7 @@ class scal(BaseModule):
                 subs_param.del_param(self, beam + '_targetbeams_phase_thresholdtype')
                 subs_param.del_param(self, beam + '_targetbeams_phase_final_majorcycle')
                 subs_param.del_param(self, beam + '_targetbeams_phase_final_minorcycle')
+                subs_param.del_param(self, beam + '_targetbeams_phase_checkpoint')
                 subs_param.del_param(self, beam + '_targetbeams_amp_status')
                 subs_param.del_param(self, beam + '_targetbeams_amp_applystatus')
                 subs_param.del_param(self, beam + '_targetbeams_amp_mapstatus')
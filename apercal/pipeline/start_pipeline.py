@@ -44,7 +44,7 @@ def validate_taskid(taskid_from_autocal):
 
 
 def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=None, flip_ra=False,
-                           steps=None, configfilename=None):
+                           steps=None, configfilename=None, param_database=None, shell_pool=0):
     """
     Trigger the start of a fluxcal pipeline. Returns when pipeline is done.
     Example for taskid, name, beamnr: (190108926, '3C147_36', 36)
@@ -64,6 +64,10 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
         flip_ra (bool): flip RA (for old measurement sets where beamweights were flipped)
         steps (List[str]): list of steps to perform
         configfilename (List[str]): Custom configfile (should be full path for now)
+        param_database (str): Name of an SQLite database in basedir to keep the parameters of all
+                              steps and beams in, instead of separate param_*.npy files
+        shell_pool (int): Number of persistent shells per process to run shell commands (e.g. MIRIAD
+                          tasks) in, 0 (default) starts a new shell for every command
 
     Returns:
         Tuple[Dict[int, List[str]], str], str: Tuple of a dict, the formatted runtime, and possibly
@@ -224,6 +228,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
         """
 
         p.basedir = basedir
+        p.paramdatabase = param_database
         p.fluxcal = name_to_ms(name_fluxcal)
         p.polcal = name_to_ms(name_polcal)
         p.target = name_to_ms(name_target)
@@ -249,6 +254,10 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
     else:
         beamlist_target_for_config = beamlist_target
 
+    if shell_pool:
+        logger.info("Running shell commands in {} persistent shell(s) per process".format(shell_pool))
+        lib.enable_shell_pool(shell_pool)
+
     time_start = time()
     try:
         # =======
@@ -267,6 +276,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
             p0 = prepare(
                 file_=configfilename_list[beamlist_target_for_config.index(beamnr_fluxcal)])
             p0.basedir = basedir
+            p0.paramdatabase = param_database
             # set_files(p0)
             p0.prepare_flip_ra = flip_ra
             # the following two need to be empty strings for prepare
@@ -298,6 +308,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
                 p0 = prepare(
                     file_=configfilename_list[beamlist_target_for_config.index(beamnr_polcal)])
                 p0.basedir = basedir
+                p0.paramdatabase = param_database
                 # set_files(p0)
                 p0.prepare_flip_ra = flip_ra
                 # the following two need to be empty strings for prepare
@@ -328,6 +339,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
             p0 = prepare(
                 file_=configfilename_list[beamlist_target_for_config.index(beamnr)])
             p0.basedir = basedir
+            p0.paramdatabase = param_database
             # set_files(p0)
             p0.prepare_flip_ra = flip_ra
             # the following two need to be empty strings for prepare
@@ -490,6 +502,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
                     p1.paramfilename = 'param_{0:02d}_preflag_{1}.npy'.format(
                         beamnr, name_fluxcal.split('_')[0])
                     p1.basedir = basedir
+                    p1.paramdatabase = param_database
                     p1.fluxcal = ''
                     p1.polcal = ''
                     p1.target = name_to_ms(name_fluxcal)
@@ -538,6 +551,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
                 try:
                     p1 = preflag(filename=configfilename_list[beam_index])
                     p1.basedir = basedir
+                    p1.paramdatabase = param_database
                     p1.paramfilename = 'param_{0:02d}_preflag_{1}.npy'.format(
                         beamnr, name_polcal.split('_')[0])
                     p1.basedir = basedir
@@ -592,6 +606,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
                     p1.paramfilename = 'param_{0:02d}_preflag_{1}.npy'.format(
                         beamnr, name_target)
                     p1.basedir = basedir
+                    p1.paramdatabase = param_database
                     p1.fluxcal = ''
                     p1.polcal = ''
                     p1.target = name_to_ms(name_target)
@@ -791,6 +806,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
                     p4 = scal(file_=configfilename_list[beam_index])
                     p4.paramfilename = 'param_{:02d}.npy'.format(beamnr)
                     p4.basedir = basedir
+                    p4.paramdatabase = param_database
                     p4.beam = "{:02d}".format(beamnr)
                     p4.target = name_target + '.mir'
                     if "scal" in steps and not dry_run:
@@ -806,6 +822,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
                     p5 = continuum(file_=configfilename_list[beam_index])
                     p5.paramfilename = 'param_{:02d}.npy'.format(beamnr)
                     p5.basedir = basedir
+                    p5.paramdatabase = param_database
                     p5.beam = "{:02d}".format(beamnr)
                     p5.target = name_target + '.mir'
                     if "continuum" in steps and not dry_run:
@@ -821,6 +838,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
                     p6 = polarisation(file_=configfilename_list[beam_index])
                     p6.paramfilename = 'param_{:02d}.npy'.format(beamnr)
                     p6.basedir = basedir
+                    p6.paramdatabase = param_database
                     p6.beam = "{:02d}".format(beamnr)
                     p6.polcal = name_to_mir(name_polcal)
                     p6.target = name_to_mir(name_target)
@@ -872,6 +890,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
                         "Skipping line imaging for beam {}".format(beamnr))
                     continue
                 p7.basedir = basedir
+                p7.paramdatabase = param_database
                 p7.beam = "{:02d}".format(beamnr)
                 p7.paramfilename = 'param_{:02d}.npy'.format(beamnr)
                 p7.target = name_target + '.mir'
@@ -949,6 +968,7 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
                     p8 = transfer(file_=configfilename_list[beam_index])
                     p8.paramfilename = 'param_{:02d}.npy'.format(beamnr)
                     p8.basedir = basedir
+                    p8.paramdatabase = param_database
                     p8.target = name_target + '.mir'
                     p8.beam = "{:02d}".format(beamnr)
                     if "transfer" in steps and not dry_run:
@@ -1040,3 +1060,6 @@ def start_apercal_pipeline(targets, fluxcals, polcals, dry_run=False, basedir=No
             str(timedelta(seconds=time() - time_start))
         logger.exception(msg)
         return status, str(timedelta(seconds=time() - time_start)), str(e)
+    finally:
+        if shell_pool:
+            lib.disable_shell_pool()
@@ -36,50 +36,59 @@ def get_ratio_autocorrelation_above_limit(amp, amp_threshold):
     return ratio_vis_above_threshold
 
 
-def get_autocorr(msfile):
-    """
-    Gets the autocorrelation data from a dataset
-    msfile: Input dataset with the autocorrelations
+def get_autocorr_amplitudes(msfile, datacolumn='CORRECTED_DATA', chunksize=100):
     """
+    Reads the auto-correlations of all antennas in a single pass over the dataset and averages them over time
 
-    # get the list of channels
-    # then get frequencies:
-    taql_antnames = "SELECT NAME FROM {0}::ANTENNA".format(msfile)
-    t = pt.taql(taql_antnames)
-    ant_names = t.getcol("NAME")
-    if ant_names is None:
-        logger.warning(
-            "Something wrong. No antenna names. Continue with next beam")
+    msfile (str): Input dataset with the autocorrelations
+    datacolumn (str): Column to read the visibilities from
+    chunksize (int): Number of rows to read at once
+    returns (list, numpy array, numpy array): Antenna names, channel frequencies and the amplitude of the mean of the
+        unflagged auto-correlations for each antenna, channel and polarisation. Amplitudes without unflagged data are 0.
+    """
+    t = pt.table(msfile + '/ANTENNA', ack=False)
+    ant_names = t.getcol('NAME')
+    t.close()
 
-    taql_freq = "SELECT CHAN_FREQ FROM {0}::SPECTRAL_WINDOW".format(msfile)
-    t = pt.taql(taql_freq)
+    t = pt.table(msfile + '/SPECTRAL_WINDOW', ack=False)
     freqs = t.getcol('CHAN_FREQ')[0, :]
+    t.close()
+
+    t = pt.table(msfile + '/POLARIZATION', ack=False)
+    n_stokes = t.getcol('NUM_CORR')[0]
+    t.close()
+
+    # Sum and count the unflagged visibilities for each antenna
+    sums = np.zeros((len(ant_names), len(freqs), n_stokes), dtype=np.complex128)
+    counts = np.zeros((len(ant_names), len(freqs), n_stokes), dtype=np.int64)
+    t = pt.taql("SELECT ANTENNA1, {1}, FLAG FROM {0} WHERE ANTENNA1==ANTENNA2".format(msfile, datacolumn))
+    nrow = t.nrows()
+    for start in range(0, nrow, chunksize):
+        nchunk = min(chunksize, nrow - start)
+        ants = t.getcol('ANTENNA1', startrow=start, nrow=nchunk)
+        flags = t.getcol('FLAG', startrow=start, nrow=nchunk)
+        data = np.where(flags, 0, t.getcol(datacolumn, startrow=start, nrow=nchunk))
+        for ant in np.unique(ants):
+            rows = ants == ant
+            sums[ant] += data[rows].sum(axis=0)
+            counts[ant] += np.sum(~flags[rows], axis=0)
+    t.close()
+
+    amp_ant_array = np.zeros(sums.shape, dtype=np.float32)
+    good = counts > 0
+    amp_ant_array[good] = np.abs(sums[good] / counts[good])
+
+    return ant_names, freqs, amp_ant_array
 
-    # and number of stokes params
-    taql_stokes = "SELECT abs(DATA) AS amp from {0} limit 1".format(msfile)
-    t_pol = pt.taql(taql_stokes)
-    pol_array = t_pol.getcol('amp')
-    if pol_array is None:
-        logger.warning(
-            "Something wrong. No polarisation information. Continue with next beam")
-    n_stokes = pol_array.shape[2]  # shape is time, one, nstokes
 
-    # take MS file and get data
-    amp_ant_array = np.empty(
-        (len(ant_names), len(freqs), n_stokes), dtype=np.float32)
+def get_autocorr(msfile):
+    """
+    Gets the autocorrelation data from a dataset
+    msfile: Input dataset with the autocorrelations
+    """
 
-    # get autocorrelation
-    for ant in xrange(len(ant_names)):
-        try:
-            taql_command = ("SELECT abs(gmeans(CORRECTED_DATA[FLAG])) AS amp "
-                            "FROM {0} "
-                            "WHERE ANTENNA1==ANTENNA2 && (ANTENNA1={1} || ANTENNA2={1})").format(msfile, ant)
-            t = pt.taql(taql_command)
-            # phase_ant_array[ant, :, :] = t.getcol('phase')[0, :, :]
-            amp_ant_array[ant, :, :] = t.getcol('amp')[0, :, :]
-        except Exception as e:
-            amp_ant_array[ant, :, :] = np.full((len(freqs), n_stokes), np.nan)
-            logger.exception(e)
+    # read the autocorrelations of all antennas in one pass
+    ant_names, freqs, amp_ant_array = get_autocorr_amplitudes(msfile)
 
     # get XX and YY
     amp_xx = amp_ant_array[:, :, 0]
@@ -0,0 +1,126 @@
+"""
+Checkpoints of iterative steps. The outputs of each finished unit of work are fingerprinted with a hash of their
+content, so that a rerun can verify them and continue after the last valid unit. Calibration items of a MIRIAD dataset
+are copied aside after each calibration to restore the state of the dataset at a checkpoint.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+
+logger = logging.getLogger(__name__)
+
+# Items of a MIRIAD uv dataset written by selfcal, the header holds the number of solutions and the interval
+GAIN_ITEMS = ['header', 'gains', 'gainsf', 'freqs']
+
+
+def _update_hash(sha, path, blocksize=1048576):
+    with open(path, 'rb') as f:
+        block = f.read(blocksize)
+        while block:
+            sha.update(block)
+            block = f.read(blocksize)
+
+
+def get_output_hash(path):
+    """
+    Calculates a hash of the content of a MIRIAD dataset or a file
+
+    path (string): Path to the dataset or file
+    returns (string): The hash or None if the path does not exist
+    """
+    if os.path.isdir(path):
+        files = [os.path.join(path, item) for item in sorted(os.listdir(path)) if item != 'history']
+    elif os.path.isfile(path):
+        files = [path]
+    else:
+        return None
+    sha = hashlib.sha1()
+    for fl in files:
+        if os.path.isfile(fl):
+            sha.update(os.path.basename(fl).encode('ascii'))
+            _update_hash(sha, fl)
+    return sha.hexdigest()
+
+
+def get_items_hash(dataset, items=GAIN_ITEMS):
+    """
+    Calculates a hash of a set of items of a MIRIAD dataset, missing items are part of the hash
+
+    dataset (string): Path to the MIRIAD dataset
+    items (list): Names of the items
+    returns (string): The hash
+    """
+    sha = hashlib.sha1()
+    for item in items:
+        path = os.path.join(dataset, item)
+        sha.update(item.encode('ascii'))
+        if os.path.isfile(path):
+            _update_hash(sha, path)
+        else:
+            sha.update(b'\x00missing')
+    return sha.hexdigest()
+
+
+def save_items(dataset, checkpointdir, items=GAIN_ITEMS):
+    """
+    Copies a set of items of a MIRIAD dataset into a checkpoint directory, replacing its previous content
+
+    dataset (string): Path to the MIRIAD dataset
+    checkpointdir (string): Directory to copy the items to
+    items (list): Names of the items
+    returns (string): The hash of the items as calculated by get_items_hash
+    """
+    if os.path.isdir(checkpointdir):
+        shutil.rmtree(checkpointdir)
+    os.makedirs(checkpointdir)
+    for item in items:
+        path = os.path.join(dataset, item)
+        if os.path.isfile(path):
+            shutil.copy2(path, os.path.join(checkpointdir, item))
+    return get_items_hash(checkpointdir, items)
+
+
+def restore_items(dataset, checkpointdir, items=GAIN_ITEMS):
+    """
+    Restores a set of items of a MIRIAD dataset from a checkpoint directory. Items that are not in the checkpoint are
+    removed from the dataset.
+
+    dataset (string): Path to the MIRIAD dataset
+    checkpointdir (string): Directory with the items written by save_items
+    items (list): Names of the items
+    returns (string): The hash of the restored items
+    """
+    for item in items:
+        source = os.path.join(checkpointdir, item)
+        path = os.path.join(dataset, item)
+        if os.path.isfile(source):
+            shutil.copy2(source, path)
+        elif os.path.isfile(path):
+            os.remove(path)
+    logger.debug('Restored {0} of {1} from {2}'.format(', '.join(items), dataset, checkpointdir))
+    return get_items_hash(dataset, items)
+
+
+def get_config_hash(step, prefixes, datasets=()):
+    """
+    Calculates a hash of the configuration of a step and the state of its input datasets
+
+    step (object): The step with the configuration as attributes
+    prefixes (tuple): Prefixes of the names of the attributes to use
+    datasets (list): MIRIAD datasets, the size and modification time of their visibilities and flags are used
+    returns (string): The hash
+    """
+    sha = hashlib.sha1()
+    for name in sorted(dir(step)):
+        if name.startswith(prefixes):
+            value = getattr(step, name)
+            if not callable(value):
+                sha.update('{0}={1!r};'.format(name, value).encode('utf-8'))
+    for dataset in datasets:
+        for item in ['visdata', 'flags']:
+            path = os.path.join(dataset, item)
+            if os.path.isfile(path):
+                sha.update('{0}:{1}:{2!r};'.format(item, os.path.getsize(path), os.path.getmtime(path)).encode('utf-8'))
+    return sha.hexdigest()
@@ -1,17 +1,88 @@
-import astropy.io.fits as pyfits
 import numpy as np
 import os
-import random
-import string
 import logging
-from backports import tempfile
+from collections import OrderedDict
+
+import scipy.stats
 
-from apercal.libs import lib
 from apercal.subs import setinit
+from apercal.subs import mirio
 from apercal.exceptions import ApercalException
 
 logger = logging.getLogger(__name__)
 
+# Statistics of recently read images, keyed by the absolute path of the image
+STATS_CACHE_SIZE = 256
+_stats_cache = OrderedDict()
+
+
+def _get_image_signature(image):
+    """
+    Returns the modification time and size of the files holding the pixels of an image. For MIRIAD images this
+    includes the header and mask items, as the modification time of the dataset directory does not change when
+    the image is overwritten.
+    """
+    if os.path.isdir(image):
+        files = [os.path.join(image, item) for item in ('header', 'image', 'mask')]
+    else:
+        files = [image]
+    signature = []
+    for f in files:
+        if os.path.exists(f):
+            st = os.stat(f)
+            signature.append((st.st_mtime, st.st_size, st.st_ino))
+        else:
+            signature.append(None)
+    return tuple(signature)
+
+
+def _calc_stats(data):
+    """
+    Calculates the statistics of an array of pixels
+    """
+    valid = data[~np.isnan(data)]
+    stats = {'count': valid.size, 'nonzero': np.count_nonzero(data), 'sum': np.sum(data), 'nansum': np.sum(valid)}
+    if valid.size > 0:
+        stats['min'] = np.min(valid)
+        stats['max'] = np.max(valid)
+        stats['std'] = np.std(valid)
+    else:
+        stats['min'] = stats['max'] = stats['std'] = np.nan
+    return stats
+
+
+def getstats(image, selection='all', pvalue=False):
+    """
+    Returns the statistics of an image. The pixels are only read if the image changed since the statistics were last
+    calculated, then the statistics for all selections are calculated at once.
+    image (string): The path to the image in MIRIAD or FITS format
+    selection (string): 'all' for the full image, 'plane' for the first plane (first Stokes parameter and channel)
+        or 'chan0' for all Stokes parameters of the first channel
+    pvalue (bool): Also calculate the p-value of the test for a normal distribution of the first plane
+    returns (dict): The min, max, std, count (number of pixels that are not NaN), nonzero (number of pixels that are
+        not 0), sum, nansum (sum ignoring NaNs) and, if requested, pvalue of the selection and the shape of the image
+    """
+    key = os.path.abspath(image)
+    signature = _get_image_signature(image)
+    entry = _stats_cache.get(key)
+    if entry is None or entry['signature'] != signature or (pvalue and 'pvalue' not in entry):
+        data = mirio.getimagedata(image)
+        entry = {'signature': signature, 'shape': data.shape, 'all': _calc_stats(data)}
+        if data.ndim >= 4:
+            entry['plane'] = _calc_stats(data[0, 0])
+            entry['chan0'] = _calc_stats(data[:, 0])
+        if pvalue:
+            entry['pvalue'] = scipy.stats.normaltest(data[0][0], nan_policy='omit', axis=None)[1]
+    _stats_cache.pop(key, None)
+    _stats_cache[key] = entry
+    while len(_stats_cache) > STATS_CACHE_SIZE:
+        _stats_cache.popitem(last=False)
+    stats = dict(entry[selection])
+    stats['shape'] = entry['shape']
+    if pvalue:
+        stats['pvalue'] = entry['pvalue']
+    return stats
+
 
 def getimagestats(self, image):
     """
@@ -20,35 +91,14 @@ def getimagestats(self, image):
     returns (numpy array): The min, max and rms of the image
     """
     setinit.setinitdirs(self)
-    char_set = string.ascii_uppercase + string.digits
     if os.path.isdir(image) or os.path.isfile(image):
-        if os.path.isdir(image):
-            temp_string = ''.join(random.sample(char_set * 8, 8))
-            fits = lib.miriad('fits')
-            fits.op = 'xyout'
-            fits.in_ = image
-            with tempfile.TemporaryDirectory() as tempdir:
-                fits.out = tempdir + '/' + temp_string + '.fits'
-                fits.go()
-                image_data = pyfits.open(tempdir + '/' + temp_string + '.fits')
-        elif os.path.isfile(image):
-            image_data = pyfits.open(image)
-        else:
-            error = 'Image format not supported. Only MIRIAD and FITS formats are supported!'
-            logger.error(error)
-            raise ApercalException(error)
-
-        data = image_data[0].data
+        stats = getstats(image)
+        if stats['shape'][-3] == 2:
+            stats = getstats(image, 'plane')
         imagestats = np.full(3, np.nan)
-        if data.shape[-3] == 2:
-            imagestats[0] = np.nanmin(data[0,0,:,:])  # Get the maxmimum of the image
-            imagestats[1] = np.nanmax(data[0,0,:,:])  # Get the minimum of the image
-            imagestats[2] = np.nanstd(data[0,0,:,:])  # Get the standard deviation
-        else:
-            imagestats[0] = np.nanmin(data)  # Get the maxmimum of the image
-            imagestats[1] = np.nanmax(data)  # Get the minimum of the image
-            imagestats[2] = np.nanstd(data)  # Get the standard deviation
-        image_data.close()  # Close the image
+        imagestats[0] = stats['min']  # Get the maxmimum of the image
+        imagestats[1] = stats['max']  # Get the minimum of the image
+        imagestats[2] = stats['std']  # Get the standard deviation
     else:
         error = 'Image does not seem to exist!'
         logger.error(error)
@@ -65,29 +115,10 @@ def getmaskstats(self, image, size):
     returns (numpy array): The number of pixels and their percentage of the full image
     """
     setinit.setinitdirs(self)
-    char_set = string.ascii_uppercase + string.digits
     if os.path.isdir(image) or os.path.isfile(image):
-        if os.path.isdir(image):
-            temp_string = ''.join(random.sample(char_set * 8, 8))
-            fits = lib.miriad('fits')
-            fits.op = 'xyout'
-            fits.in_ = image
-            with tempfile.TemporaryDirectory() as tempdir:
-                fits.out = tempdir + '/' + temp_string + '.fits'
-                fits.go()
-                mask_data = pyfits.open(tempdir + '/' + temp_string + '.fits')
-        elif os.path.isfile(image):
-            mask_data = pyfits.open(image)
-        else:
-            error = 'Image format not supported. Only MIRIAD and FITS formats are supported!'
-            logger.error(error)
-            raise ApercalException(error)
-
-        data = mask_data[0].data
         maskstats = np.full(2, np.nan)
-        maskstats[0] = np.count_nonzero(~np.isnan(data))
+        maskstats[0] = getstats(image)['count']
         maskstats[1] = maskstats[0]/(size**2)
-        mask_data.close()
     else:
         error = 'Image does not seem to exist!'
         logger.error(error)
@@ -103,29 +134,11 @@ def getmodelstats(self, image):
     returns (numpy array): The number of pixels with clean components and their summed flux in Jy
     """
     setinit.setinitdirs(self)
-    char_set = string.ascii_uppercase + string.digits
     if os.path.isdir(image) or os.path.isfile(image):
-        if os.path.isdir(image):
-            temp_string = ''.join(random.sample(char_set * 8, 8))
-            fits = lib.miriad('fits')
-            fits.op = 'xyout'
-            fits.in_ = image
-            with tempfile.TemporaryDirectory() as tempdir:
-                fits.out = tempdir + '/' + temp_string + '.fits'
-                fits.go()
-                model_data = pyfits.open(tempdir + '/' + temp_string + '.fits')
-        elif os.path.isfile(image):
-            model_data = pyfits.open(image)
-        else:
-            error = 'Image format not supported. Only MIRIAD and FITS formats are supported!'
-            logger.error(error)
-            raise ApercalException(error)
-
-        data = model_data[0].data[:,0,:,:]
+        stats = getstats(image, 'chan0')
         modelstats = np.full(2, np.nan)
-        modelstats[0] = np.count_nonzero(data)
-        modelstats[1] = np.sum(data)
-        model_data.close()
+        modelstats[0] = stats['nonzero']
+        modelstats[1] = stats['sum']
     else:
         error = 'Image does not seem to exist!'
         logger.error(error)
@@ -141,30 +154,12 @@ def getcubestats(self, cube):
     returns (numpy array): The min, max and rms of the image
     """
     setinit.setinitdirs(self)
-    char_set = string.ascii_uppercase + string.digits
     if os.path.isdir(cube) or os.path.isfile(cube):
-        if os.path.isdir(cube):
-            temp_string = ''.join(random.sample(char_set * 8, 8))
-            fits = lib.miriad('fits')
-            fits.op = 'xyout'
-            fits.in_ = cube
-            with tempfile.TemporaryDirectory() as tempdir:
-                fits.out = tempdir + '/' + temp_string + '.fits'
-                fits.go()
-                cube_data = pyfits.open(tempdir + '/' + temp_string + '.fits')
-        elif os.path.isfile(cube):
-            cube_data = pyfits.open(cube)
-        else:
-            error = 'Image format not supported. Only MIRIAD and FITS formats are supported!'
-            logger.error(error)
-            raise ApercalException(error)
-
-        data = cube_data[0].data
+        data = mirio.getimagedata(cube)
         cubestats = np.full((3,data.shape[1]), np.nan)
         cubestats[0] = np.nanmin(data, axis=(0, 2, 3))  # Get the maxmimum of the image
         cubestats[1] = np.nanmax(data, axis=(0, 2, 3))  # Get the minimum of the image
         cubestats[2] = np.nanstd(data, axis=(0, 2, 3))  # Get the standard deviation
-        cube_data.close()  # Close the image
     else:
         error = 'Image does not seem to exist!'
         logger.error(error)
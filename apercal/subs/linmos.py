@@ -0,0 +1,420 @@
+"""
+Linear mosaicking of regridded beam images in memory. For every pixel the mosaic is
+
+    mosaic = sum_ij(B_i C^-1_ij I_j) / sum_ij(B_i C^-1_ij B_j)
+
+with B the primary beam maps, I the images and C^-1 the inverse noise covariance matrix of the beams. This computes
+the same products as the chain of maths calls in the mosaic module, but reads every input only once and processes the
+images in tiles of rows to limit the memory use.
+
+The images can also be convolved to the common beam and reprojected onto the mosaic grid in memory (convolve_to_beam
+and ReprojectedImage) instead of writing regridded and convolved images with regrid and convol. The common beam itself
+is determined from the image headers with get_common_beam.
+"""
+
+import logging
+import os
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import scipy.ndimage
+import scipy.optimize
+
+from apercal.exceptions import ApercalException
+from apercal.subs import mirio
+
+logger = logging.getLogger(__name__)
+
+
+# Conversion from full width at half maximum to the standard deviation of a Gaussian
+FWHM_TO_SIGMA = 1. / np.sqrt(8. * np.log(2.))
+
+
+def _beam_covariance(bmaj, bmin, bpa):
+    """
+    Returns the covariance matrix of a Gaussian beam in (east, north) sky coordinates
+
+    bmaj (float): Major axis FWHM
+    bmin (float): Minor axis FWHM
+    bpa (float): Position angle of the major axis from north through east in degrees
+    """
+    pa = np.radians(bpa)
+    major = np.array([np.sin(pa), np.cos(pa)])
+    minor = np.array([np.cos(pa), -np.sin(pa)])
+    return ((bmaj * FWHM_TO_SIGMA) ** 2 * np.outer(major, major) +
+            (bmin * FWHM_TO_SIGMA) ** 2 * np.outer(minor, minor))
+
+
+def convolve_to_beam(data, cdelt, beam, target_beam):
+    """
+    Convolves an image with a Gaussian beam to a larger target beam using FFTs, like convol options=final. The result
+    is scaled to Jy per target beam. Blanked pixels are treated as zero and stay blanked.
+
+    data (numpy array): Image plane with NaN for blanked pixels
+    cdelt (tuple): Pixel increments of the x and y axis in arcsec
+    beam (tuple): bmaj and bmin in arcsec and bpa in degrees of the image
+    target_beam (tuple): bmaj and bmin in arcsec and bpa in degrees of the target beam
+    returns (numpy array): The convolved image
+    """
+    kernel = _beam_covariance(*target_beam) - _beam_covariance(*beam)
+    eigenvalues = np.linalg.eigvalsh(kernel)
+    if eigenvalues[0] < -1.e-6 * eigenvalues[-1]:
+        raise ApercalException('Target beam {0} is smaller than the beam {1} of the image'.format(
+            target_beam, beam))
+    # Covariance of the convolution kernel in pixels
+    scale = np.diag([1. / cdelt[0], 1. / cdelt[1]])
+    kernel = scale.dot(kernel).dot(scale)
+
+    blanked = ~np.isfinite(data)
+    ny, nx = data.shape
+    # Pad the image to avoid wrapping around, the kernel is negligible after five standard deviations
+    pad = int(np.ceil(5. * np.sqrt(max(np.max(np.diag(kernel)), 0.))))
+    fy, fx = ny + 2 * pad, nx + 2 * pad
+    padded = np.zeros((fy, fx), dtype=np.float64)
+    padded[pad:pad + ny, pad:pad + nx] = np.where(blanked, 0., data)
+    # The Fourier transform of a normalised Gaussian with covariance K is exp(-2 pi^2 k^T K k)
+    ky = np.fft.fftfreq(fy)[:, np.newaxis]
+    kx = np.fft.rfftfreq(fx)[np.newaxis, :]
+    transfer = np.exp(-2. * np.pi ** 2 * (kernel[0, 0] * kx ** 2 + 2. * kernel[0, 1] * kx * ky + kernel[1, 1] * ky ** 2))
+    convolved = np.fft.irfft2(np.fft.rfft2(padded) * transfer, s=(fy, fx))[pad:pad + ny, pad:pad + nx]
+    # Jy/beam of the image to Jy/beam of the target beam
+    convolved *= (target_beam[0] * target_beam[1]) / (beam[0] * beam[1])
+    convolved[blanked] = np.nan
+    return convolved.astype(np.float32)
+
+
+def _beam_from_covariance(covariance):
+    """
+    Returns bmaj, bmin and bpa in degrees of a Gaussian beam with a covariance matrix in (east, north) coordinates
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+    bmaj = np.sqrt(max(eigenvalues[1], 0.)) / FWHM_TO_SIGMA
+    bmin = np.sqrt(max(eigenvalues[0], 0.)) / FWHM_TO_SIGMA
+    bpa = np.degrees(np.arctan2(eigenvectors[0, 1], eigenvectors[1, 1]))
+    # position angles are only defined from -90 to 90 degrees
+    bpa = (bpa + 90.) % 180. - 90.
+    return bmaj, bmin, bpa
+
+
+def _enclosing_factor(covariance, beam_covariances):
+    """
+    Returns the factor by which a beam has to be scaled in area to be larger than all beams in every direction
+    """
+    # largest generalised eigenvalue of each beam with respect to the common beam
+    whiten = np.linalg.inv(np.linalg.cholesky(covariance))
+    return max(np.linalg.eigvalsh(whiten.dot(c).dot(whiten.T))[-1] for c in beam_covariances)
+
+
+def common_beam(beams, circular=False):
+    """
+    Determines the smallest Gaussian beam to which all beams can be convolved, i.e. the beam of the smallest area
+    that every beam can be deconvolved from. This is the maximum of the major axes for a circular beam. Otherwise, the
+    inverse covariance matrix P of the common beam maximises log(det(P)) with P_i - P positive semi-definite for the
+    inverse covariance matrices P_i of all beams.
+
+    beams (list): bmaj and bmin in arcsec and bpa in degrees of each beam, NaN for unknown beams
+    circular (bool): Determine the smallest circular beam
+    returns (tuple): bmaj and bmin in arcsec and bpa in degrees of the common beam
+    """
+    beams = np.array(beams, dtype=np.float64).reshape(-1, 3)
+    beams = beams[np.all(np.isfinite(beams), axis=1)]
+    if len(beams) == 0:
+        raise ApercalException('No valid beams to determine a common beam from')
+    if circular:
+        bmaj = float(np.max(beams[:, :2]))
+        return bmaj, bmaj, 0.
+
+    # work in units of the largest beam
+    scale = float(np.max(beams[:, :2]))
+    covariances = [_beam_covariance(bmaj / scale, bmin / scale, bpa) for bmaj, bmin, bpa in beams]
+
+    # one of the beams may already contain all other beams
+    largest = int(np.argmax(beams[:, 0] * beams[:, 1]))
+    if _enclosing_factor(covariances[largest], covariances) <= 1. + 1.e-9:
+        return tuple(float(x) for x in beams[largest])
+
+    precisions = [np.linalg.inv(c) for c in covariances]
+
+    def to_matrix(x):
+        return np.array([[x[0], x[1]], [x[1], x[2]]])
+
+    def objective(x):
+        det = x[0] * x[2] - x[1] ** 2
+        return -np.log(det) if det > 0. else 1.e10
+
+    # a 2x2 matrix is positive semi-definite if its trace and determinant are not negative
+    constraints = []
+    for precision in precisions:
+        constraints.append({'type': 'ineq', 'fun': lambda x, p=precision: np.trace(p - to_matrix(x))})
+        constraints.append({'type': 'ineq', 'fun': lambda x, p=precision: np.linalg.det(p - to_matrix(x))})
+
+    # the smallest circular beam is a valid starting point
+    start = 0.999 / max(np.linalg.eigvalsh(c)[-1] for c in covariances)
+    result = scipy.optimize.minimize(objective, [start, 0., start], method='SLSQP', constraints=constraints,
+                                     options={'ftol': 1.e-12, 'maxiter': 200})
+    covariance = np.linalg.inv(to_matrix(result.x))
+    if not result.success or np.any(np.linalg.eigvalsh(covariance) <= 0.):
+        logger.warning("Could not determine the smallest common beam ({}), using the smallest circular beam".format(
+            result.message))
+        return common_beam(beams, circular=True)
+    # make sure the common beam is not smaller than any beam after the numerical optimisation
+    covariance *= max(_enclosing_factor(covariance, covariances), 1.)
+    bmaj, bmin, bpa = _beam_from_covariance(covariance)
+    return float(scale * bmaj), float(scale * bmin), float(bpa)
+
+
+# Common beams of sets of images, the key includes the modification time of the images
+_common_beam_cache = {}
+
+
+def get_common_beam(images, circular=False, margin=1.05, nworkers=1):
+    """
+    Reads the beams of a set of MIRIAD or FITS images from their headers and determines the common beam with
+    common_beam. The result is cached for each set of images as long as none of the images changes.
+
+    images (list): Paths to the images
+    circular (bool): Determine a circular beam
+    margin (float): Factor to scale the axes of the common beam with, so that all images can be convolved to it
+    nworkers (int): Number of headers read at the same time
+    returns (tuple): bmaj and bmin in arcsec and bpa in degrees of the common beam
+    """
+    def modification_time(image):
+        item = os.path.join(image, 'header')
+        return os.path.getmtime(item if os.path.isfile(item) else image)
+
+    key = (tuple((os.path.abspath(image), modification_time(image)) for image in images), bool(circular), margin)
+    if key in _common_beam_cache:
+        logger.debug("Using cached common beam of {} images".format(len(images)))
+        return _common_beam_cache[key]
+
+    if nworkers > 1 and len(images) > 1:
+        pool = ThreadPool(min(nworkers, len(images)))
+        try:
+            beams = pool.map(mirio.getbeam, images)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        beams = [mirio.getbeam(image) for image in images]
+
+    bmaj, bmin, bpa = common_beam(beams, circular=circular)
+    result = (margin * bmaj, margin * bmin, bpa)
+    _common_beam_cache[key] = result
+    return result
+
+
+class ReprojectedImage(object):
+    """
+    An image that is reprojected onto the mosaic grid when its pixels are read. Pixels are interpolated bilinearly,
+    pixels more than half a pixel outside of the image or next to blanked pixels are NaN.
+
+    data (numpy array): Image plane, for example a memory mapped array
+    wcs (astropy WCS): Celestial coordinate system of the image
+    template_wcs (astropy WCS): Celestial coordinate system of the mosaic grid
+    template_shape (tuple): Shape of the mosaic grid in FITS order
+    """
+
+    def __init__(self, data, wcs, template_wcs, template_shape):
+        self.data = data
+        self.wcs = wcs
+        self.template_wcs = template_wcs
+        self.shape = tuple(template_shape)
+
+    def read(self, ymin, ymax, xmin, xmax):
+        """
+        Returns the pixels of the mosaic grid in a box
+
+        returns (numpy array): Reprojected pixels with shape (ymax - ymin, xmax - xmin)
+        """
+        y, x = np.mgrid[ymin:ymax, xmin:xmax]
+        lon, lat = self.template_wcs.wcs_pix2world(x.ravel(), y.ravel(), 0)
+        sx, sy = self.wcs.wcs_world2pix(lon, lat, 0)
+        ny, nx = self.data.shape
+        outside = ~(np.isfinite(sx) & np.isfinite(sy))
+        outside[~outside] = (sx[~outside] < -0.5) | (sx[~outside] > nx - 0.5) | (sy[~outside] < -0.5) | (
+            sy[~outside] > ny - 0.5)
+        sx[outside] = 0.
+        sy[outside] = 0.
+        values = scipy.ndimage.map_coordinates(self.data, [sy, sx], order=1, mode='nearest')
+        values[outside] = np.nan
+        return values.reshape(ymax - ymin, xmax - xmin).astype(np.float32)
+
+    def footprint(self):
+        """
+        Determines the bounding box of the image on the mosaic grid from the edges of the image
+
+        returns (tuple): (ymin, ymax, xmin, xmax) like footprint or None if the image is outside of the mosaic
+        """
+        ny, nx = self.data.shape
+        edge_x = np.arange(nx, dtype=np.float64)
+        edge_y = np.arange(ny, dtype=np.float64)
+        x = np.concatenate([edge_x, edge_x, np.zeros(ny), np.full(ny, nx - 1.)])
+        y = np.concatenate([np.zeros(nx), np.full(nx, ny - 1.), edge_y, edge_y])
+        lon, lat = self.wcs.wcs_pix2world(x, y, 0)
+        tx, ty = self.template_wcs.wcs_world2pix(lon, lat, 0)
+        valid = np.isfinite(tx) & np.isfinite(ty)
+        if not valid.any():
+            return None
+        box = (max(int(np.floor(ty[valid].min())), 0), min(int(np.ceil(ty[valid].max())) + 1, self.shape[-2]),
+               max(int(np.floor(tx[valid].min())), 0), min(int(np.ceil(tx[valid].max())) + 1, self.shape[-1]))
+        if box[0] >= box[1] or box[2] >= box[3]:
+            return None
+        return box
+
+
+def _read_box(image, header, start, stop, box):
+    """
+    Reads the rows of an image within the columns of its footprint with NaN replaced by zero like maths options=unmask
+    """
+    if isinstance(image, ReprojectedImage):
+        ny = image.shape[-2]
+        data = image.read(start % ny, (stop - 1) % ny + 1, box[2], box[3])
+    else:
+        data = mirio.readrows(image, start, stop, header=header, columns=(box[2], box[3]))
+    data[~np.isfinite(data)] = 0.
+    return data
+
+
+def footprint(image, tile_rows=256):
+    """
+    Determines the bounding box of the pixels with a finite non-zero value in any plane of a MIRIAD image
+
+    image (string): Path to the MIRIAD image
+    tile_rows (int): Number of rows read at once
+    returns (tuple): First and last plus one row and column of the box (ymin, ymax, xmin, xmax) or None if the image
+        has no valid pixels
+    """
+    header = mirio.readheader(image)
+    shape = mirio.getshape(header)
+    ny, nx = shape[-2], shape[-1]
+    nrows = int(np.prod(shape)) // nx
+    valid_rows = np.zeros(ny, dtype=bool)
+    valid_columns = np.zeros(nx, dtype=bool)
+    for start in range(0, nrows, tile_rows):
+        data = mirio.readrows(image, start, start + tile_rows, header=header)
+        valid = np.isfinite(data) & (data != 0.)
+        valid_rows[np.arange(start, start + len(data))[valid.any(axis=1)] % ny] = True
+        valid_columns |= valid.any(axis=0)
+    if not valid_rows.any():
+        return None
+    rows = np.flatnonzero(valid_rows)
+    columns = np.flatnonzero(valid_columns)
+    return int(rows[0]), int(rows[-1]) + 1, int(columns[0]), int(columns[-1]) + 1
+
+
+def overlaps(box1, box2):
+    """
+    Checks if two bounding boxes returned by footprint overlap
+
+    returns (bool): True if the boxes share at least one pixel
+    """
+    if box1 is None or box2 is None:
+        return False
+    return box1[0] < box2[1] and box2[0] < box1[1] and box1[2] < box2[3] and box2[2] < box1[3]
+
+
+def combine(beam_maps, image_maps, inv_cov, variance_map, numerator_map, tile_rows=64, beam_footprints=None,
+            image_footprints=None, regions=None):
+    """
+    Calculates the variance map and the weighted sum of the images of a linear mosaic. Only beams with a non-zero
+    coefficient in the inverse covariance matrix and a footprint in the same tile are combined and every image is only
+    read within its footprint, so the cost scales with the number of overlapping beam pairs and the sky area of each
+    beam instead of the size of the mosaic. A dense inverse covariance matrix (e.g. the ASKAP based correlation matrix)
+    has no zero coefficients to skip, only the footprints limit the work then.
+
+    beam_maps (list): Paths to the regridded beam maps in MIRIAD format, one for every beam
+    image_maps (list): Paths to the regridded and convolved images in MIRIAD format or ReprojectedImage objects in the
+        same order as beam_maps
+    inv_cov (numpy array): Inverse covariance matrix of the beams, same order as beam_maps
+    variance_map (string): Path of the output variance map, sum_ij(B_i C^-1_ij B_j)
+    numerator_map (string): Path of the output weighted image sum, sum_ij(B_i C^-1_ij I_j)
+    tile_rows (int): Number of image rows processed at once
+    beam_footprints (list): Footprints of the beam maps as returned by footprint, determined from the maps if None
+    image_footprints (list): Footprints of the images as returned by footprint, determined from the images if None
+    regions (list): Boxes (ymin, ymax, xmin, xmax) to recompute in the existing variance and numerator maps, which are
+        updated in place. The whole maps are created if None
+    """
+    inv_cov = np.asarray(inv_cov, dtype=np.float64)
+    nbeams = len(beam_maps)
+    if len(image_maps) != nbeams or inv_cov.shape != (nbeams, nbeams):
+        raise ApercalException('Number of beam maps, images and size of the covariance matrix do not match')
+
+    beam_headers = [mirio.readheader(image) for image in beam_maps]
+    image_headers = [None if isinstance(image, ReprojectedImage) else mirio.readheader(image) for image in image_maps]
+    shape = mirio.getshape(beam_headers[0])
+    for image, header in zip(beam_maps + image_maps, beam_headers + image_headers):
+        image_shape = image.shape if header is None else mirio.getshape(header)
+        if image_shape[-2:] != shape[-2:] or (header is not None and image_shape != shape):
+            raise ApercalException('Image {0} does not have the same shape as the other mosaic inputs'.format(image))
+    if beam_footprints is None:
+        beam_footprints = [footprint(image) for image in beam_maps]
+    if image_footprints is None:
+        image_footprints = [image.footprint() if isinstance(image, ReprojectedImage) else footprint(image)
+                            for image in image_maps]
+
+    # Beams contributing to the weights of each beam
+    coupled = [np.flatnonzero(inv_cov[:, j]) for j in range(nbeams)]
+    logger.debug("Inverse covariance matrix has {0} non-zero entries out of {1}".format(
+        sum(len(c) for c in coupled), nbeams * nbeams))
+
+    ny, nx = shape[-2], shape[-1]
+    nplanes = int(np.prod(shape)) // (nx * ny)
+    tile_rows = max(int(tile_rows), 1)
+    logger.debug("Combining {0} beams with {1} planes of {2}x{3} pixels in tiles of {4} rows".format(
+        nbeams, nplanes, nx, ny, tile_rows))
+
+    if regions is None:
+        variance = mirio.createimage(variance_map, beam_maps[0])
+        numerator = mirio.createimage(numerator_map, beam_maps[0] if image_headers[0] is None else image_maps[0])
+        regions = [(0, ny, 0, nx)]
+    else:
+        variance = mirio.openimage(variance_map)
+        numerator = mirio.openimage(numerator_map)
+        if variance.shape != tuple(shape) or numerator.shape != tuple(shape):
+            raise ApercalException('Existing mosaic maps do not have the same shape as the mosaic inputs')
+        regions = [region for region in regions if region is not None]
+        logger.debug("Updating {0} regions of the mosaic maps".format(len(regions)))
+    variance_planes = variance.reshape(nplanes, ny, nx)
+    numerator_planes = numerator.reshape(nplanes, ny, nx)
+    for region in regions:
+        ry1, ry2 = max(int(region[0]), 0), min(int(region[1]), ny)
+        rx1, rx2 = max(int(region[2]), 0), min(int(region[3]), nx)
+        for plane in range(nplanes):
+            for ymin in range(ry1, ry2, tile_rows):
+                ymax = min(ymin + tile_rows, ry2)
+                start, stop = plane * ny + ymin, plane * ny + ymax
+                tile = (ymin, ymax, rx1, rx2)
+                # Only read the beams covering this tile
+                beams = {}
+                for i in range(nbeams):
+                    if overlaps(beam_footprints[i], tile):
+                        beams[i] = _read_box(beam_maps[i], beam_headers[i], start, stop, beam_footprints[i])
+                variance_tile = np.zeros((ymax - ymin, nx), dtype=np.float64)
+                numerator_tile = np.zeros((ymax - ymin, nx), dtype=np.float64)
+                for j in range(nbeams):
+                    terms = [i for i in coupled[j] if i in beams]
+                    if len(terms) == 0:
+                        continue
+                    # Column j of the transpose of the beam matrix multiplied by the inverse covariance matrix, only
+                    # within the columns covered by the contributing beams
+                    xmin = min(beam_footprints[i][2] for i in terms)
+                    xmax = max(beam_footprints[i][3] for i in terms)
+                    btci = np.zeros((ymax - ymin, xmax - xmin), dtype=np.float64)
+                    for i in terms:
+                        box = beam_footprints[i]
+                        btci[:, box[2] - xmin:box[3] - xmin] += inv_cov[i, j] * beams[i]
+                    if j in beams:
+                        box = beam_footprints[j]
+                        x1, x2 = max(xmin, box[2]), min(xmax, box[3])
+                        if x1 < x2:
+                            variance_tile[:, x1:x2] += btci[:, x1 - xmin:x2 - xmin] * beams[j][:, x1 - box[2]:x2 - box[2]]
+                    box = image_footprints[j]
+                    if overlaps(box, tile):
+                        x1, x2 = max(xmin, box[2], rx1), min(xmax, box[3], rx2)
+                        if x1 < x2:
+                            image = _read_box(image_maps[j], image_headers[j], start, stop, (None, None, x1, x2))
+                            numerator_tile[:, x1:x2] += btci[:, x1 - xmin:x2 - xmin] * image
+                variance_planes[plane, ymin:ymax, rx1:rx2] = variance_tile[:, rx1:rx2]
+                numerator_planes[plane, ymin:ymax, rx1:rx2] = numerator_tile[:, rx1:rx2]
+    mirio.closeimage(variance_map, variance)
+    mirio.closeimage(numerator_map, numerator)
@@ -1,14 +1,18 @@
 import os
 import logging
 import numpy as np
+import aipy
 import bdsf
 import astropy.io.fits as pyfits
+from scipy import ndimage
+from scipy import stats
 
 from apercal.libs import lib
 from apercal.subs import imstats
 from apercal.subs import managefiles
 from apercal.subs import convim
 from apercal.subs import qa
+from apercal.subs import mirio
 from apercal.exceptions import ApercalException
 
 logger = logging.getLogger(__name__)
@@ -90,11 +94,134 @@ def calc_dr_amp(drstart, dr0, minorcycles, function_):
     return dr_min
 
 
-def get_theoretical_noise(self, dataset, gausslimit, startchan=None, endchan=None):
+# Theoretical noise and gaussianity of datasets, the key includes the modification time of the visibilities and flags
+_noise_cache = {}
+
+# MIRIAD polarisation codes of the cross hands of linear feeds
+POL_XY = -7
+POL_YX = -8
+
+
+def get_theoretical_noise(self, dataset, gausslimit, startchan=None, endchan=None, engine='image'):
+    """
+    Subroutine to measure the noise in Stokes V, which should be similar to the theoretical one. The result is cached
+    for each dataset and channel range as long as the visibilities and flags do not change.
+    dataset (string): The path to the dataset file.
+    gausslimit (float): The p-value limit of the gaussianity test
+    startchan(int): First channel to use for imaging, zero-based
+    endchan(int): Last channel to use for imaging, zero-based
+    engine (string): 'image' to measure the noise in a Stokes V image or 'visibility' to estimate it from the Stokes V
+                     visibilities without imaging
+    returns (numpy array): The gaussianity of Stokes V and its rms
+    """
+    def modification_time(item):
+        path = os.path.join(dataset, item)
+        return os.path.getmtime(path) if os.path.isfile(path) else None
+
+    # Both engines use all channels unless a start and an end channel are given
+    if startchan is None or endchan is None:
+        startchan, endchan = None, None
+    key = (os.path.abspath(dataset), modification_time('visdata'), modification_time('flags'), modification_time('gains'),
+           startchan, endchan, gausslimit, engine)
+    if key in _noise_cache:
+        logger.debug('Using cached theoretical noise of {0}'.format(dataset))
+        return _noise_cache[key]
+    if engine == 'image':
+        result = get_theoretical_noise_image(self, dataset, gausslimit, startchan=startchan, endchan=endchan)
+    elif engine == 'visibility':
+        result = get_theoretical_noise_vis(self, dataset, gausslimit, startchan=startchan, endchan=endchan)
+    else:
+        raise ApercalException('Noise engine {0} not supported! Use image or visibility!'.format(engine))
+    _noise_cache[key] = result
+    return result
+
+
+def get_theoretical_noise_vis(self, dataset, gausslimit, startchan=None, endchan=None, imsize=1024, cell=5, robust=-2,
+                              maxsamples=100000):
+    """
+    Estimates the noise of a Stokes V image from the Stokes V visibilities in a single pass over the dataset. Stokes V is
+    formed from the XY and YX correlations and assumed to contain only noise. The squared Stokes V values are gridded
+    together with the number of visibilities in each uv-cell of an image with the given size and cell size, which gives
+    the noise for robust weighting without imaging. The gaussianity test is done on a sample of the Stokes V values.
+    Calibration tables of the dataset are not applied.
+    dataset (string): The path to the dataset file.
+    gausslimit (float): The p-value limit of the gaussianity test
+    startchan(int): First channel to use, zero-based, all channels are used if startchan or endchan is None
+    endchan(int): Last channel to use, zero-based
+    imsize (int): Image size in pixels the noise is estimated for
+    cell (float): Cell size in arcseconds the noise is estimated for
+    robust (float): Robust weighting the noise is estimated for
+    maxsamples (int): Maximum number of Stokes V values used for the gaussianity test
+    returns (numpy array): The gaussianity of Stokes V and its rms
+    """
+    uv = aipy.miriad.UV(dataset)
+    uv.select('auto', 0, 0, include=False)
+    # Frequencies of the channels of all spectral windows
+    sfreq, sdf, nschan = np.atleast_1d(uv['sfreq']), np.atleast_1d(uv['sdf']), np.atleast_1d(uv['nschan'])
+    freqs = np.concatenate([sfreq[spw] + np.arange(nschan[spw]) * sdf[spw] for spw in range(int(uv['nspect']))])
+    if startchan is not None and endchan is not None:
+        channels = slice(startchan, endchan + 1)
+    else:
+        channels = slice(None)
+    freqs = freqs[channels]
+    # Size of a uv-cell in wavelengths, only the half plane with u >= 0 is gridded
+    duv = 1.0 / (imsize * np.radians(cell / 3600.0))
+    counts = np.zeros((imsize, imsize // 2 + 1))
+    squares = np.zeros((imsize, imsize // 2 + 1))
+    baselines = {}
+    samples = []
+    nsamples = 0
+    pending = {}
+    for (uvw, t, (i, j)), data in uv.all():
+        pol = uv['pol']
+        if pol not in (POL_XY, POL_YX):
+            continue
+        other = pending.pop((t, i, j), None)
+        if other is None:
+            pending[(t, i, j)] = (pol, data[channels])
+            continue
+        xy, yx = (data[channels], other[1]) if pol == POL_XY else (other[1], data[channels])
+        flags = np.ma.getmaskarray(xy) | np.ma.getmaskarray(yx)
+        stats_bl = baselines.setdefault((i, j), np.zeros(3))
+        stats_bl[2] += flags.size
+        if flags.all():
+            continue
+        stokesv = ((np.ma.getdata(xy) - np.ma.getdata(yx)) / 2j)[~flags]
+        # uvw is in nanoseconds, the frequencies in GHz
+        u, v = uvw[0] * freqs[~flags], uvw[1] * freqs[~flags]
+        sign = np.where(u < 0, -1, 1)
+        iu = np.rint(sign * u / duv).astype(int)
+        iv = np.rint(sign * v / duv).astype(int) + imsize // 2
+        ongrid = (iu < counts.shape[1]) & (iv >= 0) & (iv < counts.shape[0])
+        # The variance of each of the real and imaginary part
+        variance = np.abs(stokesv) ** 2 / 2.0
+        np.add.at(counts, (iv[ongrid], iu[ongrid]), 1)
+        np.add.at(squares, (iv[ongrid], iu[ongrid]), variance[ongrid])
+        stats_bl[0] += np.sum(variance)
+        stats_bl[1] += len(stokesv)
+        if nsamples < maxsamples:
+            samples.append(stokesv.real[:maxsamples - nsamples])
+            nsamples += len(samples[-1])
+    del uv
+    nvis = np.sum(counts)
+    if nvis == 0:
+        raise ApercalException('No unflagged Stokes V visibilities in {0}. Cannot calculate theoretical noise! No iterative selfcal possible!'.format(dataset))
+    for (i, j), (sumvar, ngood, ntotal) in sorted(baselines.items()):
+        logger.debug('Baseline {0}-{1}: Stokes V rms {2:.6f} Jy, {3:.1%} flagged'.format(i, j, np.sqrt(sumvar / ngood) if ngood > 0 else np.nan, 1.0 - ngood / ntotal))
+    # Briggs weighting of each visibility with 1 / (1 + count * f^2) in its cell, the noise is sum(w^2 sigma^2) / sum(w)^2
+    fsquared = (5.0 * 10 ** (-robust)) ** 2 / (np.sum(counts ** 2) / nvis)
+    weights = 1.0 / (1.0 + counts * fsquared)
+    vstd = np.sqrt(np.sum(squares * weights ** 2)) / np.sum(counts * weights)
+    pvalue = stats.normaltest(np.concatenate(samples))[1]
+    gaussianity = bool(pvalue < gausslimit)
+    return gaussianity, float(vstd)
+
+
+def get_theoretical_noise_image(self, dataset, gausslimit, startchan=None, endchan=None):
     """
     Subroutine to create a Stokes V image from a dataset and measure the noise, which should be similar to the theoretical one
     image (string): The path to the dataset file.
-    startchan(int): First channel to use for imaging, zero-based
+    startchan(int): First channel to use for imaging, zero-based, all channels are used if startchan or endchan is None
     endchan(int): Last channel to use for imaging, zero-based
     returns (numpy array): The rms of the image
     """
@@ -108,7 +235,7 @@ def get_theoretical_noise(self, dataset, gausslimit, startchan=None, endchan=Non
     invert.slop = 1
     invert.robust = -2
     invert.options='mfs'
-    if (startchan and endchan) != None:
+    if startchan is not None and endchan is not None:
         invert.line = 'channel,1,' + str(startchan + 1) + ',' + str(endchan - startchan + 1) + ',' + str(endchan - startchan + 1)
     else:
         pass
@@ -226,7 +353,97 @@ def calc_clean_cutoff(mask_threshold, c1):
     return clean_cutoff
 
 
-def create_mask(self, image, mask, threshold, theoretical_noise, beampars=None, rms_map=None):
+def create_mask(self, image, mask, threshold, theoretical_noise, beampars=None, rms_map=None, engine='pybdsf'):
+    """
+    Creates a mask from an image using the native island finder or pybdsf
+    image (string): Input image to use in MIRIAD format
+    mask (string): Output mask image in MIRIAD format
+    threshold (float): Threshold in Jy to use
+    theoretical_noise (float): Theoretical noise for calculating the adaptive threshold parameter inside pybdsf
+    beampars (tuple): Synthesised beam parameters bmaj, bmin (degrees), bpa, read from the image header if None
+    rms_map (bool): Use an rms map in pybdsf, only used by the pybdsf engine
+    engine (string): 'native' or 'pybdsf'
+    """
+    if engine == 'native':
+        create_mask_native(self, image, mask, threshold, theoretical_noise, beampars=beampars)
+    elif engine == 'pybdsf':
+        create_mask_pybdsf(self, image, mask, threshold, theoretical_noise, beampars=beampars, rms_map=rms_map)
+    else:
+        raise ApercalException('Mask engine {0} not supported! Use native or pybdsf!'.format(engine))
+
+
+def get_min_island_size(header, beampars=None):
+    """
+    Calculates the minimum number of pixels of an island from the beam size like pybdsf does
+    header (dict): Header items of the MIRIAD image
+    beampars (tuple): Synthesised beam parameters bmaj, bmin (degrees), bpa, read from the header if None
+    returns (int): One third of the number of pixels in the beam, at least 6
+    """
+    if beampars:
+        bmaj, bmin = np.radians(beampars[0]), np.radians(beampars[1])
+    elif 'bmaj' in header and 'bmin' in header:
+        bmaj, bmin = float(header['bmaj']), float(header['bmin'])
+    else:
+        return 6
+    pixarea = abs(float(header['cdelt1']) * float(header['cdelt2']))
+    beamarea = np.pi * bmaj * bmin / (4.0 * np.log(2.0)) / pixarea
+    return max(6, int(beamarea / 3.0))
+
+
+def find_islands(data, threshold, peak_threshold, minpix):
+    """
+    Finds the islands of connected pixels above a threshold
+    data (numpy array): Two dimensional image, NaNs are never part of an island
+    threshold (float): Threshold for the pixels of an island
+    peak_threshold (float): Minimum peak value of an island
+    minpix (int): Minimum number of pixels of an island
+    returns (numpy array): Boolean array with True for pixels inside an island
+    """
+    with np.errstate(invalid='ignore'):
+        above = data >= threshold
+    labels, nislands = ndimage.label(above, structure=np.ones((3, 3), dtype=int))
+    if nislands == 0:
+        return above
+    index = np.arange(1, nislands + 1)
+    sizes = np.bincount(labels.ravel(), minlength=nislands + 1)[1:]
+    peaks = ndimage.maximum(data, labels, index)
+    keep = np.concatenate([[False], (sizes >= minpix) & (peaks >= peak_threshold)])
+    return keep[labels]
+
+
+def create_mask_native(self, image, mask, threshold, theoretical_noise, beampars=None, thresh_pix=5.0):
+    """
+    Creates a mask from an image with connected component labelling. Islands are formed from the pixels above the
+    threshold and kept if they are larger than a third of the beam and peak above thresh_pix times the theoretical
+    noise, which pybdsf uses as a constant rms. The mask image is written directly, its pixels are 1 inside the islands
+    and flagged outside.
+    image (string): Input image to use in MIRIAD format
+    mask (string): Output mask image in MIRIAD format
+    threshold (float): Threshold in Jy to use
+    theoretical_noise (float): Theoretical noise of the observation
+    beampars (tuple): Synthesised beam parameters bmaj, bmin (degrees), bpa, read from the image header if None
+    thresh_pix (float): Minimum peak of an island in units of the noise
+    """
+    header = mirio.readheader(image)
+    shape = mirio.getshape(header)
+    ny, nx = shape[-2], shape[-1]
+    nplanes = int(np.prod(shape)) // (nx * ny)
+    minpix = get_min_island_size(header, beampars)
+    if os.path.isdir(mask):
+        managefiles.director(self, 'rm', mask)
+    pixels = mirio.createimage(mask, image)
+    good = np.zeros((nplanes, ny, nx), dtype=bool)
+    for plane in range(nplanes):
+        data = mirio.readrows(image, plane * ny, (plane + 1) * ny, header=header)
+        good[plane] = find_islands(data, threshold, max(threshold, thresh_pix * theoretical_noise), minpix)
+        logger.debug('Found islands with {0} pixels above {1} Jy in plane {2} of {3}'.format(np.sum(good[plane]), threshold, plane, image))
+    pixels.reshape(nplanes, ny, nx)[:] = good
+    mirio.closeimage(mask, pixels)
+    del pixels
+    mirio.writemask(mask, good)
+
+
+def create_mask_pybdsf(self, image, mask, threshold, theoretical_noise, beampars=None, rms_map=None):
     """
     Creates a mask from an image using pybdsf
     image (string): Input image to use in MIRIAD format
@@ -264,9 +481,97 @@ def create_mask(self, image, mask, threshold, theoretical_noise, beampars=None,
         pass
 
 
-def get_beam(self, image, beam):
+# Fitted synthesised beams, the key includes the dataset and the imaging parameters
+_beam_cache = {}
+
+
+def fit_beam(beam, cutoff=0.35, halfsize=32):
+    """
+    Fits a two dimensional Gaussian to the main lobe of a dirty beam. The main lobe are the pixels connected to the peak
+    above the cutoff. The logarithm of a Gaussian with its peak at the reference pixel is a quadratic form of the
+    offsets, which is fitted with linear least squares weighted with the beam values.
+    beam (string): Dirty beam image in MIRIAD format
+    cutoff (float): Lowest beam value used in the fit relative to the peak
+    halfsize (int): Half size of the box around the reference pixel read initially, enlarged if the lobe touches its edge
+    return (tuple): Synthesised beam parameters in the order bmaj, bmin, bpa in degrees or None if the fit failed
+    """
+    header = mirio.readheader(beam)
+    nx, ny = int(header['naxis1']), int(header['naxis2'])
+    xc, yc = int(round(float(header['crpix1']))) - 1, int(round(float(header['crpix2']))) - 1
+    cdelt1, cdelt2 = float(header['cdelt1']), float(header['cdelt2'])
+    while True:
+        x0, x1 = max(0, xc - halfsize), min(nx, xc + halfsize + 1)
+        y0, y1 = max(0, yc - halfsize), min(ny, yc + halfsize + 1)
+        data = mirio.readrows(beam, y0, y1, header=header, columns=(x0, x1))
+        peak = data[yc - y0, xc - x0]
+        if not np.isfinite(peak) or peak <= 0:
+            return None
+        with np.errstate(invalid='ignore'):
+            labels = ndimage.label(data >= cutoff * peak)[0]
+        lobe = labels == labels[yc - y0, xc - x0]
+        rows, columns = np.nonzero(lobe)
+        touches = rows.min() == 0 and y0 > 0 or rows.max() == y1 - y0 - 1 and y1 < ny or \
+            columns.min() == 0 and x0 > 0 or columns.max() == x1 - x0 - 1 and x1 < nx
+        if not touches:
+            break
+        halfsize *= 2
+    # Offsets to the east and north in radians
+    east = (columns + x0 - xc) * cdelt1
+    north = (rows + y0 - yc) * cdelt2
+    values = data[rows, columns] / peak
+    if len(values) < 3:
+        return None
+    # ln(B) = -(a * east^2 + 2 * b * east * north + c * north^2), errors in ln(B) scale with 1 / B
+    design = np.column_stack([east ** 2, 2 * east * north, north ** 2]) * values[:, np.newaxis]
+    coeffs = np.linalg.lstsq(design, -np.log(values) * values, rcond=None)[0]
+    eigvals, eigvecs = np.linalg.eigh(np.array([[coeffs[0], coeffs[1]], [coeffs[1], coeffs[2]]]))
+    if eigvals[0] <= 0:
+        return None
+    # The major axis is along the smallest curvature, the position angle is measured from north through east
+    bmaj = np.degrees(np.sqrt(4 * np.log(2) / eigvals[0]))
+    bmin = np.degrees(np.sqrt(4 * np.log(2) / eigvals[1]))
+    bpa = np.degrees(np.arctan2(eigvecs[0, 0], eigvecs[1, 0]))
+    if bpa > 90:
+        bpa -= 180
+    elif bpa <= -90:
+        bpa += 180
+    return float(bmaj), float(bmin), float(bpa)
+
+
+def get_beam(self, image, beam, dataset=None, imsize=None, cell=None, robust=None, line=None):
+    """
+    Get the synthesised beam of an image with has not been cleaned by fitting a Gaussian to the main lobe of the dirty
+    beam. The result is cached for each dataset and set of imaging parameters as long as the flags of the dataset do not
+    change. Falls back to cleaning and restoring the image if the fit fails.
+    image (string): Input image to use in MIRIAD format
+    beam (string): Beam image for cleaning in MIRIAD format
+    dataset (string): The dataset the image was created from, the result is not cached if None
+    imsize (int): Image size used for imaging
+    cell (float): Cell size used for imaging
+    robust (float): Robust weighting used for imaging
+    line (string): Line selection used for imaging
+    return (tuple): Synthesised beam parameters in the order bmaj, bmin, bpa
+    """
+    key = None
+    if dataset is not None:
+        flags = os.path.join(dataset, 'flags')
+        key = (os.path.abspath(dataset), os.path.getmtime(flags) if os.path.isfile(flags) else None, imsize, cell, robust, line)
+        if key in _beam_cache:
+            logger.debug('Using cached synthesised beam of {0}'.format(dataset))
+            return _beam_cache[key]
+    beampars = fit_beam(beam)
+    if beampars is None:
+        logger.warning('Fitting the synthesised beam of {0} failed! Determining it with clean and restor!'.format(beam))
+        beampars = get_beam_restor(self, image, beam)
+    if key is not None:
+        _beam_cache[key] = beampars
+    return beampars
+
+
+def get_beam_restor(self, image, beam):
     """
-    Get the synthesised beam of an image with has not been cleaned
+    Get the synthesised beam of an image with has not been cleaned from the header of a restored image after one clean
+    iteration
     image (string): Input image to use in MIRIAD format
     beam (string): Beam image for cleaning in MIRIAD format
     return (tuple): Synthesised beam parameters in the order bmaj, bmin, bpa
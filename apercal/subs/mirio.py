@@ -0,0 +1,400 @@
+"""
+Direct access to MIRIAD image datasets without running MIRIAD tasks. A MIRIAD dataset is a directory with one file per
+item. Small items (naxis, crval1, bmaj, ...) are stored together in the 'header' item, the pixels are in the 'image'
+item and the optional 'mask' item holds a bit mask of the good pixels.
+"""
+
+import logging
+import os
+import struct
+
+import astropy.io.fits as pyfits
+import numpy as np
+from astropy.wcs import WCS
+
+from apercal.exceptions import ApercalException
+
+logger = logging.getLogger(__name__)
+
+# Size of the name field and of the alignment of entries in the header item
+ITEM_HDR_SIZE = 16
+
+# Type codes of MIRIAD items with their struct format and the offset of the data after the type header
+H_BYTE = 1
+H_INT = 2
+H_INT2 = 3
+H_REAL = 4
+H_DBLE = 5
+H_TXT = 6
+H_CMPLX = 7
+H_INT8 = 8
+ITEM_TYPES = {H_INT: ('i', 4, 4), H_INT2: ('h', 2, 4), H_REAL: ('f', 4, 4), H_DBLE: ('d', 8, 8),
+              H_CMPLX: ('f', 4, 8), H_INT8: ('q', 8, 8)}
+
+# Largest item (including its type header) that is stored in the header item instead of a separate file
+MAX_HEADER_ITEM_SIZE = 64
+
+# Number of flags stored in each 32 bit word of the mask item
+MASK_BITS = 31
+
+
+def ismiriad(dataset):
+    """
+    Checks if a path is a MIRIAD dataset
+
+    dataset (string): Path to the dataset
+    returns (bool): True if the path is a directory with a header item
+    """
+    return os.path.isdir(dataset) and os.path.isfile(os.path.join(dataset, 'header'))
+
+
+def _decode_item(data):
+    """
+    Decodes the value of a header item including its type header
+    """
+    itemtype = struct.unpack('>i', data[:4])[0]
+    if itemtype in (H_BYTE, H_TXT):
+        return data[4:].rstrip(b'\x00').decode('ascii')
+    if itemtype not in ITEM_TYPES:
+        raise ApercalException('Unknown MIRIAD item type {0}'.format(itemtype))
+    fmt, size, offset = ITEM_TYPES[itemtype]
+    count = (len(data) - offset) // size
+    values = struct.unpack('>' + fmt * count, data[offset:offset + count * size])
+    if itemtype == H_CMPLX:
+        values = [complex(values[i], values[i + 1]) for i in range(0, len(values), 2)]
+    if len(values) == 1:
+        return values[0]
+    return list(values)
+
+
+def _encode_item(value, itemtype=None):
+    """
+    Encodes a value as a header item including its type header. Without a given type, strings are stored as bytes,
+    integers as int and floats as real values like puthd does.
+    """
+    if itemtype is None:
+        if isinstance(value, (bool, np.bool_)):
+            raise ApercalException('Boolean values can not be stored in a MIRIAD header')
+        elif isinstance(value, (int, np.integer)):
+            itemtype = H_INT
+        elif isinstance(value, (float, np.floating)):
+            itemtype = H_REAL
+        else:
+            itemtype = H_BYTE
+    if itemtype in (H_BYTE, H_TXT):
+        return struct.pack('>i', itemtype) + str(value).encode('ascii')
+    fmt, size, offset = ITEM_TYPES[itemtype]
+    values = value if isinstance(value, (list, tuple)) else [value]
+    if itemtype == H_CMPLX:
+        values = [part for v in values for part in (complex(v).real, complex(v).imag)]
+    return struct.pack('>i', itemtype) + b'\x00' * (offset - 4) + struct.pack('>' + fmt * len(values), *values)
+
+
+def _read_header_items(dataset):
+    """
+    Reads the raw entries of the header item
+
+    returns (list): Tuples of the item name and the encoded value including its type header
+    """
+    with open(os.path.join(dataset, 'header'), 'rb') as f:
+        raw = f.read()
+    items = []
+    pos = 0
+    while pos + ITEM_HDR_SIZE <= len(raw):
+        name = raw[pos:pos + ITEM_HDR_SIZE - 1].rstrip(b'\x00').decode('ascii')
+        size = struct.unpack('B', raw[pos + ITEM_HDR_SIZE - 1:pos + ITEM_HDR_SIZE])[0]
+        pos += ITEM_HDR_SIZE
+        if name != '' and size > 0:
+            items.append((name, raw[pos:pos + size]))
+        pos += ((size + ITEM_HDR_SIZE - 1) // ITEM_HDR_SIZE) * ITEM_HDR_SIZE
+    return items
+
+
+def readheader(dataset, keys=None):
+    """
+    Reads items stored in the header item of a MIRIAD dataset
+
+    dataset (string): Path to the MIRIAD dataset
+    keys (list): Names of the items to read, all items if None
+    returns (dict): The header items and their values
+    """
+    header = {}
+    for name, data in _read_header_items(dataset):
+        if keys is None or name in keys:
+            header[name] = _decode_item(data)
+    return header
+
+
+def writeheader(dataset, items):
+    """
+    Writes items to the header item of a MIRIAD dataset. Existing items keep their type. The header is written to a
+    temporary file first and then moved in place.
+
+    dataset (string): Path to the MIRIAD dataset
+    items (dict): Names of the items and their new values
+    """
+    entries = _read_header_items(dataset)
+    types = dict((name, struct.unpack('>i', data[:4])[0]) for name, data in entries)
+    encoded = dict((name, _encode_item(value, types.get(name))) for name, value in items.items())
+    for name, data in encoded.items():
+        if len(name) > ITEM_HDR_SIZE - 1 or len(data) > MAX_HEADER_ITEM_SIZE:
+            raise ApercalException('Item {0} can not be stored in the header of {1}'.format(name, dataset))
+    # Replace existing entries in place and append new ones
+    entries = [(name, encoded.pop(name, data)) for name, data in entries]
+    entries.extend(sorted(encoded.items()))
+
+    raw = b''
+    for name, data in entries:
+        record = name.encode('ascii').ljust(ITEM_HDR_SIZE - 1, b'\x00') + struct.pack('B', len(data)) + data
+        raw += record + b'\x00' * (-len(record) % ITEM_HDR_SIZE)
+    headerfile = os.path.join(dataset, 'header')
+    tmpfile = headerfile + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(raw)
+    os.rename(tmpfile, headerfile)
+
+
+def getshape(header):
+    """
+    Returns the shape of the pixel array of a MIRIAD image in numpy (and FITS) order, i.e. the last axis is naxis1
+
+    header (dict): The header items of the image
+    returns (tuple): Shape of the pixel array
+    """
+    return tuple(int(header['naxis' + str(axis)]) for axis in range(int(header['naxis']), 0, -1))
+
+
+def getwcs(header):
+    """
+    Returns the celestial coordinate system of a MIRIAD image. MIRIAD stores the reference values and increments of
+    the celestial axes in radians.
+
+    header (dict): The header items of the image
+    returns (astropy WCS): Coordinate system of the first two axes
+    """
+    wcs = WCS(naxis=2)
+    ctype = [str(header.get('ctype' + str(axis), '')) for axis in (1, 2)]
+    crval = [float(header.get('crval' + str(axis), 0.)) for axis in (1, 2)]
+    cdelt = [float(header.get('cdelt' + str(axis), 1.)) for axis in (1, 2)]
+    for axis in range(2):
+        if ctype[axis].startswith('RA') or ctype[axis].startswith('DEC'):
+            crval[axis] = np.degrees(crval[axis])
+            cdelt[axis] = np.degrees(cdelt[axis])
+    wcs.wcs.ctype = ctype
+    wcs.wcs.crval = crval
+    wcs.wcs.cdelt = cdelt
+    wcs.wcs.crpix = [float(header.get('crpix' + str(axis), 1.)) for axis in (1, 2)]
+    wcs.wcs.set()
+    return wcs
+
+
+def readmask(dataset, npix, first=0):
+    """
+    Reads the mask item of a MIRIAD dataset
+
+    dataset (string): Path to the MIRIAD dataset
+    npix (int): Number of pixels to read
+    first (int): Index of the first pixel to read
+    returns (numpy array): Flat boolean array with True for good pixels or None if the dataset has no mask
+    """
+    maskfile = os.path.join(dataset, 'mask')
+    if not os.path.isfile(maskfile):
+        return None
+    # The first word holds the item type, each following word stores 31 flags starting at the least significant bit.
+    # Only the words covering the requested pixels are read.
+    firstbit = first + MASK_BITS
+    firstword = firstbit // MASK_BITS
+    nwords = (firstbit + npix - 1) // MASK_BITS - firstword + 1
+    with open(maskfile, 'rb') as f:
+        f.seek(4 * firstword)
+        words = np.fromfile(f, dtype='>i4', count=nwords)
+    bits = (words[:, np.newaxis] >> np.arange(MASK_BITS)) & 1
+    offset = firstbit - firstword * MASK_BITS
+    good = bits.astype(bool).ravel()[offset:offset + npix]
+    if len(good) < npix:
+        good = np.concatenate([good, np.ones(npix - len(good), dtype=bool)])
+    return good
+
+
+def readimage(dataset):
+    """
+    Reads the pixels of a MIRIAD image. Pixels blanked by the mask are set to NaN like in the output of fits op=xyout.
+
+    dataset (string): Path to the MIRIAD image
+    returns (numpy array): The pixel values with the axes in FITS order
+    """
+    header = readheader(dataset)
+    shape = getshape(header)
+    # The image item starts with a four byte type header followed by big endian floats
+    pixels = np.memmap(os.path.join(dataset, 'image'), dtype='>f4', mode='r', offset=4, shape=shape)
+    data = np.array(pixels, dtype=np.float32)
+    del pixels
+    good = readmask(dataset, data.size)
+    if good is not None:
+        data.ravel()[~good] = np.nan
+    return data
+
+
+def getimagedata(image):
+    """
+    Reads the pixels of an image in MIRIAD or FITS format
+
+    image (string): Path to the image
+    returns (numpy array): The pixel values with the axes in FITS order
+    """
+    if ismiriad(image):
+        return readimage(image)
+    elif os.path.isfile(image):
+        with pyfits.open(image) as hdulist:
+            return np.array(hdulist[0].data)
+    elif os.path.isdir(image):
+        error = 'Image format not supported. Only MIRIAD and FITS formats are supported!'
+        logger.error(error)
+        raise ApercalException(error)
+    else:
+        error = 'Image {} does not seem to exist!'.format(image)
+        logger.error(error)
+        raise ApercalException(error)
+
+
+def getbeam(image):
+    """
+    Reads the restoring beam of an image in MIRIAD or FITS format from its header
+
+    image (string): Path to the image
+    returns (tuple): bmaj and bmin in arcsec and bpa in degrees
+    """
+    if ismiriad(image):
+        header = readheader(image, ['bmaj', 'bmin', 'bpa'])
+        keys = ['bmaj', 'bmin', 'bpa']
+        # the axes are in radians and the position angle in degrees
+        scale = [3600. * 180. / np.pi, 3600. * 180. / np.pi, 1.]
+    elif os.path.isfile(image):
+        header = pyfits.getheader(image)
+        keys = ['BMAJ', 'BMIN', 'BPA']
+        scale = [3600., 3600., 1.]
+    else:
+        error = 'Image {} does not seem to exist!'.format(image)
+        logger.error(error)
+        raise ApercalException(error)
+    missing = [key for key in keys if key not in header]
+    if missing:
+        raise ApercalException('Header item(s) {0} not found in {1}'.format(', '.join(missing), image))
+    return tuple(float(header[key]) * factor for key, factor in zip(keys, scale))
+
+
+def readrows(dataset, start, stop, header=None, columns=None):
+    """
+    Reads a range of rows of a MIRIAD image without loading the full image. The image is seen as a stack of rows of
+    naxis1 pixels, the rows of all planes following each other. Masked pixels are set to NaN.
+
+    dataset (string): Path to the MIRIAD image
+    start (int): Index of the first row
+    stop (int): Index after the last row
+    header (dict): The header items of the image, read from the dataset if None
+    columns (tuple): Index of the first column and after the last column to read, all columns if None
+    returns (numpy array): The pixel values with shape (stop - start, number of columns)
+    """
+    if header is None:
+        header = readheader(dataset)
+    nx = int(header['naxis1'])
+    nrows = int(np.prod(getshape(header))) // nx
+    stop = min(stop, nrows)
+    if columns is None:
+        columns = (0, nx)
+    pixels = np.memmap(os.path.join(dataset, 'image'), dtype='>f4', mode='r', offset=4, shape=(nrows, nx))
+    data = np.array(pixels[start:stop, columns[0]:columns[1]], dtype=np.float32)
+    del pixels
+    good = readmask(dataset, (stop - start) * nx, first=start * nx)
+    if good is not None:
+        data[~good.reshape(-1, nx)[:, columns[0]:columns[1]]] = np.nan
+    return data
+
+
+def createimage(dataset, template):
+    """
+    Creates a MIRIAD image with the header and the shape of an existing image. The image has no mask and no history.
+
+    dataset (string): Path to the new MIRIAD image, must not exist
+    template (string): Path to the MIRIAD image to take the header from
+    returns (numpy memmap): Writable pixel array of the new image with the axes in FITS order
+    """
+    if os.path.exists(dataset):
+        raise ApercalException('Image {0} already exists'.format(dataset))
+    shape = getshape(readheader(template))
+    os.mkdir(dataset)
+    with open(os.path.join(template, 'header'), 'rb') as f:
+        raw = f.read()
+    with open(os.path.join(dataset, 'header'), 'wb') as f:
+        f.write(raw)
+    imagefile = os.path.join(dataset, 'image')
+    with open(imagefile, 'wb') as f:
+        f.write(struct.pack('>i', H_REAL))
+        f.truncate(4 + 4 * int(np.prod(shape)))
+    return np.memmap(imagefile, dtype='>f4', mode='r+', offset=4, shape=shape)
+
+
+def openimage(dataset):
+    """
+    Opens the pixels of an existing MIRIAD image to update them in place. The mask of the image is not changed.
+
+    dataset (string): Path to the MIRIAD image
+    returns (numpy memmap): Writable pixel array of the image with the axes in FITS order
+    """
+    shape = getshape(readheader(dataset))
+    return np.memmap(os.path.join(dataset, 'image'), dtype='>f4', mode='r+', offset=4, shape=shape)
+
+
+def closeimage(dataset, pixels):
+    """
+    Flushes the pixels of an image created with createimage or opened with openimage and updates the data range in its
+    header
+
+    dataset (string): Path to the MIRIAD image
+    pixels (numpy memmap): The pixel array returned by createimage
+    """
+    pixels.flush()
+    datamin = np.nanmin(pixels) if pixels.size > 0 else 0.
+    datamax = np.nanmax(pixels) if pixels.size > 0 else 0.
+    writeheader(dataset, {'datamin': float(datamin), 'datamax': float(datamax)})
+
+
+def writemask(dataset, good):
+    """
+    Writes the mask item of a MIRIAD dataset, replacing an existing mask
+
+    dataset (string): Path to the MIRIAD dataset
+    good (numpy array): Boolean array with True for good pixels, flattened in the order of the image item
+    """
+    good = np.asarray(good, dtype=bool).ravel()
+    # Pad the flags to full words, each word stores 31 flags starting at the least significant bit
+    nwords = (good.size + MASK_BITS - 1) // MASK_BITS
+    bits = np.zeros(nwords * MASK_BITS, dtype=np.int64)
+    bits[:good.size] = good
+    words = (bits.reshape(nwords, MASK_BITS) << np.arange(MASK_BITS)).sum(axis=1)
+    with open(os.path.join(dataset, 'mask'), 'wb') as f:
+        f.write(struct.pack('>i', H_INT))
+        f.write(words.astype('>i4').tobytes())
+
+
+def readgains(dataset):
+    """
+    Reads the antenna gains written by selfcal or gpcal from the gains item of a MIRIAD uv dataset
+
+    dataset (string): Path to the MIRIAD uv dataset
+    returns (tuple): The solution times in Julian days and the complex gains with shape (nsols, ngains) or None if the
+                     dataset has no gains
+    """
+    gainsfile = os.path.join(dataset, 'gains')
+    if not os.path.isfile(gainsfile):
+        return None
+    header = readheader(dataset, ['ngains', 'nsols'])
+    if 'ngains' not in header or 'nsols' not in header:
+        return None
+    ngains, nsols = int(header['ngains']), int(header['nsols'])
+    # After an eight byte header each solution is stored as its time followed by the complex gains
+    dtype = np.dtype([('time', '>f8'), ('gains', '>c8', (ngains,))])
+    with open(gainsfile, 'rb') as f:
+        f.seek(8)
+        solutions = np.fromfile(f, dtype=dtype, count=nsols)
+    return solutions['time'].astype(np.float64), solutions['gains'].astype(np.complex64)
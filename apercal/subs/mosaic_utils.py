@@ -1,9 +1,13 @@
 import numpy as np
 from apercal.libs import lib
+from apercal.exceptions import ApercalException
 import logging
 import os
 import shutil
-import copy
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+from apercal.subs import mirio
 
 logger = logging.getLogger(__name__)
 
@@ -18,7 +22,7 @@ in the Apertif-comissioning repository
 # Functions to create the beam maps
 # ++++++++++++++++++++++++++++++++++++++++
 def create_beam(beam, beam_map_dir, corrtype='Gaussian', primary_beam_path=None,
-                bm_size=3073, cell=4.0, fwhm=1950.0, cutoff=0.25):
+                bm_size=3073, cell=4.0, fwhm=1950.0, cutoff=0.25, cache_dir=None):
     """
     Function to create beam maps with miriad
 
@@ -34,6 +38,7 @@ def create_beam(beam, beam_map_dir, corrtype='Gaussian', primary_beam_path=None,
         cell (float): Cell size of a pixel in arcsec (default 4, continuum mfs images)
         fwhm (float): FWHM in arcsec for type='Gaussian' (default 32.5*60)
         cutoff (float): Relative power level to cut beam off at
+        cache_dir (str): Directory with previously created beam maps, which are copied instead of creating them again
     """
     # iterate through beams:
     # for beam,beamdir in zip(beam_list,beam_map_dir):
@@ -42,27 +47,116 @@ def create_beam(beam, beam_map_dir, corrtype='Gaussian', primary_beam_path=None,
     # use beam integer in name
     beamoutname = 'beam_{}.map'.format(beam.zfill(2))
 
+    if corrtype not in ['Gaussian', 'Correct']:
+        error = 'Type of beam map not supported'
+        logger.error(error)
+        raise ApercalException(error)
+    if corrtype == 'Correct' and primary_beam_path is None:
+        error = "Path to primary beam maps not specified"
+        logger.error(error)
+        raise ApercalException(error)
+
     # check if file exists:
-    if not os.path.isdir(beamoutname):
-        # then test type and proceed for different types
-        if corrtype == 'Gaussian':
-            make_gaussian_beam(beam_map_dir, beamoutname,
-                               bm_size, cell, fwhm, cutoff)
-        elif corrtype == 'Correct':
-            if primary_beam_path is None:
-                error = "Path to primary beam maps not specified"
-                logger.error(error)
-                raise ApercalException(error)
-            else:
-                get_measured_beam_maps(
-                    beam, primary_beam_path, beam_map_dir, beamoutname, cutoff)
-        else:
-            error = 'Type of beam map not supported'
-            logger.error(error)
-            raise ApercalException(error)
-    else:
+    if os.path.isdir(os.path.join(beam_map_dir, beamoutname)):
         logger.warning(
             "Beam map for beam {} already exists. Did not create it again".format(beam))
+    elif cache_dir is not None:
+        cached_map = get_cached_beam_map(beam, cache_dir, corrtype, primary_beam_path, bm_size, cell, fwhm, cutoff)
+        shutil.copytree(cached_map, os.path.join(beam_map_dir, beamoutname))
+    else:
+        make_beam(beam, beam_map_dir, beamoutname, corrtype, primary_beam_path, bm_size, cell, fwhm, cutoff)
+
+
+def make_beam(beam, beam_map_dir, beamoutname, corrtype, primary_beam_path, bm_size, cell, fwhm, cutoff):
+    """
+    Function to create a beam map of the given type
+
+    Args:
+        beam (str): beam number
+        beam_map_dir (str): output directory for the beam map
+        beamoutname (str): name of the beam map
+        other arguments as for create_beam
+    """
+    if corrtype == 'Gaussian':
+        make_gaussian_beam(beam_map_dir, beamoutname,
+                           bm_size, cell, fwhm, cutoff)
+    else:
+        get_measured_beam_maps(
+            beam, primary_beam_path, beam_map_dir, beamoutname, cutoff)
+
+
+def get_beam_model_file(beam, beam_map_input_path):
+    """
+    Function to get the file name of the beam model from drift scans
+
+    Args:
+        beam (str): beam number
+        beam_map_input_path (str): path to the directory with measured beam maps
+    """
+    return os.path.join(beam_map_input_path, "{0}_{1}_I_model.fits".format(
+        beam_map_input_path.split("/")[5], beam))
+
+
+def get_beam_map_key(beam, corrtype, primary_beam_path, bm_size, cell, fwhm, cutoff):
+    """
+    Function to get the key of a beam map in the cache of beam maps
+
+    Gaussian beam maps are the same for all beams. Beam maps from drift scans depend on the beam model file,
+    which is identified by its path, size and modification time.
+
+    Args:
+        arguments as for create_beam
+
+    Returns:
+        str: key of the beam map
+    """
+    if corrtype == 'Gaussian':
+        parameters = (corrtype, int(bm_size), float(cell), float(fwhm), float(cutoff))
+    else:
+        model_file = os.path.abspath(get_beam_model_file(beam, primary_beam_path))
+        st = os.stat(model_file)
+        parameters = (corrtype, model_file, st.st_size, st.st_mtime, float(cutoff))
+    # MIRIAD limits the length of file names, so only part of the hash is used
+    return hashlib.sha1(repr(parameters).encode('ascii')).hexdigest()[:16]
+
+
+def get_cached_beam_map(beam, cache_dir, corrtype, primary_beam_path, bm_size, cell, fwhm, cutoff):
+    """
+    Function to get a beam map from the cache of beam maps and to create it if it is not cached yet
+
+    Beam maps are created under a temporary name and then moved in place, so other processes using the
+    same cache never see an incomplete beam map.
+
+    Args:
+        beam (str): beam number
+        cache_dir (str): directory of the cache
+        other arguments as for create_beam
+
+    Returns:
+        str: path of the cached beam map
+    """
+    key = get_beam_map_key(beam, corrtype, primary_beam_path, bm_size, cell, fwhm, cutoff)
+    cached_map = os.path.join(cache_dir, 'beam_{}.map'.format(key))
+    if os.path.isdir(cached_map):
+        logger.debug("Using cached beam map {0} for beam {1}".format(cached_map, beam))
+        return cached_map
+
+    logger.debug("Creating beam map {0} for beam {1} in cache".format(cached_map, beam))
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    tmp_name = 'beam_{0}_{1}.map'.format(key, os.getpid())
+    tmp_map = os.path.join(cache_dir, tmp_name)
+    if os.path.isdir(tmp_map):
+        shutil.rmtree(tmp_map)
+    make_beam(beam, cache_dir, tmp_name, corrtype, primary_beam_path, bm_size, cell, fwhm, cutoff)
+    try:
+        os.rename(tmp_map, cached_map)
+    except OSError:
+        # another process created the same beam map in the meantime
+        if not os.path.isdir(cached_map):
+            raise
+        shutil.rmtree(tmp_map)
+    return cached_map
 
 
 def make_gaussian_beam(beamdir, beamoutname, bm_size, cell, fwhm, cutoff):
@@ -119,8 +213,7 @@ def get_measured_beam_maps(beam, beam_map_input_path, beam_map_output_path, beam
     work_dir = os.getcwd()
 
     # file name of the beam model fits file which will be copied
-    input_beam_model = os.path.join(beam_map_input_path, "{0}_{1}_I_model.fits".format(
-        beam_map_input_path.split("/")[5], beam))
+    input_beam_model = get_beam_model_file(beam, beam_map_input_path)
     # file name of the fits file after copying
     temp_beam_model_name = os.path.join(
         beam_map_output_path, 'beam_model_{0}_temp.fits'.format(beam))
@@ -256,45 +349,125 @@ def fixheader(beamname, beamdir):
 # Functions to calculate the inverse covariance matrix
 # ++++++++++++++++++++++++++++++++++++++++++++++++++++
 
-def inverted_covariance_matrix(imagefiles, corr_matrix, nbeams, beamlist):
+def inverted_covariance_matrix(imagefiles, corr_matrix, nbeams, beamlist, noise=None, nworkers=1):
+    """
+    Function to calculate the inverse of the noise covariance matrix of the beams
+
+    Args:
+        imagefiles (str): name of the images with a placeholder for the beam number
+        corr_matrix (str): file with the correlation matrix
+        nbeams (int): number of beams of the correlation matrix
+        beamlist (list(str)): list of beams
+        noise (dict): noise of the image of each beam, estimated from the images if None
+        nworkers (int): number of images read at the same time to estimate the noise
+
+    Returns:
+        numpy array: inverse of the noise covariance matrix
+    """
     noise_cor = np.loadtxt(corr_matrix, dtype=np.float64)
-    # Initialize covariance matrix
-    noise_cov = copy.deepcopy(noise_cor)
+    if noise is None:
+        noise = get_beam_noise(imagefiles, beamlist, nworkers=nworkers)
     # Measure noise in the image for each beam
     # same size as the correlation matrix
     sigma_beam = np.zeros(nbeams, np.float64)
-    # number of beams used to go through beam list using indices
-    # no need to use indices because the beams are indices themselves
-    n_beams = len(beamlist)
-    # for bm in range(n_beams):
     for bm in beamlist:
-        bmmap = imagefiles.format(str(bm).zfill(2))
-        sigma_beam[int(bm)] = beam_noise(bmmap)
+        sigma_beam[int(bm)] = noise[bm]
     # write the matrix
     # take into account that there are not always 40 beams
     # this is different from the notebook, because the notebook code
     # does not set non-diagonal matrix elements to zero
     # for missing beams
-    # for k in self.mosaic_beam_list:
-    #     for m in self.mosaic_beam_list:
-    #         a = int(k)
-    #         b = int(m)
-    for a in range(nbeams):
-        for b in range(nbeams):
-            # logger.debug("noise_cor[{0},{1}]={2}".format(a,b,noise_cor[a,b]))
-            if (sigma_beam[a] == 0. or sigma_beam[b] == 0) and a == b:
-                noise_cov[a, b] = noise_cor[a, b]
-            else:
-                noise_cov[a, b] = noise_cor[a, b] * sigma_beam[a] * \
-                                  sigma_beam[b]  # The noise covariance matrix is
-            # logger.debug("noise_cov[{0},{1}]={2}".format(a,b,noise_cov[a,b]))
+    noise_cov = noise_cor * np.outer(sigma_beam, sigma_beam)
+    missing = np.flatnonzero(sigma_beam == 0.)
+    noise_cov[missing, missing] = noise_cor[missing, missing]
     invcovmatrix = np.linalg.inv(noise_cov)
     return invcovmatrix
 
 
+def get_beam_noise(imagefiles, beamlist, nworkers=1):
+    """
+    Function to estimate the noise of the images of several beams
+
+    Args:
+        imagefiles (str): name of the images with a placeholder for the beam number
+        beamlist (list(str)): list of beams
+        nworkers (int): number of images read at the same time
+
+    Returns:
+        dict: noise of the image of each beam
+    """
+    images = [imagefiles.format(str(bm).zfill(2)) for bm in beamlist]
+    if nworkers > 1 and len(images) > 1:
+        pool = ThreadPool(min(nworkers, len(images)))
+        try:
+            noise = pool.map(image_noise, images)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        noise = [image_noise(image) for image in images]
+    return dict(zip(beamlist, noise))
+
+
+def image_noise(imagename, clip=3., niter=10):
+    """
+    Function to estimate the noise in an image from the median absolute deviation of the pixels, iteratively
+    excluding pixels deviating more than clip times the noise from the median
+
+    Args:
+        imagename (str): MIRIAD or FITS image to estimate the noise for
+        clip (float): clipping level in units of the noise
+        niter (int): maximum number of iterations
+
+    Returns:
+        float: noise of the image
+    """
+    data = mirio.getimagedata(imagename)
+    values = data[np.isfinite(data) & (data != 0.)]
+    if values.size == 0:
+        raise ApercalException("Image {} has no valid pixels to estimate the noise from".format(imagename))
+    selection = values
+    sigma = 0.
+    for i in range(niter):
+        median = np.median(selection)
+        new_sigma = 1.4826 * np.median(np.abs(selection - median))
+        if new_sigma == sigma or new_sigma == 0.:
+            break
+        sigma = new_sigma
+        selection = values[np.abs(values - median) < clip * sigma]
+    return float(sigma)
+
+
+def get_image_hash(imagename, blocksize=1048576):
+    """
+    Function to get a hash of the content of an image to find out whether it has changed
+
+    Args:
+        imagename (str): FITS image or MIRIAD image, for which the header, image and mask items are used
+        blocksize (int): number of bytes read at once
+
+    Returns:
+        str: hash of the image
+    """
+    if os.path.isdir(imagename):
+        files = [os.path.join(imagename, item) for item in ['header', 'image', 'mask']]
+    else:
+        files = [imagename]
+    sha = hashlib.sha1()
+    for fl in files:
+        if not os.path.isfile(fl):
+            continue
+        with open(fl, 'rb') as f:
+            block = f.read(blocksize)
+            while block:
+                sha.update(block)
+                block = f.read(blocksize)
+    return sha.hexdigest()
+
+
 def beam_noise(imagename):
     """
-    Funtion to estimate the noise in an image
+    Funtion to estimate the noise in an image with sigest
     imagename (str): MIRIAD image name to estimate the nosie for
     returns (str): Value of the image noise
     """
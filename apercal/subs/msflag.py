@@ -0,0 +1,357 @@
+"""
+Native flagging of measurement sets with python-casacore. Handles the deterministic flag commands of the preflag step
+(shadow, channels, auto-correlations, antennas, baselines, correlations, time ranges and zero clipping) without
+starting CASA. The flags of all commands for one dataset are combined and written with a single streaming pass over
+the FLAG column.
+"""
+
+import logging
+import re
+from datetime import datetime
+
+import casacore.tables as pt
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Correlation types as defined by the Stokes enumeration used in the POLARIZATION table
+CORR_TYPES = {5: 'RR', 6: 'RL', 7: 'LR', 8: 'LL', 9: 'XX', 10: 'XY', 11: 'YX', 12: 'YY'}
+
+# Start of the Modified Julian Date, the TIME column is in MJD seconds
+MJD_EPOCH = datetime(1858, 11, 17)
+
+FREQ_UNITS = {'hz': 1.0, 'khz': 1.0e3, 'mhz': 1.0e6, 'ghz': 1.0e9}
+
+
+class UnsupportedFlagCommand(ValueError):
+    """
+    Raised for flag commands that can not be handled natively and need to be run with CASA
+    """
+    pass
+
+
+class MSFlagger(object):
+    """
+    Collects deterministic flag selections for a measurement set and applies them in one pass.
+
+    Every selection is stored as a combination of a row mask, a channel mask and a correlation mask (None meaning
+    everything). The FLAG column is then read and written in blocks of chunksize rows, so the memory use does not
+    depend on the size of the dataset.
+    """
+
+    def __init__(self, vis, chunksize=10000):
+        """
+        vis (str): Path to the measurement set
+        chunksize (int): Number of rows to read and write at once
+        """
+        self.vis = vis
+        self.chunksize = chunksize
+        self.selections = []
+        self.clipzeros = False
+        self._meta = {}
+
+        t = pt.table(vis, ack=False)
+        self.nrow = t.nrows()
+        t.close()
+
+        t_ant = pt.table(vis + '/ANTENNA', ack=False)
+        self.antennas = list(t_ant.getcol('NAME'))
+        self.dish_diameters = t_ant.getcol('DISH_DIAMETER')
+        t_ant.close()
+
+        t_spw = pt.table(vis + '/SPECTRAL_WINDOW', ack=False)
+        self.nspw = t_spw.nrows()
+        self.chan_freq = t_spw.getcol('CHAN_FREQ')[0]
+        t_spw.close()
+        self.nchan = len(self.chan_freq)
+
+        t_pol = pt.table(vis + '/POLARIZATION', ack=False)
+        self.corr_names = [CORR_TYPES.get(corr, '') for corr in t_pol.getcol('CORR_TYPE')[0]]
+        t_pol.close()
+        self.ncorr = len(self.corr_names)
+
+    def _getcol(self, column):
+        """
+        Reads a (small) column of the main table once
+        """
+        if column not in self._meta:
+            t = pt.table(self.vis, ack=False)
+            self._meta[column] = t.getcol(column)
+            t.close()
+        return self._meta[column]
+
+    def _antenna_index(self, name):
+        """
+        Returns the index of an antenna given by name or number
+        """
+        name = name.strip()
+        if name in self.antennas:
+            return self.antennas.index(name)
+        if name.isdigit() and int(name) < len(self.antennas):
+            return int(name)
+        raise UnsupportedFlagCommand('Unknown antenna {0}'.format(name))
+
+    def add_selection(self, rows=None, channels=None, correlations=None):
+        """
+        Adds a selection to flag. Data is flagged where all given masks are True.
+
+        rows (numpy array): Boolean mask over the rows of the main table
+        channels (numpy array): Boolean mask over the channels
+        correlations (numpy array): Boolean mask over the correlations
+        """
+        self.selections.append((rows, channels, correlations))
+
+    def flag_rows(self, rows):
+        self.add_selection(rows=rows)
+
+    def flag_autocorr(self):
+        """
+        Flag all auto-correlations
+        """
+        self.flag_rows(self._getcol('ANTENNA1') == self._getcol('ANTENNA2'))
+
+    def flag_antenna(self, antenna):
+        """
+        Flag antennas and baselines
+
+        antenna (str): Comma separated antennas or baselines, e.g. 'RT2,RT3' or 'RT2&RT3,RT5&RT6'
+        """
+        ant1 = self._getcol('ANTENNA1')
+        ant2 = self._getcol('ANTENNA2')
+        rows = np.zeros(self.nrow, dtype=bool)
+        for item in antenna.split(','):
+            if item.strip() == '':
+                continue
+            if re.search(r'[!;*^<>~]|&&', item):
+                raise UnsupportedFlagCommand('Unsupported antenna selection {0}'.format(item))
+            if '&' in item:
+                a, b = [self._antenna_index(name) for name in item.split('&')]
+                rows |= ((ant1 == a) & (ant2 == b)) | ((ant1 == b) & (ant2 == a))
+            else:
+                a = self._antenna_index(item)
+                rows |= (ant1 == a) | (ant2 == a)
+        self.flag_rows(rows)
+
+    def flag_correlation(self, correlation):
+        """
+        Flag correlations
+
+        correlation (str): Comma separated correlations, e.g. 'XX,YX'
+        """
+        corrs = np.zeros(self.ncorr, dtype=bool)
+        for item in correlation.upper().split(','):
+            if item.strip() == '':
+                continue
+            if item.strip() not in self.corr_names:
+                raise UnsupportedFlagCommand('Unsupported correlation selection {0}'.format(item))
+            corrs[self.corr_names.index(item.strip())] = True
+        self.add_selection(correlations=corrs)
+
+    def flag_spw(self, spw):
+        """
+        Flag channels of the first spectral window
+
+        spw (str): Spectral window selection, e.g. '0:0;64;128' or '0:0~3054;10977~16384' or '0:1452~1492MHz'
+        """
+        if self.nspw != 1 or not spw.startswith('0:'):
+            raise UnsupportedFlagCommand('Unsupported spectral window selection {0}'.format(spw))
+        chans = np.zeros(self.nchan, dtype=bool)
+        for item in spw[2:].split(';'):
+            item = item.strip()
+            if item == '':
+                continue
+            unit = re.search(r'([kKmMgG]?[hH][zZ])$', item)
+            if unit:
+                scale = FREQ_UNITS[unit.group(1).lower()]
+                limits = [float(freq) * scale for freq in item[:unit.start()].split('~')]
+                chans |= (self.chan_freq >= min(limits)) & (self.chan_freq <= max(limits))
+            elif re.match(r'^\d+(~\d+)?$', item):
+                limits = [int(chan) for chan in item.split('~')]
+                chans[limits[0]:limits[-1] + 1] = True
+            else:
+                raise UnsupportedFlagCommand('Unsupported channel selection {0}'.format(item))
+        self.add_selection(channels=chans)
+
+    def _parse_time(self, timestr, day):
+        """
+        Converts a CASA time string (YYYY/MM/DD/hh:mm:ss or hh:mm:ss) to MJD seconds
+        """
+        match = re.match(r'^(?:(\d{4})/(\d{1,2})/(\d{1,2})/)?(\d{1,2}):(\d{1,2})(?::(\d{1,2}(?:\.\d*)?))?$',
+                         timestr.strip())
+        if not match:
+            raise UnsupportedFlagCommand('Unsupported time {0}'.format(timestr))
+        year, month, mday, hours, minutes, seconds = match.groups()
+        tod = int(hours) * 3600.0 + int(minutes) * 60.0 + float(seconds or 0.0)
+        if year is not None:
+            day = (datetime(int(year), int(month), int(mday)) - MJD_EPOCH).days * 86400.0
+        return day + tod
+
+    def flag_timerange(self, timerange):
+        """
+        Flag time ranges. Times without a date refer to the day of the first integration in the dataset.
+
+        timerange (str): Comma separated time ranges, e.g. '09:14:0~09:54:0'
+        """
+        times = self._getcol('TIME')
+        day = np.floor(times.min() / 86400.0) * 86400.0
+        rows = np.zeros(self.nrow, dtype=bool)
+        for item in timerange.split(','):
+            if item.strip() == '':
+                continue
+            limits = item.split('~')
+            if len(limits) != 2:
+                raise UnsupportedFlagCommand('Unsupported time range {0}'.format(item))
+            start, end = [self._parse_time(limit, day) for limit in limits]
+            rows |= (times >= start) & (times <= end)
+        self.flag_rows(rows)
+
+    def flag_shadow(self, tolerance=0.0):
+        """
+        Flag shadowed antennas. An antenna is shadowed at a timestamp if the projected distance to another antenna is
+        smaller than the sum of their dish radii and it is behind that antenna. All baselines to a shadowed antenna
+        are flagged for that timestamp.
+
+        tolerance (float): Amount of overlap in metres that is allowed
+        """
+        ant1 = self._getcol('ANTENNA1')
+        ant2 = self._getcol('ANTENNA2')
+        uvw = self._getcol('UVW')
+        _, tidx = np.unique(self._getcol('TIME'), return_inverse=True)
+        nant = len(self.antennas)
+
+        limit = 0.5 * (self.dish_diameters[ant1] + self.dish_diameters[ant2]) - tolerance
+        shadowing = (ant1 != ant2) & (np.hypot(uvw[:, 0], uvw[:, 1]) < limit)
+        # The antenna further away from the source along w is the one shadowed
+        shadowed = np.where(uvw[:, 2] > 0, ant1, ant2)
+        events = np.unique(tidx[shadowing] * nant + shadowed[shadowing])
+        rows = np.isin(tidx * nant + ant1, events) | np.isin(tidx * nant + ant2, events)
+        if np.any(rows):
+            logger.debug('Found {0} shadowed rows in {1}'.format(np.sum(rows), self.vis))
+        self.flag_rows(rows)
+
+    def flag_clipzeros(self):
+        """
+        Flag visibilities in the DATA column that are exactly zero or not finite, like flagdata with clipzeros
+        """
+        self.clipzeros = True
+
+    def add_command(self, command):
+        """
+        Adds a flag command given as flagdata parameters
+
+        command (dict): Parameters for flagdata, e.g. {'mode': 'shadow'} or {'spw': '0:0;64'}
+        """
+        params = dict(command)
+        mode = params.pop('mode', 'manual')
+        if mode == 'shadow' and not params:
+            self.flag_shadow()
+        elif mode == 'clip' and params == {'clipzeros': True}:
+            self.flag_clipzeros()
+        elif mode == 'manual' and len(params) == 1:
+            key, value = params.popitem()
+            if key == 'autocorr' and value is True:
+                self.flag_autocorr()
+            elif key == 'antenna':
+                self.flag_antenna(value)
+            elif key == 'correlation':
+                self.flag_correlation(value)
+            elif key == 'spw':
+                self.flag_spw(value)
+            elif key == 'timerange':
+                self.flag_timerange(value)
+            else:
+                raise UnsupportedFlagCommand('Unsupported flag command {0}'.format(command))
+        else:
+            raise UnsupportedFlagCommand('Unsupported flag command {0}'.format(command))
+
+    def _merged_selections(self):
+        """
+        Combines all selections that only act on rows, channels or correlations into a single mask each
+        """
+        rows = np.zeros(self.nrow, dtype=bool)
+        chans = np.zeros(self.nchan, dtype=bool)
+        corrs = np.zeros(self.ncorr, dtype=bool)
+        other = []
+        for sel_rows, sel_chans, sel_corrs in self.selections:
+            given = [mask is not None for mask in (sel_rows, sel_chans, sel_corrs)]
+            if given == [True, False, False]:
+                rows |= sel_rows
+            elif given == [False, True, False]:
+                chans |= sel_chans
+            elif given == [False, False, True]:
+                corrs |= sel_corrs
+            else:
+                other.append((sel_rows, sel_chans, sel_corrs))
+        return rows, chans, corrs, other
+
+    def iter_chunks(self):
+        """
+        Iterates over the main table in blocks of rows
+
+        returns (generator): Tuples of the first row and the number of rows in each block
+        """
+        for start in range(0, self.nrow, self.chunksize):
+            yield start, min(self.chunksize, self.nrow - start)
+
+    def apply(self):
+        """
+        Applies all collected flags to the FLAG column of the dataset
+
+        returns (int): Number of newly flagged visibilities
+        """
+        if not self.selections and not self.clipzeros:
+            return 0
+        rows, chans, corrs, other = self._merged_selections()
+        nflagged = 0
+        t = pt.table(self.vis, readonly=False, ack=False)
+        has_flag_row = 'FLAG_ROW' in t.colnames()
+        for start, nrow in self.iter_chunks():
+            flags = t.getcol('FLAG', startrow=start, nrow=nrow)
+            new = flags | rows[start:start + nrow, np.newaxis, np.newaxis]
+            new |= chans[np.newaxis, :, np.newaxis]
+            new |= corrs[np.newaxis, np.newaxis, :]
+            for sel_rows, sel_chans, sel_corrs in other:
+                mask = np.ones(flags.shape, dtype=bool)
+                if sel_rows is not None:
+                    mask &= sel_rows[start:start + nrow, np.newaxis, np.newaxis]
+                if sel_chans is not None:
+                    mask &= sel_chans[np.newaxis, :, np.newaxis]
+                if sel_corrs is not None:
+                    mask &= sel_corrs[np.newaxis, np.newaxis, :]
+                new |= mask
+            if self.clipzeros:
+                # Like flagdata with clipzeros, zeros and non-finite values are flagged
+                data = t.getcol('DATA', startrow=start, nrow=nrow)
+                new |= (data == 0) | ~np.isfinite(data)
+            changed = np.sum(new & ~flags)
+            if changed:
+                nflagged += changed
+                t.putcol('FLAG', new, startrow=start, nrow=nrow)
+                if has_flag_row:
+                    flag_row = t.getcol('FLAG_ROW', startrow=start, nrow=nrow)
+                    t.putcol('FLAG_ROW', flag_row | np.all(new, axis=(1, 2)), startrow=start, nrow=nrow)
+        t.close()
+        return nflagged
+
+
+def apply_flag_commands(vis, commands, chunksize=10000):
+    """
+    Applies flag commands to a measurement set natively where possible
+
+    vis (str): Path to the measurement set
+    commands (list): Flag commands as dictionaries of flagdata parameters
+    chunksize (int): Number of rows to read and write at once
+    returns (list): The commands that could not be applied and need to be run with CASA
+    """
+    flagger = MSFlagger(vis, chunksize=chunksize)
+    remaining = []
+    for command in commands:
+        try:
+            flagger.add_command(command)
+        except UnsupportedFlagCommand as e:
+            logger.debug('{0}, using CASA instead'.format(e))
+            remaining.append(command)
+    nflagged = flagger.apply()
+    logger.debug('Flagged {0} visibilities in {1} with {2} command(s)'.format(
+        nflagged, vis, len(commands) - len(remaining)))
+    return remaining
@@ -1,19 +1,298 @@
 import os
+import copy
+import pickle
+import sqlite3
 import logging
+import tempfile
+from contextlib import contextmanager
+
 import numpy as np
 
 from apercal.subs import setinit as subs_setinit
 
 logger = logging.getLogger(__name__)
 
+# In-memory copies of the parameter files of this process. Every entry holds the parameter dictionary, the
+# signature (mtime, size, inode) of the file it was read from and a flag if it has unwritten changes.
+_param_cache = {}
+
+# Nesting depth of the active param_batch blocks for each parameter file
+_param_batches = {}
+
+# Parameter changes for the database backend, which are held back inside a param_batch block.
+# Maps (database path, parameter file name) to a dictionary of parameter names and values.
+_param_db_pending = {}
+
+# Open database connections of this process, maps the database path to (process id, connection)
+_param_db_connections = {}
+
+# Marker for a parameter deleted inside a param_batch block
+_DELETED = object()
+
+# Seconds to wait for a write lock of the parameter database held by another process
+PARAM_DB_TIMEOUT = 600
+
+
+def _get_param_path(step):
+    """
+    Returns the absolute path of the parameter file of a step
+    step (object): step for which to get the parameter file
+    """
+    subs_setinit.setinitdirs(step)
+    return os.path.abspath(step.basedir + step.paramfilename)
+
+
+def _get_param_db_key(step):
+    """
+    Returns the location of the parameters of a step if they are kept in a parameter database
+    step (object): step for which to get the location
+    returns (tuple): Absolute path of the database and the name of the parameter file inside the database,
+                     None if the step uses a parameter file
+    """
+    paramdatabase = getattr(step, 'paramdatabase', None)
+    if not paramdatabase:
+        return None
+    subs_setinit.setinitdirs(step)
+    return os.path.abspath(step.basedir + paramdatabase), step.paramfilename
+
+
+def _get_batch_key(step):
+    """
+    Returns the key identifying the parameter storage of a step in the param_batch bookkeeping
+    """
+    return _get_param_db_key(step) or _get_param_path(step)
+
+
+# ++++++++++++++++++++++++++++++++++++++++
+# Parameter files (numpy dictionaries)
+# ++++++++++++++++++++++++++++++++++++++++
+
+def _get_file_signature(path):
+    """
+    Returns a signature of a file, which changes whenever the file is rewritten or replaced
+    path (string): Absolute path of the file
+    returns (tuple): mtime, size and inode of the file, None if the file does not exist
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size, st.st_ino
+
+
+def _load_params(path):
+    """
+    Returns the parameter dictionary of a parameter file. The file is only read from disk if it is not cached
+    yet or if it was changed by someone else since it was last read.
+    path (string): Absolute path of the parameter file
+    returns (dict): The parameter dictionary, None if the file does not exist
+    """
+    entry = _param_cache.get(path)
+    if entry is not None and entry['dirty']:
+        return entry['params']
+    signature = _get_file_signature(path)
+    if signature is None:
+        _param_cache.pop(path, None)
+        return None
+    if entry is None or entry['signature'] != signature:
+        entry = {'params': np.load(path).item(), 'signature': signature, 'dirty': False}
+        _param_cache[path] = entry
+    return entry['params']
+
+
+def _write_params(path, params):
+    """
+    Atomically writes a parameter dictionary to disk. The dictionary is written to a temporary file in the same
+    directory, which is then renamed to the parameter file, so readers never see a partially written file.
+    path (string): Absolute path of the parameter file
+    params (dict): The parameter dictionary to write
+    """
+    fd, temppath = tempfile.mkstemp(prefix='.' + os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, params)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(temppath, 0o666 & ~umask)
+        os.rename(temppath, path)
+    except Exception:
+        _param_cache.pop(path, None)
+        if os.path.exists(temppath):
+            os.remove(temppath)
+        raise
+    _param_cache[path] = {'params': params, 'signature': _get_file_signature(path), 'dirty': False}
+
+
+def _store_params(path, params):
+    """
+    Stores a changed parameter dictionary. Inside a param_batch block the changes are only kept in memory,
+    otherwise they are written to disk directly.
+    path (string): Absolute path of the parameter file
+    params (dict): The changed parameter dictionary
+    """
+    if _param_batches.get(path, 0) > 0:
+        entry = _param_cache.setdefault(path, {'signature': None})
+        entry['params'] = params
+        entry['dirty'] = True
+    else:
+        _write_params(path, params)
+
+
+# ++++++++++++++++++++++++++++++++++++++++
+# Parameter database (SQLite)
+# ++++++++++++++++++++++++++++++++++++++++
+
+def _get_db_connection(dbpath):
+    """
+    Returns a connection to a parameter database and creates the database if it does not exist.
+    Connections are not shared between processes, so forked worker processes open their own.
+    dbpath (string): Absolute path of the database
+    returns (sqlite3.Connection): The database connection
+    """
+    pid, conn = _param_db_connections.get(dbpath, (None, None))
+    if pid != os.getpid():
+        conn = sqlite3.connect(dbpath, timeout=PARAM_DB_TIMEOUT, isolation_level=None)
+        conn.execute('CREATE TABLE IF NOT EXISTS params (paramfile TEXT NOT NULL, name TEXT NOT NULL, '
+                     'value BLOB NOT NULL, PRIMARY KEY (paramfile, name))')
+        conn.execute('CREATE INDEX IF NOT EXISTS params_name ON params (name)')
+        _param_db_connections[dbpath] = (os.getpid(), conn)
+    return conn
+
+
+def _db_write(dbkey, changes):
+    """
+    Writes parameter changes to the database in a single transaction. Only the rows of the changed parameters
+    are touched, so processes working on different parameters or parameter files do not overwrite each other.
+    dbkey (tuple): Database path and parameter file name
+    changes (dict): Parameter names and their new values, _DELETED for parameters to remove
+    """
+    dbpath, paramfile = dbkey
+    conn = _get_db_connection(dbpath)
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        for name, value in changes.items():
+            if value is _DELETED:
+                conn.execute('DELETE FROM params WHERE paramfile = ? AND name = ?', (paramfile, name))
+            else:
+                conn.execute('INSERT OR REPLACE INTO params (paramfile, name, value) VALUES (?, ?, ?)',
+                             (paramfile, name, sqlite3.Binary(pickle.dumps(value, 2))))
+        conn.execute('COMMIT')
+    except Exception:
+        conn.execute('ROLLBACK')
+        raise
+
+
+def _db_store(dbkey, changes):
+    """
+    Stores parameter changes. Inside a param_batch block the changes are only kept in memory, otherwise they
+    are written to the database directly.
+    """
+    if _param_batches.get(dbkey, 0) > 0:
+        _param_db_pending.setdefault(dbkey, {}).update(changes)
+    else:
+        _db_write(dbkey, changes)
+
+
+def _db_get(dbkey, parameter):
+    """
+    Reads a parameter from the database, taking changes held back by a param_batch block into account
+    returns (tuple): True and the value if the parameter exists, otherwise False and None
+    """
+    pending = _param_db_pending.get(dbkey, {})
+    if parameter in pending:
+        if pending[parameter] is _DELETED:
+            return False, None
+        return True, pending[parameter]
+    dbpath, paramfile = dbkey
+    row = _get_db_connection(dbpath).execute('SELECT value FROM params WHERE paramfile = ? AND name = ?',
+                                             (paramfile, parameter)).fetchone()
+    if row is None:
+        return False, None
+    return True, pickle.loads(bytes(row[0]))
+
+
+def _db_exists(dbkey):
+    """
+    Checks if there are any parameters stored for a parameter file in the database
+    """
+    if dbkey in _param_db_pending:
+        return True
+    dbpath, paramfile = dbkey
+    if not os.path.isfile(dbpath):
+        return False
+    row = _get_db_connection(dbpath).execute('SELECT 1 FROM params WHERE paramfile = ? LIMIT 1',
+                                             (paramfile,)).fetchone()
+    return row is not None
+
+
+def _db_get_all(dbkey):
+    """
+    Reads all parameters of a parameter file from the database
+    returns (dict): Parameter names and values
+    """
+    dbpath, paramfile = dbkey
+    rows = _get_db_connection(dbpath).execute('SELECT name, value FROM params WHERE paramfile = ?',
+                                              (paramfile,)).fetchall()
+    d = dict((name, pickle.loads(bytes(value))) for name, value in rows)
+    for name, value in _param_db_pending.get(dbkey, {}).items():
+        if value is _DELETED:
+            d.pop(name, None)
+        else:
+            d[name] = value
+    return d
+
+
+# ++++++++++++++++++++++++++++++++++++++++
+# Public interface
+# ++++++++++++++++++++++++++++++++++++++++
+
+def flush_params(step):
+    """
+    Writes all parameter changes of a step, which are only held in memory, to the parameter file
+    step (object): step for which to do this
+    """
+    dbkey = _get_param_db_key(step)
+    if dbkey:
+        changes = _param_db_pending.pop(dbkey, None)
+        if changes:
+            _db_write(dbkey, changes)
+    else:
+        path = _get_param_path(step)
+        entry = _param_cache.get(path)
+        if entry is not None and entry['dirty']:
+            _write_params(path, entry['params'])
+
+
+@contextmanager
+def param_batch(step):
+    """
+    Context manager to collect all parameter changes of a step in memory and write them to the parameter file
+    in one go when the block is left, also if the block is left with an exception. Blocks can be nested, the file
+    is then written when the outermost block is left. Use flush_params to write a checkpoint within a block.
+    step (object): step for which to do this
+    """
+    key = _get_batch_key(step)
+    _param_batches[key] = _param_batches.get(key, 0) + 1
+    try:
+        yield
+    finally:
+        _param_batches[key] -= 1
+        if _param_batches[key] == 0:
+            del _param_batches[key]
+            flush_params(step)
+
 
 def create_param_file(step):
     """
     Create a new parameter file in case there is none in the base directory as a dictionary
     """
-    subs_setinit.setinitdirs(step)
-    df = {}
-    np.save(step.basedir + step.paramfilename, df)
+    dbkey = _get_param_db_key(step)
+    if dbkey:
+        _get_db_connection(dbkey[0])
+    else:
+        path = _get_param_path(step)
+        _store_params(path, {})
 
 
 def add_param(step, parameter, values):
@@ -22,12 +301,16 @@ def add_param(step, parameter, values):
     parameter(string): Name of the parameter in the param file
     values(diverse): The data corresponding to the parameter
     """
-    subs_setinit.setinitdirs(step)
-    if not os.path.isfile(step.basedir + step.paramfilename):
-        create_param_file(step)
-    d = np.load(step.basedir + step.paramfilename).item()
-    d[parameter] = values
-    np.save(step.basedir + step.paramfilename, d)
+    dbkey = _get_param_db_key(step)
+    if dbkey:
+        _db_store(dbkey, {parameter: copy.deepcopy(values)})
+        return
+    path = _get_param_path(step)
+    d = _load_params(path)
+    if d is None:
+        d = {}
+    d[parameter] = copy.deepcopy(values)
+    _store_params(path, d)
 
 
 def del_param(step, parameter):
@@ -35,14 +318,23 @@ def del_param(step, parameter):
     Delete a parameter from the parameter file.
     parameter(string): Name of the parameter to delete
     """
-    subs_setinit.setinitdirs(step)
-    if not os.path.isfile(step.basedir + step.paramfilename):
+    dbkey = _get_param_db_key(step)
+    if dbkey:
+        if not _db_exists(dbkey):
+            logger.info('Parameter file not found! Cannot remove parameter ' + str(parameter))
+        elif not _db_get(dbkey, parameter)[0]:
+            logger.info('Parameter file does not have parameter ' + str(parameter))
+        else:
+            _db_store(dbkey, {parameter: _DELETED})
+        return
+    path = _get_param_path(step)
+    d = _load_params(path)
+    if d is None:
         logger.info('Parameter file not found! Cannot remove parameter ' + str(parameter))
     else:
-        d = np.load(step.basedir + step.paramfilename).item()
         try:
             del d[parameter]
-            np.save(step.basedir + step.paramfilename, d)
+            _store_params(path, d)
         except KeyError:
             logger.info('Parameter file does not have parameter ' + str(parameter))
 
@@ -53,12 +345,21 @@ def get_param(step, parameter):
     parameter (string): Name of the keyword to load
     returns (various): The variable for the parameter
     """
-    subs_setinit.setinitdirs(step)
-    if not os.path.isfile(step.basedir + step.paramfilename):
+    dbkey = _get_param_db_key(step)
+    if dbkey:
+        if not _db_exists(dbkey):
+            logger.error('Parameter file not found! Cannot load parameter ' + str(parameter))
+            return None
+        found, values = _db_get(dbkey, parameter)
+        if not found:
+            raise KeyError(parameter)
+        return copy.deepcopy(values)
+    path = _get_param_path(step)
+    d = _load_params(path)
+    if d is None:
         logger.error('Parameter file not found! Cannot load parameter ' + str(parameter))
     else:
-        d = np.load(step.basedir + step.paramfilename).item()
-        values = d[parameter]
+        values = copy.deepcopy(d[parameter])
         return values
 
 
@@ -66,19 +367,25 @@ def get_param_def(step, parameter, default):
     """
     Load a keyword of the paramterfile into a variable, or give a default value if
     the keyword is not in the parameter file
-    TODO: merge this into get_param to avoid loading param.npy too often
     step (object): step for which to do this
     parameter (string): name of the keyword to load
     parameter (object): default value
     """
-    subs_setinit.setinitdirs(step)
-    if not os.path.isfile(step.basedir + step.paramfilename):
+    dbkey = _get_param_db_key(step)
+    if dbkey:
+        if not os.path.isfile(dbkey[0]) and dbkey not in _param_db_pending:
+            return default
+        found, values = _db_get(dbkey, parameter)
+        if found:
+            return copy.deepcopy(values)
         return default
-    else:
-        d = np.load(step.basedir + step.paramfilename).item()
-        if parameter in d:
-            # logger.info('Parameter ' + str(parameter) + ' found in cache (param.npy).')
-            return d[parameter]
+    path = _get_param_path(step)
+    d = _load_params(path)
+    if d is None:
+        return default
+    if parameter in d:
+        # logger.info('Parameter ' + str(parameter) + ' found in cache (param.npy).')
+        return copy.deepcopy(d[parameter])
     return default
 
 
@@ -88,14 +395,16 @@ def check_param(step, parameter):
     parameter (list of strings): The parameters to search for
     returns (bool): True if parameter exists, otherwise False
     """
-    subs_setinit.setinitdirs(step)
-    if not os.path.isfile(step.basedir + step.paramfilename):
+    dbkey = _get_param_db_key(step)
+    if dbkey:
+        return _db_get(dbkey, parameter)[0]
+    path = _get_param_path(step)
+    d = _load_params(path)
+    if d is None:
         logger.info('Parameter file not found! Cannot load parameter ' + str(parameter))
         create_param_file(step)
-    else:
-        d = np.load(step.basedir + step.paramfilename).item()
-        if parameter in d:
-            return True
+    elif parameter in d:
+        return True
     return False
 
 
@@ -103,10 +412,18 @@ def show_param(step):
     """
     Shows all the entries of the parameter file in a sorted order
     """
-    subs_setinit.setinitdirs(step)
-    if not os.path.isfile(step.basedir + step.paramfilename):
+    dbkey = _get_param_db_key(step)
+    if dbkey:
+        if not _db_exists(dbkey):
+            logger.info('Parameter file not found!')
+        else:
+            for k, v in _db_get_all(dbkey).items():
+                logger.info(k, v)
+        return
+    path = _get_param_path(step)
+    d = _load_params(path)
+    if d is None:
         logger.info('Parameter file not found!')
     else:
-        d = np.load(step.basedir + step.paramfilename).item()
         for k, v in d.items():
             logger.info(k, v)
@@ -1,16 +1,11 @@
 import os
-import random
-import string
 import logging
 
-import astropy.io.fits as pyfits
 import numpy as np
-import scipy.stats
-
-from backports import tempfile
 
 from apercal.libs import lib
 from apercal.subs import setinit
+from apercal.subs import mirio
 from apercal.exceptions import ApercalException
 from apercal.subs import imstats
 
@@ -24,30 +19,12 @@ def checkimagegaussianity(self, image, alpha):
     returns (boolean): True if image is ok, False otherwise
     """
     setinit.setinitdirs(self)
-    char_set = string.ascii_uppercase + string.digits
     if os.path.isdir(image) or os.path.isfile(image):
-        with tempfile.TemporaryDirectory() as tempdir:
-            if os.path.isdir(image):
-                temp_string = ''.join(random.sample(char_set * 8, 8))
-                fits = lib.miriad('fits')
-                fits.op = 'xyout'
-                fits.in_ = image
-                fits.out = tempdir + '/' + temp_string + '.fits'
-                fits.go()
-                pyfile = pyfits.open(tempdir + '/' + temp_string + '.fits')
-            elif os.path.isfile(image):
-                pyfile = pyfits.open(image)
-            else:
-                error = 'Image format not supported. Only MIRIAD and FITS formats are supported!'
-                logger.error(error)
-                raise ApercalException(error)
-            image = pyfile[0].data[0][0]
-            pyfile.close()
-            k2, p = scipy.stats.normaltest(image, nan_policy='omit', axis=None)
-            if p < alpha:
-                return True
-            else:
-                return False
+        p = imstats.getstats(image, pvalue=True)['pvalue']
+        if p < alpha:
+            return True
+        else:
+            return False
     else:
         error = 'Image {} does not seem to exist!'.format(image)
         logger.error(error)
@@ -149,14 +126,54 @@ def fieldflux(infile):
     clean.out = 'fluxmodel'
     clean.niters = 10000
     clean.go()
-    fits = lib.miriad('fits')
-    fits.in_ = clean.out
-    fits.op = 'xyout'
-    fits.out = clean.out + '.fits'
-    fits.go()
-    pyfile = pyfits.open(fits.out)
-    image = pyfile[0].data[0][0]
-    pyfile.close()
+    image = mirio.getimagedata(clean.out)[0][0]
     intflux = np.sum(image)
     os.system('rm -rf flux*')
     return intflux
+
+
+def getgainchange(self, dataset, reference):
+    """
+    Calculates how much the gains of a dataset changed compared to an earlier set of gains. Each solution is compared
+    to the solution of the reference closest in time.
+    dataset (string): The MIRIAD uv dataset with the current gains
+    reference (string): A MIRIAD dataset or directory with the earlier gains and header items
+    returns (float): The median of abs(gain / reference gain - 1) over all valid gains, None if one of the gains is missing
+    """
+    current = mirio.readgains(dataset)
+    previous = mirio.readgains(reference)
+    if current is None or previous is None or current[1].shape[1] != previous[1].shape[1] or len(previous[0]) == 0:
+        return None
+    nearest = np.abs(current[0][:, np.newaxis] - previous[0][np.newaxis, :]).argmin(axis=1)
+    gains, refgains = current[1], previous[1][nearest]
+    valid = (np.abs(gains) > 0) & (np.abs(refgains) > 0)
+    if not np.any(valid):
+        return None
+    return float(np.median(np.abs(gains[valid] / refgains[valid] - 1.0)))
+
+
+def checkconvergence(self, residualrms, modelflux, fraction, gainchange=None, ncycles=1):
+    """
+    Checks if iterative cleaning or self-calibration converged. This is the case if the rms of the residual image
+    decreased and the flux of the model increased by less than a fraction in each of the last ncycles cycles and the
+    gains changed by less than that fraction.
+    residualrms (list): The rms of the residual image of each cycle so far
+    modelflux (list): The flux of the clean model of each cycle so far
+    fraction (float): The relative improvement below which the iterations are converged, no check if None or 0
+    gainchange (float): The relative change of the gains in the last cycle as returned by getgainchange or None
+    ncycles (int): Number of consecutive cycles which need to improve by less than the fraction
+    returns (boolean): True if converged, False otherwise
+    """
+    if not fraction or len(residualrms) < ncycles + 1 or len(modelflux) < ncycles + 1:
+        return False
+    rms = np.asarray(residualrms[-(ncycles + 1):], dtype=float)
+    flux = np.asarray(modelflux[-(ncycles + 1):], dtype=float)
+    if not np.all(np.isfinite(rms)) or not np.all(np.isfinite(flux)) or np.any(rms[:-1] <= 0) or np.any(flux[:-1] <= 0):
+        return False
+    rmsimprovement = (rms[:-1] - rms[1:]) / rms[:-1]
+    fluxincrease = (flux[1:] - flux[:-1]) / flux[:-1]
+    converged = np.all(rmsimprovement < fraction) and np.all(fluxincrease < fraction) and (gainchange is None or gainchange < fraction)
+    logger.debug('Residual rms improved by {0}, model flux increased by {1}, gains changed by {2}'.format(
+        ', '.join('{0:.2%}'.format(v) for v in rmsimprovement), ', '.join('{0:.2%}'.format(v) for v in fluxincrease),
+        'n/a' if gainchange is None else '{0:.2%}'.format(gainchange)))
+    return bool(converged)
@@ -2,9 +2,48 @@ import re
 
 import numpy as np
 from astropy import units as u
-from astropy.coordinates import FK5, SkyCoord
+from astropy.coordinates import FK5, SkyCoord, Angle
 
 from apercal.libs import lib
+from apercal.subs import mirio
+from apercal.exceptions import ApercalException
+
+
+def getheader(infile, keys):
+    """
+    getheader: Get several header items of a MIRIAD dataset at once
+    infile (string): input dataset in MIRIAD format
+    keys (list): names of the header items, e.g. ['bmaj', 'bmin', 'bpa']
+    returns (dict): The values of the header items
+    """
+    header = mirio.readheader(infile, keys)
+    missing = [key for key in keys if key not in header]
+    if missing:
+        raise ApercalException('Header item(s) {0} not found in {1}'.format(', '.join(missing), infile))
+    return header
+
+
+def putheader(infile, items):
+    """
+    putheader: Put several header items into a MIRIAD dataset at once
+    infile (string): input dataset in MIRIAD format
+    items (dict): names and values of the header items
+    """
+    mirio.writeheader(infile, items)
+
+
+def formatangle(value, hours=False):
+    """
+    formatangle: Format an angle in radians like prthd does
+    value (float): The angle in radians
+    hours (bool): Format as hh:mm:ss.sss instead of dd:mm:ss.ss
+    returns (string): The formatted angle
+    """
+    if hours:
+        angle = Angle(value, unit=u.rad).wrap_at(360 * u.deg)
+        return angle.to_string(unit=u.hour, sep=':', precision=3, pad=True)
+    else:
+        return Angle(value, unit=u.rad).to_string(unit=u.deg, sep=':', precision=2, pad=True)
 
 
 def getraimage(infile):
@@ -13,10 +52,7 @@ def getraimage(infile):
     infile (string): input image file in MIRIAD format
     returns: RA coordinates of the image in hh:mm:ss.sss
     """
-    prthd = lib.basher('prthd in=' + infile)
-    regex = re.compile(".*(RA---NCP).*")
-    coordline = [m.group(0) for l in prthd for m in [regex.search(l)] if m][0].split()
-    ra = coordline[2]
+    ra = formatangle(getheader(infile, ['crval1'])['crval1'], hours=True)
     return ra
 
 
@@ -26,10 +62,7 @@ def getdecimage(infile):
     infile (string): input image file in MIRIAD format
     returns: DEC coordinates dd:mm:ss.sss
     """
-    prthd = lib.basher('prthd in=' + infile)
-    regex = re.compile(".*(DEC--NCP).*")
-    coordline = [m.group(0) for l in prthd for m in [regex.search(l)] if m][0].split()
-    dec = coordline[2]
+    dec = formatangle(getheader(infile, ['crval2'])['crval2'])
     return dec
 
 
@@ -39,7 +72,7 @@ def getbmajimage(infile):
     infile (string): input image file in MIRIAD format
     returns (float): BMAJ in arcseconds of the image
     """
-    bmaj = np.float(lib.basher('gethd in=' + infile + '/bmaj')[0]) * 3600.0 * (360.0 / (2.0 * np.pi))
+    bmaj = float(getheader(infile, ['bmaj'])['bmaj']) * 3600.0 * (360.0 / (2.0 * np.pi))
     return bmaj
 
 
@@ -49,7 +82,7 @@ def getbminimage(infile):
     infile (string): input image file in MIRIAD format
     returns (float): BMIN in arcseconds of the image
     """
-    bmin = np.float(lib.basher('gethd in=' + infile + '/bmin')[0]) * 3600.0 * (360.0 / (2.0 * np.pi))
+    bmin = float(getheader(infile, ['bmin'])['bmin']) * 3600.0 * (360.0 / (2.0 * np.pi))
     return bmin
 
 
@@ -59,20 +92,21 @@ def getbpaimage(infile):
     infile (string): input image file in MIRIAD format
     returns (float): BPA in degrees of the image
     """
-    bpa = np.float(lib.basher('gethd in=' + infile + '/bpa')[0])
+    bpa = float(getheader(infile, ['bpa'])['bpa'])
     return bpa
 
 
 def getbeamimage(infile):
     """
-    Uses the three functions above to return the beam parameters of an image (bmaj, bmin, bpa)
+    Reads the beam parameters of an image (bmaj, bmin, bpa) with a single read of the header
     infile (string): input image file in MIRIAD format
     returns (numpyarray): The bmaj, bmin, bpa of the image
     """
+    header = getheader(infile, ['bmaj', 'bmin', 'bpa'])
     beamarray = np.full(3, np.nan)
-    beamarray[0] = getbmajimage(infile)
-    beamarray[1] = getbminimage(infile)
-    beamarray[2] = getbpaimage(infile)
+    beamarray[0] = float(header['bmaj']) * 3600.0 * (360.0 / (2.0 * np.pi))
+    beamarray[1] = float(header['bmin']) * 3600.0 * (360.0 / (2.0 * np.pi))
+    beamarray[2] = float(header['bpa'])
     return beamarray
 
 
@@ -83,7 +117,7 @@ def putbmajimage(infile, bmajvalue):
     bmajvalue (float): The major axis value in arcseconds
     """
     bmajval = bmajvalue / 3600.0 / (360.0 / (2.0 * np.pi))
-    lib.basher('puthd in=' + infile + '/bmaj value=' + str(bmajval))
+    putheader(infile, {'bmaj': float(bmajval)})
 
 
 def putbminimage(infile, bminvalue):
@@ -93,7 +127,7 @@ def putbminimage(infile, bminvalue):
     bminvalue (float): The minor axis value in arcseconds
     """
     bminval = bminvalue / 3600.0 / (360.0 / (2.0 * np.pi))
-    lib.basher('puthd in=' + infile + '/bmin value=' + str(bminval))
+    putheader(infile, {'bmin': float(bminval)})
 
 
 def putbpaimage(infile, bpavalue):
@@ -103,18 +137,18 @@ def putbpaimage(infile, bpavalue):
     bpavalue (float): The position angle in degrees
     """
     bpaval = bpavalue
-    lib.basher('puthd in=' + infile + '/bpa value=' + str(bpaval))
+    putheader(infile, {'bpa': float(bpaval)})
 
 
 def putbeamimage(infile, beamparams):
     """
-    putbeamimage: Put the beam parameters into a MIRIAD image
+    putbeamimage: Put the beam parameters into a MIRIAD image with a single write of the header
     infile (string): input image file in MIRIAD format
     beamparams(array): The major, minor axis and position angle to put in
     """
-    putbmajimage(infile, beamparams[0])
-    putbminimage(infile, beamparams[1])
-    putbpaimage(infile, beamparams[2])
+    putheader(infile, {'bmaj': float(beamparams[0]) / 3600.0 / (360.0 / (2.0 * np.pi)),
+                       'bmin': float(beamparams[1]) / 3600.0 / (360.0 / (2.0 * np.pi)),
+                       'bpa': float(beamparams[2])})
 
 
 def getradec(infile):
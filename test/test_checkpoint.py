@@ -0,0 +1,100 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+from apercal.subs import checkpoint
+
+
+def write(path, content):
+    with open(path, 'wb') as f:
+        f.write(content)
+
+
+class Step(object):
+    selfcal_phase_majorcycle = 3
+    selfcal_phase_uvmin = [0.5, 0.3, 0.0]
+    selfcal_amp = 'auto'
+    continuum_mfimage = True
+
+    def selfcal_phase_method(self):
+        pass
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.dataset = os.path.join(self.tmpdir, 'target.mir')
+        os.mkdir(self.dataset)
+        write(os.path.join(self.dataset, 'header'), b'header v1')
+        write(os.path.join(self.dataset, 'gains'), b'gains v1')
+        write(os.path.join(self.dataset, 'visdata'), b'visibilities')
+        write(os.path.join(self.dataset, 'history'), b'history')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_output_hash(self):
+        self.assertIsNone(checkpoint.get_output_hash(os.path.join(self.tmpdir, 'missing')))
+        before = checkpoint.get_output_hash(self.dataset)
+        # The history is not part of the hash
+        write(os.path.join(self.dataset, 'history'), b'more history')
+        self.assertEqual(checkpoint.get_output_hash(self.dataset), before)
+        write(os.path.join(self.dataset, 'visdata'), b'visibilities changed')
+        self.assertNotEqual(checkpoint.get_output_hash(self.dataset), before)
+        # Single files are hashed as well
+        path = os.path.join(self.tmpdir, 'file.txt')
+        write(path, b'content')
+        self.assertEqual(checkpoint.get_output_hash(path), checkpoint.get_output_hash(path))
+        self.assertNotEqual(checkpoint.get_output_hash(path), before)
+
+    def test_items_hash(self):
+        before = checkpoint.get_items_hash(self.dataset)
+        write(os.path.join(self.dataset, 'visdata'), b'visibilities changed')
+        self.assertEqual(checkpoint.get_items_hash(self.dataset), before)
+        # Missing and empty items give different hashes
+        write(os.path.join(self.dataset, 'gainsf'), b'')
+        self.assertNotEqual(checkpoint.get_items_hash(self.dataset), before)
+
+    def test_save_restore(self):
+        checkpointdir = os.path.join(self.tmpdir, 'checkpoint', '00')
+        saved = checkpoint.save_items(self.dataset, checkpointdir)
+        self.assertEqual(saved, checkpoint.get_items_hash(self.dataset))
+        self.assertEqual(sorted(os.listdir(checkpointdir)), ['gains', 'header'])
+
+        write(os.path.join(self.dataset, 'header'), b'header v2')
+        write(os.path.join(self.dataset, 'gains'), b'gains v2')
+        write(os.path.join(self.dataset, 'gainsf'), b'gainsf v2')
+        self.assertNotEqual(checkpoint.get_items_hash(self.dataset), saved)
+
+        restored = checkpoint.restore_items(self.dataset, checkpointdir)
+        self.assertEqual(restored, saved)
+        # Items which were not in the checkpoint are removed, other items are not touched
+        self.assertFalse(os.path.exists(os.path.join(self.dataset, 'gainsf')))
+        with open(os.path.join(self.dataset, 'gains'), 'rb') as f:
+            self.assertEqual(f.read(), b'gains v1')
+        self.assertTrue(os.path.exists(os.path.join(self.dataset, 'visdata')))
+
+        # Saving again replaces the previous checkpoint
+        os.remove(os.path.join(self.dataset, 'gains'))
+        checkpoint.save_items(self.dataset, checkpointdir)
+        self.assertEqual(os.listdir(checkpointdir), ['header'])
+
+    def test_config_hash(self):
+        step = Step()
+        prefixes = ('selfcal_phase', 'selfcal_amp')
+        before = checkpoint.get_config_hash(step, prefixes, [self.dataset])
+        self.assertEqual(checkpoint.get_config_hash(step, prefixes, [self.dataset]), before)
+        # Settings of other steps do not matter
+        step.continuum_mfimage = False
+        self.assertEqual(checkpoint.get_config_hash(step, prefixes, [self.dataset]), before)
+        step.selfcal_phase_uvmin = [0.5, 0.3, 0.1]
+        changed = checkpoint.get_config_hash(step, prefixes, [self.dataset])
+        self.assertNotEqual(changed, before)
+        # The size of the visibilities of the input datasets is part of the hash
+        write(os.path.join(self.dataset, 'visdata'), b'more visibilities')
+        self.assertNotEqual(checkpoint.get_config_hash(step, prefixes, [self.dataset]), changed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import unittest
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from apercal.subs import linmos
+from apercal.subs import mirio
+from test_mirio import make_image
+
+NY = 12
+NX = 10
+
+
+def direct_mosaic(beams, images, inv_cov):
+    """
+    Calculates the variance map and the weighted image sum of a linear mosaic directly with numpy
+    """
+    beams = [np.nan_to_num(beam) for beam in beams]
+    images = [np.nan_to_num(image) for image in images]
+    variance = sum(inv_cov[i, j] * beams[i] * beams[j] for i in range(len(beams)) for j in range(len(beams)))
+    numerator = sum(inv_cov[i, j] * beams[i] * images[j] for i in range(len(beams)) for j in range(len(beams)))
+    return variance, numerator
+
+
+class TestLinmos(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(2)
+        # Three beams covering different, partly overlapping parts of the mosaic
+        boxes = [(0, 7, 0, 6), (4, 12, 3, 10), (8, 12, 0, 4)]
+        self.beams = []
+        for ymin, ymax, xmin, xmax in boxes:
+            beam = np.zeros((NY, NX), dtype=np.float32)
+            beam[ymin:ymax, xmin:xmax] = rng.uniform(0.1, 1., (ymax - ymin, xmax - xmin))
+            self.beams.append(beam)
+        self.beams[2][0, 0] = np.nan
+        self.images = [rng.normal(0., 1., (NY, NX)).astype(np.float32) for _ in boxes]
+        self.images[1][5, 5] = np.nan
+        self.inv_cov = np.array([[2., 0.5, 0.], [0.5, 1.5, -0.2], [0., -0.2, 1.]])
+        self.beam_maps = []
+        self.image_maps = []
+        for i in range(len(boxes)):
+            self.beam_maps.append(os.path.join(self.tmpdir, 'beam_{0}'.format(i)))
+            self.image_maps.append(os.path.join(self.tmpdir, 'image_{0}'.format(i)))
+            make_image(self.beam_maps[i], self.beams[i])
+            make_image(self.image_maps[i], self.images[i])
+        self.variance_map = os.path.join(self.tmpdir, 'variance')
+        self.numerator_map = os.path.join(self.tmpdir, 'numerator')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_mosaic(self):
+        variance, numerator = direct_mosaic(self.beams, self.images, self.inv_cov)
+        np.testing.assert_allclose(mirio.readimage(self.variance_map), variance, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(mirio.readimage(self.numerator_map), numerator, rtol=1e-5, atol=1e-6)
+
+    def test_footprint(self):
+        self.assertEqual(linmos.footprint(self.beam_maps[0]), (0, 7, 0, 6))
+        self.assertEqual(linmos.footprint(self.beam_maps[2]), (8, 12, 0, 4))
+        self.assertTrue(linmos.overlaps((0, 7, 0, 6), (4, 12, 3, 10)))
+        self.assertFalse(linmos.overlaps((0, 7, 0, 6), (8, 12, 0, 4)))
+        self.assertFalse(linmos.overlaps(None, (8, 12, 0, 4)))
+
+    def test_combine(self):
+        linmos.combine(self.beam_maps, self.image_maps, self.inv_cov, self.variance_map, self.numerator_map)
+        self.check_mosaic()
+
+    def test_combine_tiles(self):
+        linmos.combine(self.beam_maps, self.image_maps, self.inv_cov, self.variance_map, self.numerator_map,
+                       tile_rows=5)
+        self.check_mosaic()
+
+    def test_combine_regions(self):
+        linmos.combine(self.beam_maps, self.image_maps, self.inv_cov, self.variance_map, self.numerator_map,
+                       tile_rows=3)
+        # Update the image of one beam and only recompute its footprint
+        self.images[1][6:9, 4:8] += 10.
+        pixels = mirio.openimage(self.image_maps[1])
+        pixels[:] = self.images[1]
+        mirio.closeimage(self.image_maps[1], pixels)
+        del pixels
+        region = linmos.footprint(self.beam_maps[1])
+        linmos.combine(self.beam_maps, self.image_maps, self.inv_cov, self.variance_map, self.numerator_map,
+                       tile_rows=3, regions=[region])
+        self.check_mosaic()
+
+    def test_combine_shape_mismatch(self):
+        other = os.path.join(self.tmpdir, 'other')
+        make_image(other, np.zeros((NY, NX + 1), dtype=np.float32))
+        self.assertRaises(Exception, linmos.combine, self.beam_maps, self.image_maps[:2] + [other], self.inv_cov,
+                          self.variance_map, self.numerator_map)
+
+    def test_common_beam(self):
+        self.assertEqual(linmos.common_beam([(10., 5., 30.), (10., 5., 30.)]), (10., 5., 30.))
+        self.assertEqual(linmos.common_beam([(10., 5., 30.), (8., 5., 0.)], circular=True), (10., 10., 0.))
+        bmaj, bmin, bpa = linmos.common_beam([(10., 5., 0.), (10., 5., 90.)])
+        self.assertAlmostEqual(bmaj, 10., places=3)
+        self.assertAlmostEqual(bmin, 10., places=3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+import os
+import shutil
+import struct
+import tempfile
+
+import numpy as np
+
+from apercal.subs import mirio
+
+
+def make_image(path, data, **items):
+    """
+    Writes a MIRIAD image with the given pixels and header items
+    """
+    os.mkdir(path)
+    open(os.path.join(path, 'header'), 'wb').close()
+    header = {'naxis': data.ndim}
+    for axis, size in enumerate(data.shape[::-1]):
+        header['naxis' + str(axis + 1)] = size
+    header.update(items)
+    mirio.writeheader(path, header)
+    with open(os.path.join(path, 'image'), 'wb') as f:
+        f.write(struct.pack('>i', mirio.H_REAL))
+        f.write(np.asarray(data, dtype='>f4').tobytes())
+
+
+class TestMirio(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_encode_decode(self):
+        self.assertEqual(mirio._decode_item(mirio._encode_item(42)), 42)
+        self.assertEqual(mirio._decode_item(mirio._encode_item(1.5)), 1.5)
+        self.assertEqual(mirio._decode_item(mirio._encode_item('RA---SIN')), 'RA---SIN')
+        self.assertEqual(mirio._decode_item(mirio._encode_item(0.1, mirio.H_DBLE)), 0.1)
+        self.assertEqual(mirio._decode_item(mirio._encode_item(2 ** 40, mirio.H_INT8)), 2 ** 40)
+        self.assertEqual(mirio._decode_item(mirio._encode_item([1, 2, 3], mirio.H_INT2)), [1, 2, 3])
+        self.assertEqual(mirio._decode_item(mirio._encode_item(1 - 2j, mirio.H_CMPLX)), 1 - 2j)
+        self.assertRaises(Exception, mirio._encode_item, True)
+
+    def test_header_roundtrip(self):
+        image = os.path.join(self.tmpdir, 'image')
+        make_image(image, np.zeros((4, 6)), crval1=1.5, crpix1=3.0, ctype1='RA---SIN', bunit='JY/BEAM')
+        header = mirio.readheader(image)
+        self.assertEqual(header['naxis'], 2)
+        self.assertEqual(header['naxis1'], 6)
+        self.assertEqual(header['naxis2'], 4)
+        self.assertEqual(header['crval1'], 1.5)
+        self.assertEqual(header['ctype1'], 'RA---SIN')
+        self.assertEqual(mirio.getshape(header), (4, 6))
+        self.assertEqual(mirio.readheader(image, ['crpix1', 'bunit']), {'crpix1': 3.0, 'bunit': 'JY/BEAM'})
+
+    def test_writeheader_keeps_type(self):
+        image = os.path.join(self.tmpdir, 'image')
+        make_image(image, np.zeros((4, 6)), crpix1=3.0)
+        mirio.writeheader(image, {'crpix1': 5, 'bmaj': 1e-4})
+        header = mirio.readheader(image)
+        self.assertIsInstance(header['crpix1'], float)
+        self.assertEqual(header['crpix1'], 5.0)
+        self.assertAlmostEqual(header['bmaj'], 1e-4)
+        self.assertEqual(header['naxis1'], 6)
+
+    def test_mask_roundtrip(self):
+        image = os.path.join(self.tmpdir, 'image')
+        make_image(image, np.zeros((10, 13)))
+        good = np.random.RandomState(1).rand(130) > 0.3
+        mirio.writemask(image, good)
+        np.testing.assert_array_equal(mirio.readmask(image, 130), good)
+        np.testing.assert_array_equal(mirio.readmask(image, 50, first=37), good[37:87])
+        os.remove(os.path.join(image, 'mask'))
+        self.assertIsNone(mirio.readmask(image, 130))
+
+    def test_readimage_and_rows(self):
+        image = os.path.join(self.tmpdir, 'image')
+        data = np.arange(2 * 5 * 7, dtype=np.float32).reshape(2, 5, 7)
+        make_image(image, data)
+        good = np.ones(data.shape, dtype=bool)
+        good[1, 2, 3] = False
+        good[0, 0, :] = False
+        mirio.writemask(image, good)
+        expected = np.where(good, data, np.nan)
+        np.testing.assert_array_equal(mirio.readimage(image), expected)
+        # Rows of all planes follow each other
+        np.testing.assert_array_equal(mirio.readrows(image, 4, 8), expected.reshape(10, 7)[4:8])
+        np.testing.assert_array_equal(mirio.readrows(image, 6, 9, columns=(2, 5)), expected.reshape(10, 7)[6:9, 2:5])
+
+    def test_createimage(self):
+        template = os.path.join(self.tmpdir, 'template')
+        make_image(template, np.zeros((3, 4)), crval1=1.5)
+        image = os.path.join(self.tmpdir, 'image')
+        pixels = mirio.createimage(image, template)
+        pixels[:] = np.arange(12).reshape(3, 4)
+        mirio.closeimage(image, pixels)
+        del pixels
+        np.testing.assert_array_equal(mirio.readimage(image), np.arange(12).reshape(3, 4))
+        header = mirio.readheader(image)
+        self.assertEqual(header['crval1'], 1.5)
+        self.assertEqual(header['datamin'], 0.)
+        self.assertEqual(header['datamax'], 11.)
+        self.assertRaises(Exception, mirio.createimage, image, template)
+
+    def test_readgains(self):
+        dataset = os.path.join(self.tmpdir, 'uv')
+        os.mkdir(dataset)
+        open(os.path.join(dataset, 'header'), 'wb').close()
+        self.assertIsNone(mirio.readgains(dataset))
+        times = np.array([2458000.5, 2458000.6])
+        gains = np.array([[1 + 1j, 2, 0.5j], [1, 1 - 1j, 3]], dtype=np.complex64)
+        mirio.writeheader(dataset, {'ngains': 3, 'nsols': 2})
+        solutions = np.zeros(2, dtype=[('time', '>f8'), ('gains', '>c8', (3,))])
+        solutions['time'] = times
+        solutions['gains'] = gains
+        with open(os.path.join(dataset, 'gains'), 'wb') as f:
+            f.write(b'\x00' * 8)
+            f.write(solutions.tobytes())
+        gaintimes, gainvalues = mirio.readgains(dataset)
+        np.testing.assert_array_equal(gaintimes, times)
+        np.testing.assert_array_equal(gainvalues, gains)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,167 @@
+import unittest
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+import casacore.tables as pt
+import numpy as np
+
+from apercal.subs import msflag
+
+NCHAN = 8
+NCORR = 4
+# Baselines of three antennas including the auto-correlations
+BASELINES = [(0, 0), (0, 1), (0, 2), (1, 1), (1, 2), (2, 2)]
+# Integrations at 10:00, 10:01 and 10:02 on 2017/09/04
+DAY = (datetime(2017, 9, 4) - msflag.MJD_EPOCH).days * 86400.
+TIMES = DAY + 36000. + 60. * np.arange(3)
+
+
+def make_ms(vis):
+    """
+    Creates a small measurement set with three antennas, three integrations, 8 channels and 4 correlations
+    """
+    desc = pt.maketabdesc([pt.makearrcoldesc('DATA', 0j, shape=[NCHAN, NCORR], valuetype='complex')])
+    t = pt.default_ms(vis, desc)
+    nrow = len(BASELINES) * len(TIMES)
+    t.addrows(nrow)
+    t.putcol('ANTENNA1', np.array([a for _ in TIMES for a, b in BASELINES]))
+    t.putcol('ANTENNA2', np.array([b for _ in TIMES for a, b in BASELINES]))
+    t.putcol('TIME', np.repeat(TIMES, len(BASELINES)))
+    t.putcol('UVW', np.tile([100., 100., 0.], (nrow, 1)))
+    t.putcol('FLAG', np.zeros((nrow, NCHAN, NCORR), dtype=bool))
+    t.putcol('FLAG_ROW', np.zeros(nrow, dtype=bool))
+    t.putcol('DATA', np.ones((nrow, NCHAN, NCORR), dtype=np.complex64))
+    t.close()
+    t = pt.table(vis + '/ANTENNA', readonly=False, ack=False)
+    t.addrows(3)
+    t.putcol('NAME', ['RT2', 'RT3', 'RT4'])
+    t.putcol('DISH_DIAMETER', np.full(3, 25.))
+    t.close()
+    t = pt.table(vis + '/SPECTRAL_WINDOW', readonly=False, ack=False)
+    t.addrows(1)
+    t.putcell('NUM_CHAN', 0, NCHAN)
+    t.putcell('CHAN_FREQ', 0, 1.4e9 + 1e6 * np.arange(NCHAN))
+    t.close()
+    t = pt.table(vis + '/POLARIZATION', readonly=False, ack=False)
+    t.addrows(1)
+    t.putcell('NUM_CORR', 0, NCORR)
+    t.putcell('CORR_TYPE', 0, np.array([9, 10, 11, 12]))
+    t.close()
+
+
+def read_flags(vis):
+    t = pt.table(vis, ack=False)
+    flags, flag_row = t.getcol('FLAG'), t.getcol('FLAG_ROW')
+    t.close()
+    return flags, flag_row
+
+
+class TestMSFlag(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.vis = os.path.join(self.tmpdir, 'toy.MS')
+        make_ms(self.vis)
+        t = pt.table(self.vis, ack=False)
+        self.ant1, self.ant2 = t.getcol('ANTENNA1'), t.getcol('ANTENNA2')
+        self.time = t.getcol('TIME')
+        t.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def apply(self, *commands):
+        remaining = msflag.apply_flag_commands(self.vis, list(commands), chunksize=4)
+        self.assertEqual(remaining, [])
+        return read_flags(self.vis)
+
+    def assert_rows_flagged(self, rows):
+        flags, flag_row = read_flags(self.vis)
+        np.testing.assert_array_equal(flags.all(axis=(1, 2)), rows)
+        np.testing.assert_array_equal(flags.any(axis=(1, 2)), rows)
+        np.testing.assert_array_equal(flag_row, rows)
+
+    def test_autocorr(self):
+        self.apply({'autocorr': True})
+        self.assert_rows_flagged(self.ant1 == self.ant2)
+
+    def test_antenna(self):
+        self.apply({'antenna': 'RT3'})
+        self.assert_rows_flagged((self.ant1 == 1) | (self.ant2 == 1))
+
+    def test_baseline(self):
+        self.apply({'antenna': 'RT4&RT2'})
+        self.assert_rows_flagged((self.ant1 == 0) & (self.ant2 == 2))
+
+    def test_timerange(self):
+        self.apply({'timerange': '10:00:30~10:01:30'})
+        self.assert_rows_flagged(self.time == TIMES[1])
+
+    def test_shadow(self):
+        t = pt.table(self.vis, readonly=False, ack=False)
+        uvw = t.getcol('UVW')
+        # RT2 is behind RT3 at a projected distance of 10 m during the first integration
+        uvw[1] = [6., 8., 50.]
+        t.putcol('UVW', uvw)
+        t.close()
+        self.apply({'mode': 'shadow'})
+        self.assert_rows_flagged((self.time == TIMES[0]) & ((self.ant1 == 0) | (self.ant2 == 0)))
+
+    def test_correlation(self):
+        flags, flag_row = self.apply({'correlation': 'XY,YX'})
+        np.testing.assert_array_equal(flags.all(axis=(0, 1)), [False, True, True, False])
+        np.testing.assert_array_equal(flags.any(axis=(0, 1)), [False, True, True, False])
+        self.assertFalse(flag_row.any())
+
+    def test_channels(self):
+        flags, _ = self.apply({'spw': '0:0~1;5'})
+        expected = np.zeros(NCHAN, dtype=bool)
+        expected[[0, 1, 5]] = True
+        np.testing.assert_array_equal(flags.all(axis=(0, 2)), expected)
+        np.testing.assert_array_equal(flags.any(axis=(0, 2)), expected)
+
+    def test_frequency_range(self):
+        flags, _ = self.apply({'spw': '0:1402~1403.5MHz'})
+        np.testing.assert_array_equal(flags.any(axis=(0, 2)), np.arange(NCHAN) // 2 == 1)
+
+    def test_clipzeros(self):
+        t = pt.table(self.vis, readonly=False, ack=False)
+        data = t.getcol('DATA')
+        data[3, 2, 1] = 0.
+        data[7, 4, 0] = np.nan
+        data[9, 0, 3] = np.inf
+        t.putcol('DATA', data)
+        t.close()
+        flags, _ = self.apply({'mode': 'clip', 'clipzeros': True})
+        self.assertEqual(flags.sum(), 3)
+        self.assertTrue(flags[3, 2, 1] and flags[7, 4, 0] and flags[9, 0, 3])
+
+    def test_combined_commands(self):
+        flags, _ = self.apply({'autocorr': True}, {'correlation': 'XX'}, {'spw': '0:7'})
+        expected = np.zeros(flags.shape, dtype=bool)
+        expected[self.ant1 == self.ant2] = True
+        expected[:, :, 0] = True
+        expected[:, 7, :] = True
+        np.testing.assert_array_equal(flags, expected)
+
+    def test_existing_flags_are_kept(self):
+        t = pt.table(self.vis, readonly=False, ack=False)
+        flags = t.getcol('FLAG')
+        flags[1, 3, 2] = True
+        t.putcol('FLAG', flags)
+        t.close()
+        flags, _ = self.apply({'spw': '0:0'})
+        self.assertTrue(flags[1, 3, 2])
+        self.assertEqual(flags.sum(), 1 + len(self.ant1) * NCORR)
+
+    def test_unsupported_commands(self):
+        commands = [{'mode': 'rflag'}, {'antenna': 'RT2', 'spw': '0:0'}, {'antenna': 'RT9'}, {'spw': '0:0', 'mode': 'manual'}]
+        remaining = msflag.apply_flag_commands(self.vis, commands)
+        self.assertEqual(remaining, commands[:3])
+        flags, _ = read_flags(self.vis)
+        np.testing.assert_array_equal(flags.any(axis=(0, 2)), np.arange(NCHAN) == 0)
+
+
+if __name__ == "__main__":
+    unittest.main()